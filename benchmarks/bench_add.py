@@ -0,0 +1,50 @@
+"""Measure the throughput of `add` on a generated working tree.
+
+Usage:
+    python benchmarks/bench_add.py [files] [file_size]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import merge  # noqa: E402
+
+
+def make_tree(root, files, file_size, per_dir=100):
+    """Write `files` random files of `file_size` bytes,
+       `per_dir` files to a directory."""
+    for i in range(files):
+        dir_path = os.path.join(root, f'dir{i // per_dir}')
+        os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, f'file{i}.txt'), 'wb') as f:
+            f.write(os.urandom(file_size))
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(files=10000, file_size=4096):
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        merge.init()
+        make_tree(root, files, file_size)
+        time.sleep(0.01)  # Let the files' mtime tick pass the index's.
+
+        staged, cold = timed(merge.add, '.')
+        _, warm = timed(merge.add, '.')
+        megabytes = files * file_size / 2 ** 20
+        print(f'add {len(staged)} files ({megabytes:.1f} MB): '
+              f'{cold:.2f}s, {files / cold:.0f} files/s, '
+              f'{megabytes / cold:.1f} MB/s')
+        print(f'add again, nothing changed: {warm:.2f}s, '
+              f'{files / warm:.0f} files/s')
+        os.chdir(os.path.dirname(root))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
@@ -0,0 +1,56 @@
+"""Time the CSR commit graph routines on a synthetic history.
+
+Usage:
+    python benchmarks/bench_topology.py [commits] [merge_every] [width]
+
+The frontier-at-a-time routines take one step per generation, so
+they gain most on wide histories (many lines of development).
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import merge  # noqa: E402
+
+
+def make_history(commits, merge_every, width=1, seed=0):
+    """Return a 'commit_id: parents' dict of `width` parallel lines
+       of history, with a merge of a random older commit every
+       `merge_every` commits."""
+    rng = random.Random(seed)
+    ids = [f'{i:040x}' for i in range(commits)]
+    all_parents = {}
+    for i in range(commits):
+        parents = [ids[i - width]] if i >= width else []
+        if merge_every and i % merge_every == 0 and i > width:
+            parents.append(ids[rng.randrange(i - width)])
+        all_parents[ids[i]] = parents
+    return all_parents
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main(commits=100000, merge_every=10, width=1):
+    all_parents = make_history(commits, merge_every, width)
+    backend = 'numpy' if merge.numpy is not None else 'array'
+    print(f'{commits} commits, {width} wide, {backend} backend')
+    _, seconds = timed(merge.topological_order, all_parents)
+    print(f'topological_order (dicts): {seconds:.3f}s')
+    csr, seconds = timed(merge.csr_graph, all_parents)
+    print(f'csr_graph: {seconds:.3f}s')
+    _, seconds = timed(merge.csr_topological_order, csr)
+    print(f'csr_topological_order: {seconds:.3f}s')
+    _, seconds = timed(merge.csr_generations, csr)
+    print(f'csr_generations: {seconds:.3f}s')
+    _, seconds = timed(merge.csr_reachable_count, csr, [commits - 1])
+    print(f'csr_reachable_count: {seconds:.3f}s')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:4]))
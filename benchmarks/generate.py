@@ -0,0 +1,128 @@
+"""Generate synthetic wit repositories of a configurable shape.
+
+Usage:
+    python benchmarks/generate.py <path> [--files N] [--depth N] ...
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import merge  # noqa: E402
+
+
+DEFAULT_SHAPE = {
+    'files': 1000,
+    'depth': 3,
+    'fanout': 8,
+    'mean_size': 4096,
+    'history': 20,
+    'changes': 5,
+    'branch_every': 5,
+    'merge_every': 2,
+    'seed': 0,
+}
+
+
+def file_paths(shape, rng):
+    """Spread `files` relative paths over a directory tree of
+       the given depth and fanout."""
+    paths = []
+    for i in range(shape['files']):
+        depth = rng.randint(0, shape['depth'])
+        dirs = [f"d{rng.randrange(shape['fanout'])}" for _ in range(depth)]
+        paths.append(os.path.join(*dirs, f'file{i}.txt'))
+    return paths
+
+
+def file_size(shape, rng):
+    """Draw a file size from a log-normal distribution around
+       `mean_size`, so most files are small and a few are large."""
+    return int(rng.lognormvariate(0, 1) * shape['mean_size'] / 1.65)
+
+
+def write_file(path, size, rng):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(rng.randbytes(size))
+
+
+def write_files(root, paths, shape, rng):
+    for relpath in paths:
+        write_file(os.path.join(root, relpath), file_size(shape, rng), rng)
+
+
+def commit_changes(root, paths, shape, rng, message):
+    """Rewrite `changes` random files, stage and commit them."""
+    changed = rng.sample(paths, min(shape['changes'], len(paths)))
+    write_files(root, changed, shape, rng)
+    merge.add(*(os.path.join(root, relpath) for relpath in changed))
+    merge.commit(message)
+
+
+def sync_after_merge(root):
+    """Bring the merged files to the working tree, which `merge`
+       leaves untouched, so the next checkout is safe."""
+    staging_area = os.path.join(root, '.wit', 'staging_area')
+    merge.update_root_dir(root, staging_area)
+    merge.add(root)
+
+
+def generate_repo(root, **shape):
+    """Create a repository with the given shape in `root`.
+
+    Args:
+        root (str): An existing, empty directory.
+        shape: Overrides of DEFAULT_SHAPE: the number of files, the
+          directory depth and fanout, the mean file size, the number
+          of commits on master, the files changed per commit, and
+          every how many commits a side branch is made and every how
+          many branches one is merged back.
+
+    Returns:
+        dict: The shape used.
+    """
+    shape = {**DEFAULT_SHAPE, **shape}
+    rng = random.Random(shape['seed'])
+    paths = file_paths(shape, rng)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        merge.init()
+        write_files(root, paths, shape, rng)
+        merge.add(root)
+        merge.commit('Initial commit')
+        branches = 0
+        for i in range(1, shape['history']):
+            commit_changes(root, paths, shape, rng, f'Commit {i}')
+            if not shape['branch_every'] or i % shape['branch_every']:
+                continue
+            name = f'branch{i}'
+            merge.branch(name)
+            merge.checkout(name)
+            commit_changes(root, paths, shape, rng, f'Work on {name}')
+            merge.checkout('master')
+            branches += 1
+            if shape['merge_every'] and not branches % shape['merge_every']:
+                merge.merge(name)
+                sync_after_merge(root)
+    finally:
+        os.chdir(cwd)
+    return shape
+
+
+def shape_arguments(parser):
+    """Add an option for every DEFAULT_SHAPE key to the parser."""
+    for key, value in DEFAULT_SHAPE.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=int, default=value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    shape_arguments(parser)
+    args = vars(parser.parse_args())
+    path = os.path.abspath(args.pop('path'))
+    os.makedirs(path, exist_ok=True)
+    print(generate_repo(path, **args))
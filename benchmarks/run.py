@@ -0,0 +1,148 @@
+"""Time wit's commands on a synthetic repository.
+
+Generates a repository (see generate.py), times add, commit, status,
+checkout, merge, graph and log on it, and prints the results as JSON.
+The read-only commands start every repeat with merge's caches cleared.
+With --compare, the results are checked against an earlier run and
+the exit status is 1 if any command got slower than --threshold.
+
+Usage:
+    python benchmarks/run.py [--files N] ... [--output results.json]
+        [--compare baseline.json] [--threshold 1.2]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import generate  # noqa: E402
+from generate import merge  # noqa: E402
+
+
+def best_of(repeat, function, setup=None):
+    """Return the fastest of `repeat` timed calls, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def clear_caches():
+    """Empty merge's in-process caches, so that repeats in one process
+       time the cold path rather than warm commit and tree caches."""
+    for cached in (merge.read_commit, merge.tree_listing,
+                   merge.matching_lines, merge.blame_blob):
+        cached.cache_clear()
+    for cache in (merge._refs_cache, merge._journal_cache,
+                  merge._commit_graph_cache, merge._bitmaps_cache,
+                  merge._index_cache, merge._packs_cache,
+                  merge._alternates_cache):
+        cache.clear()
+
+
+def run(shape, repeat=3):
+    """Generate a repository and time the commands on it.
+
+    Returns:
+        dict: 'command: seconds' for the fastest of `repeat` runs.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        shape = generate.generate_repo(root, **shape)
+        rng = random.Random(shape['seed'])
+        paths = generate.file_paths(shape, rng)
+        cwd = os.getcwd()
+        os.chdir(root)
+        try:
+            def modify():
+                changed = rng.sample(paths, min(shape['changes'], len(paths)))
+                generate.write_files(root, changed, shape, rng)
+                time.sleep(0.01)
+
+            results['add'] = best_of(repeat, lambda: merge.add(root), modify)
+            results['commit'] = best_of(
+                repeat, lambda: merge.commit('Benchmark'),
+                lambda: (modify(), merge.add(root)),
+            )
+            results['status'] = best_of(repeat, merge.status, clear_caches)
+            merge.branch('benchmark')
+            results['checkout'] = best_of(
+                repeat,
+                lambda: (merge.checkout('benchmark'), merge.checkout('master')),
+            )
+            results['graph'] = best_of(repeat, merge.graph, clear_caches)
+            results['log'] = best_of(repeat, merge.log, clear_caches)
+
+            def prepare_merge():
+                generate.sync_after_merge(root)
+                name = f'merge{time.perf_counter_ns()}'
+                merge.branch(name)
+                merge.checkout(name)
+                generate.commit_changes(root, paths, shape, rng, name)
+                merge.checkout('master')
+                prepare_merge.name = name
+
+            results['merge'] = best_of(
+                repeat, lambda: merge.merge(prepare_merge.name), prepare_merge
+            )
+        finally:
+            os.chdir(cwd)
+    return {
+        'shape': shape,
+        'python': platform.python_version(),
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio of every command to the baseline.
+
+    Returns:
+        list: The commands slower than `threshold` times the baseline.
+    """
+    regressions = []
+    for command, seconds in results['results'].items():
+        before = baseline['results'].get(command)
+        if not before:
+            continue
+        ratio = seconds / before
+        flag = ''
+        if ratio > threshold:
+            regressions.append(command)
+            flag = '  <- regression'
+        print(f'{command:10} {before:9.4f}s -> {seconds:9.4f}s  '
+              f'x{ratio:.2f}{flag}', file=sys.stderr)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    generate.shape_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=1.2)
+    args = vars(parser.parse_args())
+    options = {key: args.pop(key)
+               for key in ('repeat', 'output', 'compare', 'threshold')}
+
+    results = run(args, repeat=options['repeat'])
+    output = json.dumps(results, indent=2)
+    if options['output']:
+        with open(options['output'], 'w') as f:
+            f.write(output + '\n')
+    print(output)
+    if options['compare']:
+        with open(options['compare']) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, options['threshold']):
+            sys.exit(1)
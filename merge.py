@@ -1,16 +1,150 @@
 # Upload 177
+import array
+import atexit
+import concurrent.futures
+import cProfile
 import datetime
+import difflib
 import errno
 import filecmp
-import fnmatch
+import functools
+import getpass
+import glob
+import hashlib
+import heapq
+import io
+import json
 import logging
+import mmap
 import os
 import random
+import re
 import shutil
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+import time
+import zlib
 
 from graphviz import Digraph
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+WIT_TRACE = os.environ.get('WIT_TRACE', '')
+WIT_TRACE_FILE = os.environ.get('WIT_TRACE_FILE', 'wit-trace.json')
+WIT_PROFILE = os.environ.get('WIT_PROFILE', '')
+_trace_events = []
+_trace_spans = threading.local()
+
+
+def traced(name):
+    """Record every call of the decorated function as a span.
+
+    Spans are only recorded when the WIT_TRACE environment variable
+    is set; otherwise the function is returned undecorated, so
+    tracing costs nothing.
+
+    Args:
+        name (str): The span's name, e.g. 'walk' or 'refs.read'.
+    """
+    def decorator(function):
+        if not WIT_TRACE:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            span = {'name': name, 'args': {}}
+            stack = _trace_spans.__dict__.setdefault('stack', [])
+            stack.append(span)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                span['dur'] = time.perf_counter_ns() - start
+                span['ts'] = start
+                span['tid'] = threading.get_ident()
+                stack.pop()
+                _trace_events.append(span)
+        return wrapper
+    return decorator
+
+
+def trace_add(**counters):
+    """Add counters (e.g. files=, bytes=) to the innermost span."""
+    stack = getattr(_trace_spans, 'stack', None)
+    if stack:
+        span_args = stack[-1]['args']
+        for key, value in counters.items():
+            span_args[key] = span_args.get(key, 0) + value
+
+
+def trace_summary(events):
+    """Return a table of the calls, total time and counters per span."""
+    totals = {}
+    for event in events:
+        total = totals.setdefault(event['name'], {'calls': 0, 'ms': 0.0})
+        total['calls'] += 1
+        total['ms'] += event['dur'] / 1e6
+        for key, value in event['args'].items():
+            total[key] = total.get(key, 0) + value
+    lines = [f"{'span':<16}{'calls':>8}{'ms':>12}  counters"]
+    for name, total in sorted(totals.items(), key=lambda t: -t[1]['ms']):
+        counters = ' '.join(f'{key}={value}' for key, value in total.items()
+                            if key not in ('calls', 'ms'))
+        lines.append(
+            f"{name:<16}{total['calls']:>8}{total['ms']:>12.2f}  {counters}")
+    return '\n'.join(lines)
+
+
+def write_trace(command):
+    """Emit the recorded spans, under a span for the whole command.
+
+    WIT_TRACE=chrome writes Chrome trace-event JSON (viewable in
+    chrome://tracing or Perfetto) to WIT_TRACE_FILE; any other value
+    prints a summary table to stderr.
+    """
+    start = min((event['ts'] for event in _trace_events), default=0)
+    events = [{
+        'name': command['name'], 'args': {},
+        'ts': command['start'], 'tid': threading.get_ident(),
+        'dur': time.perf_counter_ns() - command['start'],
+    }] + _trace_events
+    if WIT_TRACE == 'chrome':
+        start = min(start, command['start'])
+        trace_events = [{
+            'name': event['name'], 'cat': 'wit', 'ph': 'X',
+            'ts': (event['ts'] - start) / 1000, 'dur': event['dur'] / 1000,
+            'pid': os.getpid(), 'tid': event['tid'], 'args': event['args'],
+        } for event in events]
+        with open(WIT_TRACE_FILE, 'w') as f:
+            json.dump({'traceEvents': trace_events}, f)
+    else:
+        print(trace_summary(events), file=sys.stderr)
+
+
+def start_tracing(function):
+    """Turn on WIT_TRACE output and WIT_PROFILE for a command.
+
+    With WIT_PROFILE set to a directory, the command runs under
+    cProfile and the stats are dumped to '<dir>/wit-<command>.prof'.
+    """
+    if WIT_TRACE:
+        command = {'name': f'wit {function}', 'start': time.perf_counter_ns()}
+        atexit.register(write_trace, command)
+    if WIT_PROFILE:
+        profiler = cProfile.Profile()
+        os.makedirs(WIT_PROFILE, exist_ok=True)
+        path = os.path.join(WIT_PROFILE, f'wit-{function}.prof')
+        atexit.register(profiler.dump_stats, path)
+        atexit.register(profiler.disable)
+        profiler.enable()
+
 
 def create_paths(paths):
     """Gets a list of  directories paths and create them.
@@ -39,11 +173,12 @@ def update_activated_file(root, branch_name):
         f.write(branch_name)
 
 
-def init():
+def init(store='filesystem'):
     """Make '.wit' directory in the cwd.
 
     Args:
-        None
+        store (str): Default to 'filesystem'. The backend keeping
+          objects, commits and refs, one of STORES.
 
     Returns:
         bool: True if the directory was created successfully,
@@ -54,9 +189,15 @@ def init():
     paths_to_create = (
         wit_path,
         os.path.join(wit_path, 'images'),
+        os.path.join(wit_path, 'journal'),
+        os.path.join(wit_path, 'objects'),
         os.path.join(wit_path, 'staging_area')
     )
     create_paths(paths_to_create)
+    if store != 'filesystem':
+        with open(os.path.join(wit_path, 'store.txt'), 'w') as f:
+            f.write(store)
+    _stores.pop(wit_path, None)
     update_activated_file(cwd, branch_name='master')
     are_exist = all(map(os.path.exists, paths_to_create))
     return are_exist
@@ -66,6 +207,7 @@ class WitDirNotFoundError(Exception):
     pass
 
 
+@traced('discover')
 def is_wit_exists(abs_path):
     """Checks if .wit directory exists in any parent-directory.
 
@@ -94,6 +236,7 @@ def is_wit_exists(abs_path):
         f"in any parent-directory of {abs_path}.")
 
 
+@traced('copy')
 def copy_files(source, destination):
     """Copy all files in the source dir to the destination
        dir. Replace files with same path, makes all
@@ -109,368 +252,1865 @@ def copy_files(source, destination):
         shutil.copy2(source, destination)
     else:
         for dirpath, _, filenames in os.walk(source):
+            target_dir = os.path.join(
+                destination, os.path.relpath(dirpath, start=source)
+            )
+            os.makedirs(target_dir, exist_ok=True)
             for filename in filenames:
-                filepath = os.path.join(dirpath, filename)
-                if not os.path.exists(destination):
-                    os.makedirs(destination)
-                shutil.copy2(filepath, destination)
+                shutil.copy2(os.path.join(dirpath, filename), target_dir)
+            trace_add(files=len(filenames))
 
 
-def add(path):
-    """Copy a file or directory to the staging area.
+CHUNK_SIZE = 1 << 16
+INDEX_VERSION = 2
+PARALLEL_ADD_THRESHOLD = 64
+_index_cache = {}
 
-    Copy all the parent directories of the path to the
-    root directory (which consists '.wit' dir). A directory
-    is copied with all of its content.
 
-    Args:
-        path (str): An absolute or relative path.
-    """
-    abs_path = os.path.abspath(path)
-    root = is_wit_exists(abs_path)
-    staging_area = os.path.join(root, '.wit', 'staging_area')
-    destination = os.path.join(
-        staging_area, os.path.relpath(abs_path, start=root)
-    )
-    copy_files(abs_path, destination)
+_common_dirs = {}
 
 
-def id_generator():
-    """Generate an ID composed of 40 characters"""
-    chars = '1234567890abcdef'
-    return ''.join(random.choices(chars, k=40))
+def common_dir(root):
+    """Return the '.wit' directory that holds the shared history.
 
+    A worktree's '.wit' only keeps its own HEAD, activated branch,
+    index and staging area, and its 'commondir.txt' names the main
+    repository's '.wit', where the images, objects, references and
+    commit graph are.
+    """
+    if root not in _common_dirs:
+        wit_path = os.path.join(root, '.wit')
+        try:
+            with open(os.path.join(wit_path, 'commondir.txt'), 'r') as f:
+                _common_dirs[root] = f.read().strip()
+        except FileNotFoundError:
+            _common_dirs[root] = wit_path
+    return _common_dirs[root]
 
-def get_ref(root):
-    """Extract data from references.txt file.
 
-    Args:
-        root (str): Path to the root directory
-          (which consist .wit directory).
+def object_path(root, sha):
+    """Return the path of an object in '.wit/objects'."""
+    return os.path.join(common_dir(root), 'objects', sha[:2], sha[2:])
 
-    Returns:
-        dict: The current 'HEAD' and 'master'.
-    """
-    references_path = os.path.join(root, '.wit', 'references.txt')
-    with open(references_path, 'r') as f:
-        lines = map(lambda x: x.strip('\n').split('='), f.readlines())
-    references = {line[0]: line[1] for line in lines}
-    return references
 
+_alternates_cache = {}
 
-def create_commit_file(images_path, commit_id, root, message, branch):
-    """Document the detailes of the commit execution.
 
-    Args:
-        images_path (str): Path to 'images' dir in '.wit' dir.
-        commit_id (str): ID generated by `id_generator`.
-        references_path (str): Path to the references.txt file.
-        message (str): User message.
+def wit_dirs(root):
+    """Return the '.wit' directories commits and objects are read from.
+
+    The repository's own '.wit' comes first, followed by the ones
+    listed in its 'alternates.txt' (and theirs), whose commits,
+    images and objects are borrowed rather than copied.
     """
-    commit_path = os.path.join(images_path, f'{commit_id}.txt')
-    date = datetime.datetime.now(datetime.timezone.utc).astimezone()
+    wit_path = common_dir(root)
+    alternates_path = os.path.join(wit_path, 'alternates.txt')
     try:
-        head = get_ref(root)['HEAD']
+        key = os.stat(alternates_path).st_mtime_ns
     except FileNotFoundError:
-        head = None
+        return [wit_path]
+    cached = _alternates_cache.get(alternates_path)
+    if cached and cached[0] == key:
+        return cached[1]
 
-    if not branch:
-        parents = head
-    else:
-        parents = f"{head},{get_ref(root)[branch]}"
+    dirs = [wit_path]
+    for current in dirs:
+        try:
+            with open(os.path.join(current, 'alternates.txt'), 'r') as f:
+                alternates = [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            continue
+        dirs.extend(alternate for alternate in alternates
+                    if alternate not in dirs)
+    _alternates_cache[alternates_path] = (key, dirs)
+    return dirs
 
-    content = (
-        f'parent={parents}\n'
-        + f'date={date.strftime("%c %z")}\n'
-        + f'message={message}'
-    )
-    with open(commit_path, 'w') as commit_file:
-        commit_file.write(content)
 
+def find_in_wit_dirs(root, *path):
+    """Return the first existing path under one of `wit_dirs`,
+       or the repository's own one if none exists."""
+    for wit_path in wit_dirs(root):
+        candidate = os.path.join(wit_path, *path)
+        if os.path.exists(candidate):
+            return candidate
+    return os.path.join(common_dir(root), *path)
 
-def get_active_branch(root):
-    path = os.path.join(root, '.wit', 'activated.txt')
-    with open(path, 'r') as f:
-        return f.read()
 
+def image_path(root, commit_id):
+    """Return the path of a commit's images directory."""
+    return find_in_wit_dirs(root, 'images', commit_id)
 
-def update_references(commit_id, root, head_only=False):
-    """Change the commit id in the refrences.txt file.
 
-    If the reference file doesn't exist, or 'HEAD' and
-    the activated branch points at the same commit_id
-    (according to activated.txt), than both of them gets
-    the new id given to the function. If the active branch
-    points at another id, or there is no actived branch,
-    than only 'HEAD' is changed.
+_refs_cache = {}
 
-    Args:
-        commit_id (str): ID generated by `id_generator`.
-        root (str): Path to the root directory.
-        head_only (bool): Default to False. If True, only the
-          'HEAD' gets the given ID. Usefull for 'checkout' comand.
+
+class Store:
+    """Where a repository keeps its objects, commit records and refs.
+
+    Objects are put and got as their compressed records (see
+    `store_stream`), commits as their raw records (see
+    `format_commit_record`) and refs as a 'name: commit_id' dict.
+    Objects are written through a spool: a file-like object the
+    compressed record is streamed into before its SHA-1 is known.
     """
-    references_path = os.path.join(root, '.wit', 'references.txt')
-    branch = get_active_branch(root)
-    if not os.path.exists(references_path):
-        content = [f'HEAD={commit_id}\n', f'master={commit_id}\n']
-    else:
-        references = get_ref(root)
-        if references['HEAD'] == references.get(branch, 'No branch') and not head_only:
-            references[branch] = commit_id
-        references['HEAD'] = commit_id
-        content = [f'{key}={val}\n' for key, val in references.items()]
 
-    with open(references_path, 'w') as references_file:
-        references_file.writelines(content)
+    def get_object(self, sha):
+        """Return an object's compressed record, or None."""
+        raise NotImplementedError
 
+    def has_object(self, sha):
+        return self.get_object(sha) is not None
 
-def commit(message, branch=None):
-    """Copy the files in the staging area to the 'images' dir
-      and update refrences.txt.
+    def put_object(self, sha, record):
+        raise NotImplementedError
 
-    Args:
-        message (str): User message.
-    """
-    root = is_wit_exists(os.getcwd())
-    commit_id = id_generator()
-    wit_path = os.path.join(root, '.wit')
-    images_path = os.path.join(wit_path, 'images')
-    staging_area_path = os.path.join(wit_path, 'staging_area')
-    commit_path = os.path.join(images_path, commit_id)
+    def put_objects(self, records):
+        """Store (sha, compressed record) pairs."""
+        for sha, record in records:
+            self.put_object(sha, record)
 
-    create_commit_file(images_path, commit_id, root, message, branch)
-    shutil.copytree(staging_area_path, commit_path)
-    update_references(commit_id, root)
+    def iter_objects(self):
+        """Yield the (sha, compressed record) of every object."""
+        raise NotImplementedError
 
+    def iter_object_sizes(self):
+        """Yield the (sha, compressed record's size) of every object."""
+        for sha, record in self.iter_objects():
+            yield sha, len(record)
 
-def dir_files(dir_path, ignore_wit=False):
-    """Create a list of a directory's files.
+    def delete_object(self, sha):
+        raise NotImplementedError
 
-    Args:
-        dir_path (str): The path of the directory.
-        ignore_wit (bool): If one of the directories for comparement
-          is the root dir (which consists the .wit dir), the .wit dir can
-          be ignored.
+    def open_spool(self):
+        return io.BytesIO()
 
-    Returns:
-        list: List of files' paths.
-    """
-    main_files = []
-    for dirpath, dirnames, filenames in os.walk(dir_path):
-        if ignore_wit and '.wit' in dirnames:
-            dirnames.remove('.wit')
-        for filename in filenames:
-            main_files.append(os.path.join(dirpath, filename))
-    return main_files
+    def store_spool(self, sha, spool):
+        self.put_object(sha, spool.getvalue())
 
+    def discard_spool(self, spool):
+        pass
 
-def compare_dirs(main_dir, compared_dir, content=True, ignore_wit=False):
-    """Compare a directory's content to another's directory.
+    def get_commit(self, commit_id):
+        """Return a commit's record, or None."""
+        raise NotImplementedError
 
-    Args:
-        main_dir (str): The path of the main directory for the comparement.
-          The functions iterates over the *main dir's* files and compare them
-          to the parallel files in the compared_dir.
-        compared_dir (str): The path for the second dir.
-        content (bool): If True - compare the content of the files as well.
-          If set to False, compare only the existence of files.
-        ignore_wit (bool): If set to True, the functions doesn't iterate over
-          files in the .wit directory. Usefull for finding untracked files.
+    def has_commit(self, commit_id):
+        return self.get_commit(commit_id) is not None
 
-    Return:
-        list: Files' pathes that exists in the main dir and not in the
-          compared one, and that exits in both dirs and don't have
-          same content.
-    """
-    diff_files = []
-    main_files = dir_files(main_dir, ignore_wit)
-    compared_files = dir_files(compared_dir, ignore_wit=False)
+    def commit_ids(self):
+        return {commit_id for commit_id, _ in self.iter_commits()}
 
-    compared_relpaths = tuple(map(
-        lambda f: os.path.relpath(f, start=compared_dir),
-        compared_files
-    ))
-    for f in main_files:
-        f_relpath = os.path.relpath(f, start=main_dir)
-        compared_f = os.path.join(compared_dir, f_relpath)
-        if f_relpath not in compared_relpaths:
-            diff_files.append(f)
-        elif content and not filecmp.cmp(f, compared_f):
-            diff_files.append(f)
-    return diff_files
+    def iter_commits(self):
+        """Yield the (commit_id, record) of every commit, oldest first."""
+        raise NotImplementedError
 
+    def put_commits(self, records):
+        """Store (commit_id, record) pairs."""
+        raise NotImplementedError
 
-def status():
-    """Return status to the user.
+    def remove_commits(self, keep):
+        """Delete the commits `keep(commit_id, record)` is false for,
+           and return how many were deleted."""
+        raise NotImplementedError
 
-    Args:
-        None
+    def get_refs(self):
+        """Return the 'name: commit_id' dict of the refs, HEAD first.
 
-    Returns:
-        dict: The last 'commit' directory (head), files paths
-          to be committed, files paths not staged for commit and
-          untracked files.
-    """
-    root = is_wit_exists(os.getcwd())
-    head = get_ref(root)["HEAD"]
-    wit_path = os.path.join(root, '.wit')
-    last_commit_path = os.path.join(wit_path, 'images', head)
-    staging_path = os.path.join(wit_path, 'staging_area')
-    status_dict = {
-        "HEAD": head,
-        "Changes to be committed": compare_dirs(staging_path, last_commit_path),
-        "Changes not staged for commit": compare_dirs(staging_path, root),
-        "Untracked files": compare_dirs(root, staging_path,
-                                        content=False, ignore_wit=True),
-    }
-    return status_dict
+        Raises:
+            FileNotFoundError: If nothing was committed yet.
+        """
+        raise NotImplementedError
 
+    def put_refs(self, references):
+        """Replace the refs; implementations drop `_refs_cache[self]`."""
+        raise NotImplementedError
 
-class NotSavedChangesError(Exception):
-    pass
+    def refs_key(self):
+        """Return a value that changes whenever another process
+           changes the refs."""
+        raise NotImplementedError
 
+    def load_refs(self):
+        """Return the refs and their 'commit_id: branch names' index,
+           cached in `_refs_cache` by `refs_key`."""
+        key = self.refs_key()
+        cached = _refs_cache.get(self)
+        if not cached or cached[0] != key:
+            references = self.get_refs()
+            refs_index = {}
+            for name, commit_id in references.items():
+                if name != 'HEAD':
+                    refs_index.setdefault(commit_id, []).append(name)
+            cached = (key, references, refs_index)
+            _refs_cache[self] = cached
+        return cached[1], cached[2]
 
-def update_root_dir(root, commit_path):
-    """Copy files from the given commit directory
-       to the root directory. Replace if needed."""
-    for dirpath, _, filenames in os.walk(commit_path):
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
-            destination = os.path.join(
-                root, os.path.relpath(filepath, start=commit_path)
-            )
-            if not os.path.exists(os.path.dirname(destination)):
-                os.makedirs(os.path.dirname(destination))
-            shutil.copy2(filepath, destination)
 
+class FileStore(Store):
+    """The '.wit' directory layout: loose objects and packs under
+       'objects', commits in the journal and refs in references.txt."""
 
-def update_staging_area(wit_path, commit_path):
-    """Remove the current staging dir and copy the
-       given commit directory's content to a new staging directory"""
-    staging_area = os.path.join(wit_path, 'staging_area')
-    shutil.rmtree(staging_area)
-    shutil.copytree(commit_path, staging_area)
+    def __init__(self, wit_path):
+        self.wit_path = wit_path
+        self.root = os.path.dirname(wit_path)
+        self.objects_path = os.path.join(wit_path, 'objects')
+        self.references_path = os.path.join(wit_path, 'references.txt')
 
+    def loose_path(self, sha):
+        return os.path.join(self.objects_path, sha[:2], sha[2:])
 
-def is_safe_checkout():
-    """Return if there are 'Changes to be committed' or
-       'Changes not staged for commit' according to `status()`"""
-    all_changes_saved = (not (status()["Changes to be committed"]
-                         + status()["Changes not staged for commit"]))
-    if not all_changes_saved:
-        raise NotSavedChangesError(
-            "There are changes not yet staged or commited.")
-    else:
-        return True
+    def get_object(self, sha):
+        try:
+            with open(self.loose_path(sha), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        for index_path, pack_path in list_packs(self.objects_path):
+            found = find_in_pack_index(index_path, sha)
+            if found:
+                with open(pack_path, 'rb') as pack:
+                    pack.seek(found[0])
+                    return pack.read(found[1])
+        return None
 
+    def has_object(self, sha):
+        return os.path.exists(self.loose_path(sha)) or any(
+            find_in_pack_index(index_path, sha)
+            for index_path, _ in list_packs(self.objects_path))
 
-def checkout(identifier):
-    """Update the root directory and the data files.
+    def put_object(self, sha, record):
+        spool = self.open_spool()
+        spool.write(record)
+        self.store_spool(sha, spool)
 
-    Copys the files in the given commit dir to the root dir.
-    Replaces the staging area's content with the commit dir's
-    content. Update refrence.txt and activated.txt (if a commit_id
-    was given then there is no active branch).
+    def put_objects(self, records):
+        """Write the objects to a new pack."""
+        write_pack(self.root, records)
 
-    Args:
-        identifier (str): An existing commit id or branch name.
-    """
-    is_safe_checkout()
-    root = is_wit_exists(os.getcwd())
-    wit_path = os.path.join(root, '.wit')
+    def iter_objects(self):
+        for path, sha, *location in stored_objects(self.root):
+            offset, length = location or (0, None)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                yield sha, f.read() if length is None else f.read(length)
 
-    is_branch = get_ref(root).get(identifier, False)
-    if is_branch:
-        branch = identifier
-        commit_id = is_branch
-    else:
-        branch = ''
-        commit_id = identifier
-    update_activated_file(root, branch_name=branch)
+    def delete_object(self, sha):
+        """Delete a loose object; packed ones go when gc repacks."""
+        if os.path.exists(self.loose_path(sha)):
+            os.remove(self.loose_path(sha))
 
-    commit_path = os.path.join(wit_path, 'images', commit_id)
-    update_root_dir(root, commit_path)
-    update_references(commit_id, root, head_only=True)
-    update_staging_area(wit_path, commit_path)
+    def open_spool(self):
+        os.makedirs(self.objects_path, exist_ok=True)
+        return tempfile.NamedTemporaryFile(
+            dir=self.objects_path, prefix='tmp_', delete=False)
 
+    def store_spool(self, sha, spool):
+        spool.close()
+        path = self.loose_path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(spool.name, path)
 
-def get_commit_data(root, commit_id):
-    """Extract data from commit_id.txt file.
+    def discard_spool(self, spool):
+        spool.close()
+        os.remove(spool.name)
 
-    Args:
-        commit_id (str): An existing commit_id.
+    def get_commit(self, commit_id):
+        offsets = load_journal(self.wit_path)
+        if offsets is None:
+            commit_file = os.path.join(self.wit_path, 'images', f'{commit_id}.txt')
+            if not os.path.exists(commit_file):
+                return None
+            with open(commit_file, 'rb') as f:
+                return f.read()
+        if commit_id not in offsets:
+            return None
+        log_path, offset, length = offsets[commit_id]
+        with open(log_path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
 
-    Returns:
-        dict: The 'parent', 'date' and 'message' values
-          from the file.
-    """
-    commit_f_path = os.path.join(
-        root, '.wit', 'images', f'{commit_id}.txt'
-    )
-    with open(commit_f_path, 'r') as f:
-        lines = map(lambda x: x.strip('\n').split('='), f.readlines())
-    commit_data = {line[0]: line[1] for line in lines}
-    commit_data['parent'] = commit_data['parent'].split(',')
+    def commit_ids(self):
+        offsets = load_journal(self.wit_path)
+        if offsets is None:
+            return {os.path.basename(f)[:-4] for f in
+                    glob.glob(os.path.join(self.wit_path, 'images', '*.txt'))}
+        return set(offsets)
 
-    return commit_data
+    def iter_commits(self):
+        if load_journal(self.wit_path) is None:
+            for commit_file in glob.glob(os.path.join(self.wit_path, 'images', '*.txt')):
+                with open(commit_file, 'rb') as f:
+                    yield os.path.basename(commit_file)[:-4], f.read()
+            return
+        for log_path, _ in journal_segments(self.wit_path):
+            for commit_id, _, _, record in scan_segment(log_path):
+                yield commit_id, record
 
+    def put_commits(self, records):
+        append_commit_records(self.wit_path, records)
 
-def return_all_parents(root):
-    """Return a dictionary of all the commit_ids
-       and their parent-commit_ids."""
-    images = os.path.join(root, '.wit', 'images')
-    with os.scandir(images) as files:
-        commit_files = [os.path.splitext(f.name)[0] for f in files
-                        if fnmatch.fnmatch(f.name, '*.txt')]
-    return {f: get_commit_data(root, f)['parent'] for f in commit_files}
+    def remove_commits(self, keep):
+        if load_journal(self.wit_path) is None:
+            return 0
+        return compact_journal(self.wit_path, keep)
 
+    def get_refs(self):
+        with open(self.references_path, 'r') as f:
+            lines = [line.strip('\n').split('=', 1) for line in f]
+        return {line[0]: line[1] for line in lines if len(line) == 2}
 
-def find_partial_parents(all_parents, start, parents=None):
-    """Find part of the parent-commit diretories of the given
-      commit.
+    def put_refs(self, references):
+        content = [f'{key}={val}\n' for key, val in references.items()]
+        with open(self.references_path, 'w') as references_file:
+            references_file.writelines(content)
+        _refs_cache.pop(self, None)
 
-    Args:
-        all_parents (dict): The dictionary contains each commit
-          and its parents-commits.
-        start (str): The commit_id whose parents are searched.
-        parents (dict): A dictionary similar to parents_dict.
-          Default to None.
+    def refs_key(self):
+        """The stat data of references.txt."""
+        try:
+            stat = os.stat(self.references_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
 
-    Returns:
-        dict: A dictionary similar to parents_dict.
-        None: Only when the start dict
-    """
-    if not parents:
-        parents = {}
-    if all_parents[start] == ['None']:
-        return parents
-    parents.update({start: all_parents[start]})
-    if not all_parents.get(start, False):
-        return None
-    for p in all_parents[start]:
-        if p not in parents.keys():
-            newparents = find_partial_parents(all_parents, p, parents)
-            if newparents:
-                return newparents
-    return None
 
+SQLITE_BATCH_SIZE = 1000
 
-def add_missing_parents(parents, all_parents, root):
-    """Assert that all the parents are in the dictionary.
 
-    `find_partial_parents` doesn't return *all* parents. This
-    function return the missing parents.
+class SQLiteStore(Store):
+    """A single '.wit/store.sqlite' database, for repositories with
+       so many small objects that a file per object wastes inodes."""
 
-    Args:
-        parents (dict): The partial 'commit_id: parent' dict.
-        parents_dict (dict): All of the commit_id in .wit and
-          theirs parents.
+    def __init__(self, wit_path):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            os.path.join(wit_path, 'store.sqlite'), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS objects (
+                    sha TEXT PRIMARY KEY, record BLOB NOT NULL) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS commits (
+                    id TEXT UNIQUE NOT NULL, record BLOB NOT NULL);
+                CREATE TABLE IF NOT EXISTS refs (
+                    position INTEGER PRIMARY KEY, name TEXT, commit_id TEXT);
+            ''')
 
-    Returns:
-        list: Dictionaries of commit_id and its parents.
-    """
-    additional_parents = []
+    def query(self, sql, *parameters):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def iter_rows(self, sql, *parameters):
+        """Yield a query's rows, fetched SQLITE_BATCH_SIZE at a time,
+           so a whole table is never held in memory."""
+        with self.lock:
+            cursor = self.connection.execute(sql, parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(SQLITE_BATCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+    def get_object(self, sha):
+        rows = self.query('SELECT record FROM objects WHERE sha = ?', sha)
+        return rows[0][0] if rows else None
+
+    def put_object(self, sha, record):
+        self.put_objects([(sha, record)])
+
+    def put_objects(self, records):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO objects VALUES (?, ?)', records)
+
+    def iter_objects(self):
+        return self.iter_rows('SELECT sha, record FROM objects')
+
+    def iter_object_sizes(self):
+        return self.iter_rows('SELECT sha, length(record) FROM objects')
+
+    def delete_object(self, sha):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM objects WHERE sha = ?', (sha,))
+
+    def get_commit(self, commit_id):
+        rows = self.query('SELECT record FROM commits WHERE id = ?', commit_id)
+        return rows[0][0] if rows else None
+
+    def commit_ids(self):
+        return {row[0] for row in self.iter_rows('SELECT id FROM commits')}
+
+    def iter_commits(self):
+        return self.iter_rows('SELECT id, record FROM commits ORDER BY rowid')
+
+    def put_commits(self, records):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO commits VALUES (?, ?)', records)
+
+    def remove_commits(self, keep):
+        dropped = [(commit_id,) for commit_id, record in self.iter_commits()
+                   if not keep(commit_id, record)]
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM commits WHERE id = ?', dropped)
+        return len(dropped)
+
+    def get_refs(self):
+        rows = self.query('SELECT name, commit_id FROM refs ORDER BY position')
+        if not rows:
+            raise FileNotFoundError('No references yet.')
+        return dict(rows)
+
+    def put_refs(self, references):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM refs')
+            self.connection.executemany(
+                'INSERT INTO refs VALUES (?, ?, ?)',
+                [(position, name, commit_id) for position, (name, commit_id)
+                 in enumerate(references.items())])
+        _refs_cache.pop(self, None)
+
+    def refs_key(self):
+        """SQLite's data_version, which changes when another
+           connection commits (this one's writes drop the cache)."""
+        return self.query('PRAGMA data_version')[0][0]
+
+
+class MemoryStore(Store):
+    """Dicts that live as long as the process, for tests and
+       benchmarks that shouldn't measure the disk."""
+
+    def __init__(self, wit_path=None):
+        self.objects = {}
+        self.commits = {}
+        self.references = {}
+
+    def get_object(self, sha):
+        return self.objects.get(sha)
+
+    def put_object(self, sha, record):
+        self.objects.setdefault(sha, record)
+
+    def iter_objects(self):
+        return iter(list(self.objects.items()))
+
+    def delete_object(self, sha):
+        self.objects.pop(sha, None)
+
+    def get_commit(self, commit_id):
+        return self.commits.get(commit_id)
+
+    def iter_commits(self):
+        return iter(list(self.commits.items()))
+
+    def put_commits(self, records):
+        for commit_id, record in records:
+            self.commits.setdefault(commit_id, record)
+
+    def remove_commits(self, keep):
+        dropped = [commit_id for commit_id, record in self.commits.items()
+                   if not keep(commit_id, record)]
+        for commit_id in dropped:
+            del self.commits[commit_id]
+        return len(dropped)
+
+    def get_refs(self):
+        if not self.references:
+            raise FileNotFoundError('No references yet.')
+        return dict(self.references)
+
+    def put_refs(self, references):
+        self.references = dict(references)
+        _refs_cache.pop(self, None)
+
+    def refs_key(self):
+        return None
+
+
+STORES = {'filesystem': FileStore, 'sqlite': SQLiteStore, 'memory': MemoryStore}
+_stores = {}
+
+
+def open_store(wit_path):
+    """Return the Store of a '.wit' directory, the backend named in
+       its 'store.txt' ('filesystem' if there is none)."""
+    if wit_path not in _stores:
+        try:
+            with open(os.path.join(wit_path, 'store.txt'), 'r') as f:
+                backend = f.read().strip()
+        except FileNotFoundError:
+            backend = 'filesystem'
+        _stores[wit_path] = STORES[backend](wit_path)
+    return _stores[wit_path]
+
+
+def store_stream(root, obj_type, size, chunks, copy_to=None):
+    """Hash, compress and store an object in a single pass.
+
+    Objects are zlib-compressed '<type> <size>\\0<data>' records
+    named by the SHA-1 of the uncompressed record, like git's
+    loose objects. The data is consumed once; every chunk goes to
+    the hasher, the compressor (and on to the store's spool) and,
+    optionally, a plain copy.
+
+    Args:
+        root (str): Path to the root directory.
+        obj_type (str): 'blob' or 'tree'.
+        size (int): Length of the data.
+        chunks (iterable): The data, as bytes chunks.
+        copy_to (str): Default to None. Path to write the
+          uncompressed data to as well.
+
+    Returns:
+        str: The object's SHA-1.
+    """
+    store = open_store(common_dir(root))
+    header = f'{obj_type} {size}\0'.encode()
+    hasher = hashlib.sha1(header)
+    compressor = zlib.compressobj()
+    spool = store.open_spool()
+    copy = open(copy_to, 'wb') if copy_to else None
+    try:
+        spool.write(compressor.compress(header))
+        for chunk in chunks:
+            hasher.update(chunk)
+            spool.write(compressor.compress(chunk))
+            if copy:
+                copy.write(chunk)
+        spool.write(compressor.flush())
+    except BaseException:
+        store.discard_spool(spool)
+        raise
+    finally:
+        if copy:
+            copy.close()
+
+    sha = hasher.hexdigest()
+    if has_object(root, sha):
+        store.discard_spool(spool)
+    else:
+        store.store_spool(sha, spool)
+    return sha
+
+
+def read_chunks(path):
+    """Yield the content of a file in CHUNK_SIZE pieces."""
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield chunk
+
+
+def write_object(root, obj_type, data):
+    """Store bytes as an object and return its SHA-1."""
+    return store_stream(root, obj_type, len(data), [data])
+
+
+PACK_INDEX_MAGIC = b'WITIDX1\n'
+PACK_INDEX_ENTRY = struct.Struct('>20sQQ')
+PACK_INDEX_HEADER_SIZE = len(PACK_INDEX_MAGIC) + 8
+_packs_cache = {}
+
+
+def list_packs(objects_path):
+    """Return the (index, pack file) path pairs in 'objects/pack',
+       cached by the directory's stat data."""
+    pack_dir = os.path.join(objects_path, 'pack')
+    try:
+        key = os.stat(pack_dir).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    cached = _packs_cache.get(pack_dir)
+    if not cached or cached[0] != key:
+        names = sorted(name[:-4] for name in os.listdir(pack_dir)
+                       if name.endswith('.idx'))
+        cached = (key, [(os.path.join(pack_dir, f'{name}.idx'),
+                         os.path.join(pack_dir, f'{name}.pack'))
+                        for name in names])
+        _packs_cache[pack_dir] = cached
+    return cached[1]
+
+
+def find_in_pack_index(index_path, sha):
+    """Binary search a pack index for an object.
+
+    The index is a header, an entry count and fixed-size
+    (20-byte SHA-1, offset, length) entries sorted by SHA-1, so a
+    lookup is O(log n) and only touches the mapped pages it needs.
+
+    Returns:
+        tuple: (offset, length) in the pack, or None.
+    """
+    with open(index_path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+        position = pack_index_position(index, bytes.fromhex(sha))
+        if position is None:
+            return None
+        return PACK_INDEX_ENTRY.unpack_from(
+            index, PACK_INDEX_HEADER_SIZE + position * PACK_INDEX_ENTRY.size)[1:]
+
+
+def pack_index_position(index, digest):
+    """Return the entry number of a 20-byte digest in a mapped pack
+       index, or None."""
+    low, high = 0, struct.unpack_from('>Q', index, len(PACK_INDEX_MAGIC))[0]
+    while low < high:
+        middle = (low + high) // 2
+        start = PACK_INDEX_HEADER_SIZE + middle * PACK_INDEX_ENTRY.size
+        found = index[start:start + 20]
+        if found < digest:
+            low = middle + 1
+        elif found > digest:
+            high = middle
+        else:
+            return middle
+    return None
+
+
+def iter_pack_index(index_path):
+    """Yield the (sha, offset, length) entries of a pack index."""
+    header_size = len(PACK_INDEX_MAGIC) + 8
+    with open(index_path, 'rb') as f:
+        f.seek(header_size)
+        for entry in iter(lambda: f.read(PACK_INDEX_ENTRY.size), b''):
+            digest, offset, length = PACK_INDEX_ENTRY.unpack(entry)
+            yield digest.hex(), offset, length
+
+
+def read_raw_object(root, sha):
+    """Return the compressed record of an object, loose or packed.
+
+    Raises:
+        FileNotFoundError: If the object doesn't exist.
+    """
+    for wit_path in wit_dirs(root):
+        record = open_store(wit_path).get_object(sha)
+        if record is not None:
+            return record
+    raise FileNotFoundError(f'Object {sha} not found.')
+
+
+def has_object(root, sha):
+    """Check if an object is stored, loose or packed."""
+    return any(open_store(wit_path).has_object(sha)
+               for wit_path in wit_dirs(root))
+
+
+def write_pack(root, records):
+    """Write objects to a new pack and its index.
+
+    Args:
+        root (str): Path to the root directory.
+        records (iterable): (sha, compressed record) pairs, the
+          same bytes as the objects' loose files.
+
+    Returns:
+        tuple: The pack's path and size in bytes.
+    """
+    pack_dir = os.path.join(common_dir(root), 'objects', 'pack')
+    os.makedirs(pack_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=pack_dir, prefix='tmp_')
+    entries = []
+    checksum = hashlib.sha1()
+    offset = 0
+    with os.fdopen(fd, 'wb') as pack:
+        for sha, record in records:
+            pack.write(record)
+            checksum.update(record)
+            entries.append((bytes.fromhex(sha), offset, len(record)))
+            offset += len(record)
+    if not entries:
+        os.remove(tmp_path)
+        return None, 0
+    entries.sort()
+
+    name = os.path.join(pack_dir, f'pack-{checksum.hexdigest()}')
+    with open(f'{name}.idx.tmp', 'wb') as index:
+        index.write(PACK_INDEX_MAGIC + struct.pack('>Q', len(entries)))
+        for entry in entries:
+            index.write(PACK_INDEX_ENTRY.pack(*entry))
+    os.replace(tmp_path, f'{name}.pack')
+    os.replace(f'{name}.idx.tmp', f'{name}.idx')
+    _packs_cache.pop(pack_dir, None)
+    return f'{name}.pack', offset
+
+
+def read_object(root, sha):
+    """Return the type and the data of a stored object.
+
+    Raises:
+        FileNotFoundError: If the object doesn't exist.
+    """
+    record = zlib.decompress(read_raw_object(root, sha))
+    header, _, data = record.partition(b'\0')
+    return header.split()[0].decode(), data
+
+
+@traced('hash')
+def hash_file(root, path, copy_to=None):
+    """Store a file as a blob object, reading it once.
+
+    Args:
+        root (str): Path to the root directory.
+        path (str): Path of the file.
+        copy_to (str): Default to None. Path of a copy to make
+          from the same read, e.g. in the staging area.
+
+    Returns:
+        str: The blob's SHA-1.
+    """
+    size = os.path.getsize(path)
+    trace_add(files=1, bytes=size)
+    sha = store_stream(root, 'blob', size, read_chunks(path), copy_to)
+    if copy_to:
+        shutil.copystat(path, copy_to)
+    return sha
+
+
+def parse_index(lines):
+    """Build the 'relpath: (sha, size, mtime_ns)' dict and the
+       'dirpath: tree sha' cache-tree dict from index.txt lines."""
+    index = {}
+    cache_tree = {}
+    lines = iter(lines)
+    for line in lines:
+        if line == '# tree\n':
+            break
+        sha, size, mtime_ns, relpath = line.rstrip('\n').split(' ', 3)
+        index[relpath] = (sha, int(size), int(mtime_ns))
+    for line in lines:
+        sha, dirpath = line.rstrip('\n').split(' ', 1)
+        cache_tree[dirpath] = sha
+    return index, cache_tree
+
+
+@traced('index.read')
+def read_index(root):
+    """Return the index: every staged file and its blob.
+
+    Each entry keeps the SHA-1 of the staged content and the size
+    and mtime of the working-tree file it was staged from, so
+    unchanged files can be recognized without reading them. The
+    index is cached by the file's stat data. A repository without
+    an index gets one built from its staging area.
+
+    Args:
+        root (str): Path to the root directory.
+
+    Returns:
+        dict: 'relpath: (sha, size, mtime_ns)', with '/'-separated
+          relpaths. A size of -1 means the stat data is unknown.
+    """
+    index_path = os.path.join(root, '.wit', 'index.txt')
+    try:
+        stat = os.stat(index_path)
+    except FileNotFoundError:
+        staging_area = os.path.join(root, '.wit', 'staging_area')
+        index = index_from_dir(root, staging_area)
+        write_index(root, index)
+        return index
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _index_cache.get(index_path)
+    if not cached or cached[0] != key:
+        with open(index_path, 'r') as f:
+            f.readline()
+            cached = (key, *parse_index(f))
+        _index_cache[index_path] = cached
+    return dict(cached[1])
+
+
+def read_cache_tree(root):
+    """Return the index's 'dirpath: tree sha' dict ('' for the root).
+
+    A directory is only in it while none of the entries under it
+    changed since its tree was last written.
+    """
+    read_index(root)
+    index_path = os.path.join(root, '.wit', 'index.txt')
+    return dict(_index_cache[index_path][2])
+
+
+def invalidate_cache_tree(cache_tree, old_index, new_index):
+    """Drop the cached trees of the directories along the paths
+       of the entries whose blob changed between two indexes."""
+    changed = {relpath for relpath in old_index.keys() | new_index.keys()
+               if (old_index.get(relpath) or (None,))[0]
+               != (new_index.get(relpath) or (None,))[0]}
+    for relpath in changed:
+        dirpath = relpath
+        while dirpath:
+            dirpath = dirpath.rpartition('/')[0]
+            cache_tree.pop(dirpath, None)
+    return cache_tree
+
+
+@traced('index.write')
+def write_index(root, index, cache_tree=None):
+    """Write the index dict to index.txt, sorted by path.
+
+    Without a cache_tree, the cached trees of the index on disk are
+    kept, minus the ones the changed entries invalidate.
+    """
+    index_path = os.path.join(root, '.wit', 'index.txt')
+    if cache_tree is None:
+        if os.path.exists(index_path):
+            cache_tree = invalidate_cache_tree(
+                read_cache_tree(root), read_index(root), index)
+        else:
+            cache_tree = {}
+    lines = [f'# index {INDEX_VERSION}\n']
+    for relpath in sorted(index):
+        sha, size, mtime_ns = index[relpath]
+        lines.append(f'{sha} {size} {mtime_ns} {relpath}\n')
+    lines.append('# tree\n')
+    for dirpath in sorted(cache_tree):
+        lines.append(f'{cache_tree[dirpath]} {dirpath}\n')
+    tmp_path = f'{index_path}.lock'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, index_path)
+    _index_cache.pop(index_path, None)
+
+
+def to_relpath(path, start):
+    """Return a '/'-separated path relative to `start`."""
+    return os.path.relpath(path, start=start).replace(os.sep, '/')
+
+
+def index_from_dir(root, dir_path):
+    """Store every file of a directory as a blob and return
+       index entries for them, with unknown stat data."""
+    return {
+        to_relpath(f, dir_path): (hash_file(root, f), -1, 0)
+        for f in dir_files(dir_path)
+    }
+
+
+def expand_pathspecs(root, paths):
+    """Return the absolute paths of the files the pathspecs match.
+
+    A pathspec is a file, a directory (all of its files, '.wit'
+    excluded) or a glob pattern, where '**' matches any number of
+    directories.
+
+    Args:
+        root (str): Path to the root directory.
+        paths (iterable): Paths or glob patterns.
+
+    Returns:
+        list: Absolute file paths, without duplicates.
+    """
+    files = {}
+    for path in paths:
+        abs_path = os.path.abspath(path)
+        if os.path.exists(abs_path):
+            matches = [abs_path]
+        else:
+            matches = glob.glob(abs_path, recursive=True)
+            if not matches:
+                raise FileNotFoundError(
+                    f"pathspec '{path}' did not match any files")
+        for match in matches:
+            if '.wit' in to_relpath(match, root).split('/'):
+                continue
+            if os.path.isdir(match):
+                files.update(dict.fromkeys(dir_files(match, ignore_wit=True)))
+            else:
+                files[match] = None
+    return list(files)
+
+
+@traced('add')
+def add(*paths, dry_run=False):
+    """Stage files: store them as blobs and copy them to the staging area.
+
+    Every file is read once, and the same chunks are hashed,
+    compressed into the object store and copied to the staging
+    area. Files whose size and mtime match their index entry are
+    skipped without being read. Large adds are spread over a pool
+    of worker threads.
+
+    Args:
+        paths (str): Absolute or relative paths, directories
+          or glob patterns.
+        dry_run (bool): Default to False. If True, only return the
+          files that would be staged.
+
+    Returns:
+        list: The relpaths of the staged (changed) files.
+    """
+    root = is_wit_exists(os.path.abspath(paths[0]))
+    staging_area = os.path.join(root, '.wit', 'staging_area')
+    index = read_index(root)
+    # A file modified in the same mtime tick the index was written
+    # in may have changed after it was staged, so it is re-read.
+    index_mtime_ns = os.stat(os.path.join(root, '.wit', 'index.txt')).st_mtime_ns
+
+    changed = []
+    for abs_path in expand_pathspecs(root, paths):
+        relpath = to_relpath(abs_path, root)
+        stat = os.stat(abs_path)
+        entry = index.get(relpath)
+        if (entry and entry[1:] == (stat.st_size, stat.st_mtime_ns)
+                and stat.st_mtime_ns < index_mtime_ns):
+            continue
+        changed.append((abs_path, relpath, stat))
+    if dry_run:
+        return [relpath for _, relpath, _ in changed]
+
+    def stage(item):
+        abs_path, relpath, _ = item
+        destination = os.path.join(staging_area, relpath)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        return hash_file(root, abs_path, copy_to=destination)
+
+    if len(changed) < PARALLEL_ADD_THRESHOLD:
+        shas = map(stage, changed)
+    else:
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            shas = list(pool.map(stage, changed))
+
+    for (_, relpath, stat), sha in zip(changed, shas):
+        index[relpath] = (sha, stat.st_size, stat.st_mtime_ns)
+    write_index(root, index)
+    return [relpath for _, relpath, _ in changed]
+
+
+@traced('tree.write')
+def write_tree(root, index, cache_tree=None):
+    """Store the tree objects of the index and return the
+       root tree's SHA-1.
+
+    A tree object lists '<type> <sha> <name>' lines, sorted by name,
+    for the blobs and sub-trees of one directory. Directories found
+    in cache_tree are not written again, and the ones that are
+    written are added to it.
+    """
+    if cache_tree is None:
+        cache_tree = {}
+    if '' in cache_tree:
+        return cache_tree['']
+    dirs = {'': {}}
+    for relpath, (sha, _, _) in index.items():
+        *names, filename = relpath.split('/')
+        dirpath = ''
+        for name in names:
+            subdir = f'{dirpath}/{name}' if dirpath else name
+            if subdir in cache_tree:
+                dirs.setdefault(dirpath, {})[name] = ('tree', cache_tree[subdir])
+                break
+            dirs.setdefault(dirpath, {})[name] = ('tree', None)
+            dirpath = subdir
+        else:
+            dirs.setdefault(dirpath, {})[filename] = ('blob', sha)
+
+    for dirpath in sorted(dirs, key=lambda d: -d.count('/') - bool(d)):
+        lines = []
+        for name, (obj_type, sha) in sorted(dirs[dirpath].items()):
+            if sha is None:
+                sha = cache_tree[f'{dirpath}/{name}' if dirpath else name]
+            lines.append(f'{obj_type} {sha} {name}\n')
+        cache_tree[dirpath] = write_object(root, 'tree', ''.join(lines).encode())
+    trace_add(trees=len(dirs))
+    return cache_tree['']
+
+
+def read_tree(root, sha, prefix=''):
+    """Return the 'relpath: blob sha' dict of a stored tree."""
+    entries = {}
+    stack = [(sha, prefix)]
+    while stack:
+        tree_sha, dirpath = stack.pop()
+        for line in read_object(root, tree_sha)[1].decode().splitlines():
+            obj_type, obj_sha, name = line.split(' ', 2)
+            path = f'{dirpath}/{name}' if dirpath else name
+            if obj_type == 'tree':
+                stack.append((obj_sha, path))
+            else:
+                entries[path] = obj_sha
+    return entries
+
+
+def commit_entries(root, commit_id):
+    """Return the 'relpath: blob sha' dict of a commit.
+
+    Commits made before trees were stored are hashed from
+    their images directory.
+    """
+    tree = get_commit_data(root, commit_id).get('tree', commit_id)
+    if has_object(root, tree):
+        return read_tree(root, tree)
+    return {relpath: sha for relpath, (sha, _, _)
+            in index_from_dir(root, image_path(root, commit_id)).items()}
+
+
+def id_generator():
+    """Generate an ID composed of 40 characters"""
+    chars = '1234567890abcdef'
+    return ''.join(random.choices(chars, k=40))
+
+
+@traced('refs.read')
+def load_refs(root):
+    """Read the references from the store and index them in both
+       directions: 'name: commit_id' and 'commit_id: branch names'.
+
+    Both are cached by the store (see `Store.load_refs`), so
+    repeated calls in one command don't re-read or re-index them.
+
+    Args:
+        root (str): Path to the root directory
+          (which consist .wit directory).
+
+    Returns:
+        tuple: The references dict and the reverse index dict.
+    """
+    references, refs_index = open_store(common_dir(root)).load_refs()
+    if common_dir(root) != os.path.join(root, '.wit'):
+        with open(os.path.join(root, '.wit', 'HEAD.txt'), 'r') as f:
+            references = {**references, 'HEAD': f.read().strip()}
+    return references, refs_index
+
+
+def get_ref(root):
+    """Extract data from references.txt file.
+
+    Args:
+        root (str): Path to the root directory
+          (which consist .wit directory).
+
+    Returns:
+        dict: The current 'HEAD', 'master' and the other branches.
+    """
+    return dict(load_refs(root)[0])
+
+
+def get_ref_index(root):
+    """Return a dict of 'commit_id: branch names' pointing at it."""
+    return load_refs(root)[1]
+
+
+@traced('refs.write')
+def write_refs(root, references):
+    """Write the references dict to references.txt and
+       drop the cached copy. A worktree's HEAD goes to its
+       own HEAD.txt."""
+    store = open_store(common_dir(root))
+    if common_dir(root) != os.path.join(root, '.wit'):
+        with open(os.path.join(root, '.wit', 'HEAD.txt'), 'w') as f:
+            f.write(references['HEAD'])
+        references = {**references, 'HEAD': store.get_refs()['HEAD']}
+    store.put_refs(references)
+
+
+COMMIT_FORMAT_VERSION = 1
+
+
+def format_commit_record(fields):
+    """Serialize commit fields to a versioned, length-prefixed record.
+
+    Every field is written as a '<key> <length>' line followed by
+    `length` bytes of value and a newline, so values may contain
+    '=' and newlines.
+
+    Args:
+        fields (list): (key, value) string pairs. A key may repeat.
+
+    Returns:
+        bytes: The record.
+    """
+    record = [f'wit-commit {COMMIT_FORMAT_VERSION}\n'.encode()]
+    for key, value in fields:
+        data = value.encode()
+        record.append(f'{key} {len(data)}\n'.encode() + data + b'\n')
+    return b''.join(record)
+
+
+def parse_commit_record(record):
+    """Return the (key, value) pairs of a `format_commit_record` record."""
+    header, _, body = record.partition(b'\n')
+    if header.split()[-1] != str(COMMIT_FORMAT_VERSION).encode():
+        raise ValueError(f'Unknown commit format: {header.decode()}')
+    fields = []
+    pos = 0
+    while pos < len(body):
+        end = body.index(b'\n', pos)
+        key, length = body[pos:end].decode().split(' ')
+        pos = end + 1 + int(length)
+        fields.append((key, body[end + 1:pos].decode()))
+        pos += 1
+    return fields
+
+
+def create_commit_file(images_path, commit_id, root, message, branch, tree):
+    """Document the detailes of the commit execution.
+
+    The commit file holds the snapshot's tree object, the
+    parent-commits, the author, the time as epoch seconds and
+    UTC offset, and the message.
+
+    Args:
+        images_path (str): Path to 'images' dir in '.wit' dir.
+        commit_id (str): ID generated by `id_generator`.
+        root (str): Path to the root directory.
+        message (str): User message.
+        branch (str): A branch merged into HEAD, or None.
+        tree (str): SHA-1 of the root tree object.
+    """
+    try:
+        head = get_ref(root)['HEAD']
+    except FileNotFoundError:
+        head = None
+
+    if not branch:
+        parents = [f'{head}']
+    else:
+        parents = [head, get_ref(root)[branch]]
+    write_commit_record(images_path, commit_id, tree, parents, message)
+
+
+def write_commit_record(images_path, commit_id, tree, parents, message):
+    """Append a commit in the length-prefixed format to the journal.
+
+    Args:
+        images_path (str): Path to 'images' dir in '.wit' dir.
+        commit_id (str): ID generated by `id_generator`.
+        tree (str): SHA-1 of the root tree object.
+        parents (list): The parent commit_ids ('None' for none).
+        message (str): User message.
+    """
+    date = datetime.datetime.now(datetime.timezone.utc).astimezone()
+    offset = int(date.utcoffset().total_seconds()) // 60
+    sign = '-' if offset < 0 else '+'
+    hours, minutes = divmod(abs(offset), 60)
+    fields = [('tree', tree)]
+    fields.extend(('parent', parent) for parent in parents)
+    fields.extend([
+        ('author', os.environ.get('WIT_AUTHOR') or getpass.getuser()),
+        ('timestamp', f'{int(date.timestamp())} {sign}{hours:02d}{minutes:02d}'),
+        ('message', message),
+    ])
+    open_store(os.path.dirname(images_path)).put_commits(
+        [(commit_id, format_commit_record(fields))])
+
+
+def get_active_branch(root):
+    path = os.path.join(root, '.wit', 'activated.txt')
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def update_references(commit_id, root, head_only=False):
+    """Change the commit id in the refrences.txt file.
+
+    If the reference file doesn't exist, or 'HEAD' and
+    the activated branch points at the same commit_id
+    (according to activated.txt), than both of them gets
+    the new id given to the function. If the active branch
+    points at another id, or there is no actived branch,
+    than only 'HEAD' is changed.
+
+    Args:
+        commit_id (str): ID generated by `id_generator`.
+        root (str): Path to the root directory.
+        head_only (bool): Default to False. If True, only the
+          'HEAD' gets the given ID. Usefull for 'checkout' comand.
+    """
+    branch = get_active_branch(root)
+    try:
+        references = get_ref(root)
+    except FileNotFoundError:
+        references = {'HEAD': commit_id, 'master': commit_id}
+    else:
+        if references['HEAD'] == references.get(branch, 'No branch') and not head_only:
+            references[branch] = commit_id
+        references['HEAD'] = commit_id
+    write_refs(root, references)
+
+
+@traced('commit')
+def commit(message, branch=None):
+    """Record the index's tree as a new commit and update
+      refrences.txt.
+
+    Only the trees the cache-tree doesn't cover are written; the
+    commit's images directory is made when something needs it
+    (see `ensure_image`).
+
+    Args:
+        message (str): User message.
+
+    Returns:
+        str: The new commit_id.
+    """
+    root = is_wit_exists(os.getcwd())
+    commit_id = id_generator()
+    images_path = os.path.join(common_dir(root), 'images')
+
+    index = read_index(root)
+    cache_tree = read_cache_tree(root)
+    tree = write_tree(root, index, cache_tree)
+    write_index(root, index, cache_tree)
+    create_commit_file(images_path, commit_id, root, message, branch, tree)
+    append_commit_graph(root, commit_id)
+    update_references(commit_id, root)
+    return commit_id
+
+
+@traced('walk')
+def dir_files(dir_path, ignore_wit=False):
+    """Create a list of a directory's files.
+
+    Args:
+        dir_path (str): The path of the directory.
+        ignore_wit (bool): If one of the directories for comparement
+          is the root dir (which consists the .wit dir), the .wit dir can
+          be ignored.
+
+    Returns:
+        list: List of files' paths.
+    """
+    main_files = []
+    for dirpath, dirnames, filenames in os.walk(dir_path):
+        if ignore_wit and '.wit' in dirnames:
+            dirnames.remove('.wit')
+        for filename in filenames:
+            main_files.append(os.path.join(dirpath, filename))
+    trace_add(files=len(main_files))
+    return main_files
+
+
+@traced('compare')
+def compare_dirs(main_dir, compared_dir, content=True, ignore_wit=False):
+    """Compare a directory's content to another's directory.
+
+    Args:
+        main_dir (str): The path of the main directory for the comparement.
+          The functions iterates over the *main dir's* files and compare them
+          to the parallel files in the compared_dir.
+        compared_dir (str): The path for the second dir.
+        content (bool): If True - compare the content of the files as well.
+          If set to False, compare only the existence of files.
+        ignore_wit (bool): If set to True, the functions doesn't iterate over
+          files in the .wit directory. Usefull for finding untracked files.
+
+    Return:
+        list: Files' pathes that exists in the main dir and not in the
+          compared one, and that exits in both dirs and don't have
+          same content.
+    """
+    diff_files = []
+    main_files = dir_files(main_dir, ignore_wit)
+    compared_files = dir_files(compared_dir, ignore_wit=False)
+
+    compared_relpaths = tuple(map(
+        lambda f: os.path.relpath(f, start=compared_dir),
+        compared_files
+    ))
+    for f in main_files:
+        f_relpath = os.path.relpath(f, start=main_dir)
+        compared_f = os.path.join(compared_dir, f_relpath)
+        if f_relpath not in compared_relpaths:
+            diff_files.append(f)
+        elif content:
+            if WIT_TRACE:
+                trace_add(compared=1, bytes=os.path.getsize(f))
+            if not filecmp.cmp(f, compared_f):
+                diff_files.append(f)
+    return diff_files
+
+
+UNTRACKED_VERSION = 1
+
+
+def read_untracked_cache(root):
+    """Return the untracked cache and the mtime it was written at.
+
+    The cache maps a directory's relpath ('' for the root) to its
+    mtime, a hash of the tracked names in it, its subdirectories
+    and the untracked files found in it.
+    """
+    cache_path = os.path.join(root, '.wit', 'untracked.txt')
+    cache = {}
+    try:
+        with open(cache_path, 'r') as f:
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+            if f.readline() != f'# untracked {UNTRACKED_VERSION}\n':
+                return cache, 0
+            for line in f:
+                kind, value = line.rstrip('\n').split(' ', 1)
+                if kind == 'D':
+                    dir_mtime_ns, tracked_hash, relpath = value.split(' ', 2)
+                    entry = cache[relpath] = (int(dir_mtime_ns), tracked_hash, [], [])
+                else:
+                    entry[2 if kind == 'S' else 3].append(value)
+    except FileNotFoundError:
+        return cache, 0
+    return cache, mtime_ns
+
+
+def write_untracked_cache(root, cache):
+    cache_path = os.path.join(root, '.wit', 'untracked.txt')
+    lines = [f'# untracked {UNTRACKED_VERSION}\n']
+    for relpath, (dir_mtime_ns, tracked_hash, subdirs, untracked) in cache.items():
+        lines.append(f'D {dir_mtime_ns} {tracked_hash} {relpath}\n')
+        lines.extend(f'S {name}\n' for name in subdirs)
+        lines.extend(f'U {name}\n' for name in untracked)
+    tmp_path = f'{cache_path}.lock'
+    with open(tmp_path, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, cache_path)
+
+
+@traced('untracked')
+def untracked_files(root, index):
+    """Return the working-tree files that aren't in the index.
+
+    A directory is only listed again if its mtime or the tracked
+    names in it changed since the untracked cache was written, so
+    on a quiet tree this costs one stat per directory.
+
+    Args:
+        root (str): Path to the root directory.
+        index (dict): The index, as returned by read_index.
+
+    Returns:
+        list: Absolute paths of the untracked files.
+    """
+    tracked = {}
+    for relpath in index:
+        dirpath, _, name = relpath.rpartition('/')
+        tracked.setdefault(dirpath, []).append(name)
+    cache, cache_mtime_ns = read_untracked_cache(root)
+    new_cache = {}
+    untracked = []
+    listed = 0
+    stack = ['']
+    while stack:
+        relpath = stack.pop()
+        dir_path = os.path.join(root, relpath)
+        try:
+            dir_mtime_ns = os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        tracked_names = sorted(tracked.get(relpath, ()))
+        tracked_hash = hashlib.sha1(
+            '\0'.join(tracked_names).encode()).hexdigest()[:16]
+        entry = cache.get(relpath)
+        # A directory changed in the same mtime tick the cache was
+        # written in may have changed after it was listed.
+        if (not entry or entry[:2] != (dir_mtime_ns, tracked_hash)
+                or dir_mtime_ns >= cache_mtime_ns):
+            listed += 1
+            subdirs, names = [], []
+            with os.scandir(dir_path) as entries:
+                for dir_entry in entries:
+                    if dir_entry.is_dir():
+                        if not dir_entry.is_symlink() and not (
+                                relpath == '' and dir_entry.name == '.wit'):
+                            subdirs.append(dir_entry.name)
+                    else:
+                        names.append(dir_entry.name)
+            tracked_set = set(tracked_names)
+            entry = (dir_mtime_ns, tracked_hash, sorted(subdirs),
+                     sorted(name for name in names if name not in tracked_set))
+        new_cache[relpath] = entry
+        untracked.extend(os.path.join(dir_path, name) for name in entry[3])
+        stack.extend(f'{relpath}/{name}' if relpath else name
+                     for name in reversed(entry[2]))
+    trace_add(dirs=len(new_cache), listed=listed)
+    if listed or new_cache.keys() != cache.keys():
+        write_untracked_cache(root, new_cache)
+    return untracked
+
+
+@traced('status')
+def status():
+    """Return status to the user.
+
+    Args:
+        None
+
+    Returns:
+        dict: The last 'commit' directory (head), files paths
+          to be committed, files paths not staged for commit and
+          untracked files.
+    """
+    root = is_wit_exists(os.getcwd())
+    head = get_ref(root)["HEAD"]
+    wit_path = os.path.join(root, '.wit')
+    staging_path = os.path.join(wit_path, 'staging_area')
+    staged = [os.path.join(staging_path, *relpath.split('/'))
+              for relpath in sorted(staged_paths(root, head))]
+    status_dict = {
+        "HEAD": head,
+        "Changes to be committed": [path for path in staged if os.path.exists(path)],
+        "Changes not staged for commit": compare_dirs(staging_path, root),
+        "Untracked files": untracked_files(root, read_index(root)),
+    }
+    return status_dict
+
+
+def staged_paths(root, head):
+    """Return the relpaths staged differently from `head` (added,
+       changed or deleted).
+
+    The index is compared with HEAD's tree, so no file is read.
+    Only a commit without a tree has its images directory compared
+    with the staging area.
+    """
+    staging_path = os.path.join(root, '.wit', 'staging_area')
+    tree = get_commit_data(root, head).get('tree', head)
+    if tree == head or not has_object(root, tree):
+        image = ensure_image(root, head)
+        return ({to_relpath(f, staging_path) for f in compare_dirs(staging_path, image)}
+                | {to_relpath(f, image) for f in compare_dirs(image, staging_path)})
+    index_entries = {relpath: entry[0] for relpath, entry in read_index(root).items()}
+    return changed_paths(commit_entries(root, head), index_entries)
+
+
+class NotSavedChangesError(Exception):
+    pass
+
+
+@traced('copy')
+def update_root_dir(root, commit_path):
+    """Copy files from the given commit directory
+       to the root directory. Replace if needed."""
+    for dirpath, _, filenames in os.walk(commit_path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            destination = os.path.join(
+                root, os.path.relpath(filepath, start=commit_path)
+            )
+            if not os.path.exists(os.path.dirname(destination)):
+                os.makedirs(os.path.dirname(destination))
+            shutil.copy2(filepath, destination)
+            trace_add(files=1)
+
+
+@traced('copy')
+def update_staging_area(wit_path, commit_path):
+    """Remove the current staging dir and copy the
+       given commit directory's content to a new staging directory"""
+    staging_area = os.path.join(wit_path, 'staging_area')
+    shutil.rmtree(staging_area)
+    shutil.copytree(commit_path, staging_area)
+
+
+def is_safe_checkout():
+    """Return if there are 'Changes to be committed' or
+       'Changes not staged for commit' according to `status()`"""
+    changes = status()
+    all_changes_saved = (not (changes["Changes to be committed"]
+                         + changes["Changes not staged for commit"]))
+    if not all_changes_saved:
+        raise NotSavedChangesError(
+            "There are changes not yet staged or commited.")
+    else:
+        return True
+
+
+@traced('checkout')
+def checkout(identifier):
+    """Update the root directory and the data files.
+
+    Copys the files in the given commit dir to the root dir.
+    Replaces the staging area's content with the commit dir's
+    content. Update refrence.txt and activated.txt (if a commit_id
+    was given then there is no active branch).
+
+    Args:
+        identifier (str): An existing commit id (or a unique prefix
+          of one) or branch name.
+
+    Returns:
+        str: The checked out commit_id.
+    """
+    is_safe_checkout()
+    root = is_wit_exists(os.getcwd())
+    wit_path = os.path.join(root, '.wit')
+
+    is_branch = get_ref(root).get(identifier, False)
+    if is_branch:
+        check_not_checked_out(root, identifier)
+        branch = identifier
+        commit_id = is_branch
+    else:
+        branch = ''
+        commit_id = resolve(root, identifier)
+    update_activated_file(root, branch_name=branch)
+
+    commit_path = ensure_image(root, commit_id)
+    update_root_dir(root, commit_path)
+    update_references(commit_id, root, head_only=True)
+    update_staging_area(wit_path, commit_path)
+    reset_index(root, commit_id)
+    return commit_id
+
+
+def reset_index(root, commit_id):
+    """Make the index list the files of the given commit, with
+       the stat data of their freshly checked out copies."""
+    index = {}
+    for relpath, sha in commit_entries(root, commit_id).items():
+        stat = os.stat(os.path.join(root, relpath))
+        index[relpath] = (sha, stat.st_size, stat.st_mtime_ns)
+    write_index(root, index)
+
+
+JOURNAL_SEGMENT_SIZE = 64 * 1024 * 1024
+JOURNAL_FRAME = struct.Struct('>20sI')
+JOURNAL_ENTRY = struct.Struct('>20sQI')
+_journal_cache = {}
+
+
+def journal_segments(wit_path):
+    """Return the (log_path, idx_path) pairs of a journal, oldest first."""
+    journal_path = os.path.join(wit_path, 'journal')
+    return [(log_path, log_path[:-4] + '.idx')
+            for log_path in sorted(glob.glob(os.path.join(journal_path, 'segment-*.log')))]
+
+
+def new_segment_path(wit_path):
+    """Return the log path of the segment after the journal's last."""
+    segments = journal_segments(wit_path)
+    number = int(os.path.basename(segments[-1][0])[8:-4]) if segments else 0
+    return os.path.join(wit_path, 'journal', f'segment-{number + 1:06d}.log')
+
+
+def scan_segment(log_path, offset=0):
+    """Yield the (commit_id, offset, length, record) of the frames of
+       a journal segment, from `offset` up to a torn last frame."""
+    with open(log_path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            frame = f.read(JOURNAL_FRAME.size)
+            if len(frame) < JOURNAL_FRAME.size:
+                return
+            digest, length = JOURNAL_FRAME.unpack(frame)
+            record = f.read(length)
+            if len(record) < length:
+                return
+            yield digest.hex(), offset + JOURNAL_FRAME.size, length, record
+            offset += JOURNAL_FRAME.size + length
+
+
+def recover_segment(log_path, idx_path, entries):
+    """Index the frames appended to a segment after its last idx
+       entry (a crash between the two appends), and cut off a torn
+       last frame."""
+    end = 0
+    if entries:
+        _, offset, length = entries[-1]
+        end = offset + length
+    recovered = []
+    for commit_id, offset, length, _ in scan_segment(log_path, end):
+        recovered.append((bytes.fromhex(commit_id), offset, length))
+        end = offset + length
+    if end < os.path.getsize(log_path):
+        os.truncate(log_path, end)
+    # Opened even with nothing to add, so the idx always exists.
+    with open(idx_path, 'ab') as f:
+        f.writelines(JOURNAL_ENTRY.pack(*entry) for entry in recovered)
+    return entries + recovered
+
+
+def journal_key(segments):
+    """Return the sizes of the segments' log and idx files, the
+       key `load_journal` caches the offsets by."""
+    return tuple(
+        (os.path.getsize(log_path),
+         os.path.getsize(idx_path) if os.path.exists(idx_path) else 0)
+        for log_path, idx_path in segments
+    )
+
+
+@traced('journal.read')
+def load_journal(wit_path):
+    """Return the 'commit_id: (log_path, offset, length)' dict of
+       a repository's commit journal.
+
+    The journal is a list of append-only segments of
+    (commit_id, length, record) frames, each with an idx file of
+    fixed-size (commit_id, offset, length) entries; reading the idx
+    files is one sequential read per segment. The dict is cached by
+    the segments' sizes. A repository that still has one commit file
+    per commit gets them moved into a journal first.
+
+    Returns:
+        dict: The commit offsets, or None if the repository has no
+          journal and can't get one.
+    """
+    journal_path = os.path.join(wit_path, 'journal')
+    if not os.path.isdir(journal_path):
+        try:
+            migrate_commit_files(wit_path)
+        except OSError:
+            return None
+    segments = journal_segments(wit_path)
+    key = journal_key(segments)
+    cached = _journal_cache.get(wit_path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    offsets = {}
+    for log_path, idx_path in segments:
+        try:
+            with open(idx_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        entries = list(JOURNAL_ENTRY.iter_unpack(
+            data[:len(data) - len(data) % JOURNAL_ENTRY.size]))
+        last_end = entries[-1][1] + entries[-1][2] if entries else 0
+        if last_end < os.path.getsize(log_path) or not os.path.exists(idx_path):
+            entries = recover_segment(log_path, idx_path, entries)
+        for digest, offset, length in entries:
+            offsets[digest.hex()] = (log_path, offset, length)
+    _journal_cache[wit_path] = (journal_key(segments), offsets)
+    return offsets
+
+
+def append_commit_records(wit_path, records):
+    """Append (commit_id, record) pairs to the journal with a
+       single fsync, starting a new segment when the last one is
+       full."""
+    os.makedirs(os.path.join(wit_path, 'journal'), exist_ok=True)
+    segments = journal_segments(wit_path)
+    if segments and os.path.getsize(segments[-1][0]) < JOURNAL_SEGMENT_SIZE:
+        log_path, idx_path = segments[-1]
+    else:
+        log_path = new_segment_path(wit_path)
+        idx_path = log_path[:-4] + '.idx'
+    entries = []
+    with open(log_path, 'ab') as f:
+        for commit_id, record in records:
+            digest = bytes.fromhex(commit_id)
+            f.write(JOURNAL_FRAME.pack(digest, len(record)))
+            entries.append(JOURNAL_ENTRY.pack(digest, f.tell(), len(record)))
+            f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+    with open(idx_path, 'ab') as f:
+        f.writelines(entries)
+    _journal_cache.pop(wit_path, None)
+
+
+def migrate_commit_files(wit_path):
+    """Move the 'images/<commit_id>.txt' commit files of a
+       repository into a new journal.
+
+    The journal is written in a temporary directory and renamed
+    into place whole, so a crash never leaves a journal missing
+    some of the commits (the commit files are only deleted after).
+    """
+    images_path = os.path.join(wit_path, 'images')
+    commit_files = glob.glob(os.path.join(images_path, '*.txt'))
+    records = []
+    for commit_file in commit_files:
+        with open(commit_file, 'rb') as f:
+            records.append((os.path.basename(commit_file)[:-4], f.read()))
+    tmp_path = tempfile.mkdtemp(dir=wit_path, prefix='tmp_journal_')
+    try:
+        os.makedirs(os.path.join(tmp_path, 'journal'))
+        if records:
+            append_commit_records(tmp_path, records)
+        os.rename(os.path.join(tmp_path, 'journal'),
+                  os.path.join(wit_path, 'journal'))
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    for commit_file in commit_files:
+        os.remove(commit_file)
+
+
+def read_commit_record(root, commit_id):
+    """Return the raw record of a commit, from the journal of the
+       repository or one of its alternates.
+
+    Raises:
+        FileNotFoundError: If the commit doesn't exist.
+    """
+    for wit_path in wit_dirs(root):
+        record = open_store(wit_path).get_commit(commit_id)
+        if record is not None:
+            return record
+    raise FileNotFoundError(f"No commit '{commit_id}'")
+
+
+def iter_commit_records(root):
+    """Yield the (commit_id, record) of every commit, reading each
+       journal sequentially. Alternates come after the repository."""
+    for wit_path in wit_dirs(root):
+        yield from open_store(wit_path).iter_commits()
+
+
+def compact_journal(wit_path, keep):
+    """Rewrite a journal with only the commits `keep(commit_id,
+       record)` is true for.
+
+    The kept records are written to a new segment before the old
+    ones are deleted, so a crash leaves duplicates, never losses.
+
+    Returns:
+        int: The number of commits dropped.
+    """
+    segments = journal_segments(wit_path)
+    kept, dropped = [], 0
+    seen = set()
+    for log_path, _ in segments:
+        for commit_id, _, _, record in scan_segment(log_path):
+            if commit_id in seen:
+                continue
+            seen.add(commit_id)
+            if keep(commit_id, record):
+                kept.append((commit_id, record))
+            else:
+                dropped += 1
+    if not dropped:
+        return 0
+    log_path = new_segment_path(wit_path)
+    with open(log_path, 'wb') as f, open(log_path[:-4] + '.idx', 'wb') as idx:
+        for commit_id, record in kept:
+            digest = bytes.fromhex(commit_id)
+            f.write(JOURNAL_FRAME.pack(digest, len(record)))
+            idx.write(JOURNAL_ENTRY.pack(digest, f.tell(), len(record)))
+            f.write(record)
+        f.flush()
+        os.fsync(f.fileno())
+    for old_log, old_idx in segments:
+        os.remove(old_log)
+        if os.path.exists(old_idx):
+            os.remove(old_idx)
+    _journal_cache.pop(wit_path, None)
+    return dropped
+
+
+COMMIT_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=COMMIT_CACHE_SIZE)
+@traced('commit.read')
+def read_commit(root, commit_id):
+    """Read and parse a commit record, at most once per process.
+
+    Commits never change, so the parsed commits are kept in an
+    LRU cache keyed by the root and commit_id.
+
+    Raises:
+        FileNotFoundError: If the commit doesn't exist.
+    """
+    record = read_commit_record(root, commit_id)
+    trace_add(bytes=len(record))
+    return parse_commit(record)
+
+
+def parse_commit(record):
+    """Parse a commit record into a dict. Records written before
+       the length-prefixed format are parsed as 'key=value' lines."""
+    if not record.startswith(b'wit-commit '):
+        lines = record.decode().split('\n')
+        commit_data = dict(line.split('=', 1) for line in lines[:2])
+        commit_data['message'] = '\n'.join(lines[2:]).split('=', 1)[-1]
+        commit_data['parent'] = tuple(commit_data['parent'].split(','))
+        return commit_data
+
+    commit_data = {'parent': ()}
+    for key, value in parse_commit_record(record):
+        if key == 'parent':
+            commit_data['parent'] += (value,)
+        else:
+            commit_data[key] = value
+    epoch, offset = commit_data['timestamp'].split()
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    timezone = datetime.timezone(datetime.timedelta(
+        minutes=-minutes if offset[0] == '-' else minutes
+    ))
+    date = datetime.datetime.fromtimestamp(int(epoch), timezone)
+    commit_data['date'] = date.strftime("%c %z")
+    return commit_data
+
+
+def get_commit_data(root, commit_id):
+    """Extract data from commit_id.txt file.
+
+    Args:
+        root (str): Path to the root directory.
+        commit_id (str): An existing commit_id.
+
+    Returns:
+        dict: The 'parent' (a list), 'date' and 'message' values
+          from the file, and the 'tree', 'author' and 'timestamp'
+          of commits in the length-prefixed format.
+    """
+    commit_data = dict(read_commit(root, commit_id))
+    commit_data['parent'] = list(commit_data['parent'])
+    return commit_data
+
+
+def list_commit_ids(root):
+    """Return the set of commit_ids in the journal,
+       the alternates' commits included."""
+    commit_ids = set()
+    for wit_path in wit_dirs(root):
+        commit_ids.update(open_store(wit_path).commit_ids())
+    return commit_ids
+
+
+def return_all_parents(root):
+    """Return a dictionary of all the commit_ids
+       and their parent-commit_ids, read in one pass
+       over the journal."""
+    all_parents = {}
+    for commit_id, record in iter_commit_records(root):
+        all_parents.setdefault(commit_id, list(parse_commit(record)['parent']))
+    return all_parents
+
+
+def find_partial_parents(all_parents, start, parents=None):
+    """Find part of the parent-commit diretories of the given
+      commit.
+
+    Args:
+        all_parents (dict): The dictionary contains each commit
+          and its parents-commits.
+        start (str): The commit_id whose parents are searched.
+        parents (dict): A dictionary similar to parents_dict.
+          Default to None.
+
+    Returns:
+        dict: A dictionary similar to parents_dict.
+        None: Only when the start dict
+    """
+    if not parents:
+        parents = {}
+    if all_parents[start] == ['None']:
+        return parents
+    parents.update({start: all_parents[start]})
+    if not all_parents.get(start, False):
+        return None
+    for p in all_parents[start]:
+        if p not in parents.keys():
+            newparents = find_partial_parents(all_parents, p, parents)
+            if newparents:
+                return newparents
+    return None
+
+
+def add_missing_parents(parents, all_parents, root):
+    """Assert that all the parents are in the dictionary.
+
+    `find_partial_parents` doesn't return *all* parents. This
+    function return the missing parents.
+
+    Args:
+        parents (dict): The partial 'commit_id: parent' dict.
+        parents_dict (dict): All of the commit_id in .wit and
+          theirs parents.
+
+    Returns:
+        list: Dictionaries of commit_id and its parents.
+    """
+    additional_parents = []
     for val in parents.values():
         for p in val:
             none_parent = get_commit_data(root, p)['parent'] == ['None']
@@ -481,87 +2121,2744 @@ def add_missing_parents(parents, all_parents, root):
     return additional_parents
 
 
-def return_parents(root, start):
-    """Consolidate the dictionaries from
-       `find_partial_parents` and `add_missing_parents`.
+def return_parents(root, start):
+    """Consolidate the dictionaries from
+       `find_partial_parents` and `add_missing_parents`.
+
+    Args:
+        root (str): Path to the root directory.
+        start (str): Existing commit_id.
+
+    Returns:
+        dict: All of the parents from the start commit_id
+          to the first commit_id (parent=None).
+    """
+    all_parents = return_all_parents(root)
+    parents_a = find_partial_parents(all_parents, start)
+
+    parents_b = add_missing_parents(parents_a, all_parents, root)
+    while parents_b:
+        for parents_dict in parents_b:
+            parents_a.update(parents_dict)
+        parents_b = add_missing_parents(parents_a, all_parents, root)
+    return parents_a
+
+
+COMMIT_GRAPH_VERSION = 3
+BITMAP_EVERY = 100
+_commit_graph_cache = {}
+_bitmaps_cache = {}
+
+
+def topological_order(all_parents):
+    """Order commit_ids so that every commit comes after its parents.
+
+    Uses an iterative depth-first walk, so each line of history is
+    laid out contiguously and deep histories don't hit the
+    recursion limit.
+
+    Args:
+        all_parents (dict): 'commit_id: parent-commit_ids' dict,
+          like the one `return_all_parents` returns.
+
+    Returns:
+        list: The ordered commit_ids.
+    """
+    ordered = []
+    done = set()
+    for start in sorted(all_parents):
+        stack = [(start, False)]
+        while stack:
+            commit_id, expanded = stack.pop()
+            if commit_id in done:
+                continue
+            if expanded:
+                done.add(commit_id)
+                ordered.append(commit_id)
+                continue
+            stack.append((commit_id, True))
+            for p in reversed(all_parents[commit_id]):
+                if p in all_parents and p not in done:
+                    stack.append((p, False))
+    return ordered
+
+
+BLOOM_BITS_PER_PATH = 10
+BLOOM_HASHES = 7
+BLOOM_MAX_PATHS = 512
+
+
+def diff_tree_paths(root, old_tree, new_tree, prefix=''):
+    """Return the relpaths of the files and directories that differ
+       between two stored trees. Equal subtrees aren't read."""
+    if old_tree == new_tree:
+        return set()
+    old = tree_listing(root, old_tree) if old_tree else {}
+    new = tree_listing(root, new_tree) if new_tree else {}
+    paths = set()
+    for name in old.keys() | new.keys():
+        old_type, old_sha = old.get(name, (None, None))
+        new_type, new_sha = new.get(name, (None, None))
+        if old_sha == new_sha:
+            continue
+        path = f'{prefix}/{name}' if prefix else name
+        paths.add(path)
+        if 'tree' in (old_type, new_type):
+            paths |= diff_tree_paths(
+                root, old_sha if old_type == 'tree' else None,
+                new_sha if new_type == 'tree' else None, path)
+    return paths
+
+
+def same_on_disk(path_a, path_b):
+    """Return True if two files or directories (or two missing
+       paths) have the same content. Nothing is hashed."""
+    if os.path.isfile(path_a) and os.path.isfile(path_b):
+        return filecmp.cmp(path_a, path_b, shallow=False)
+    if os.path.isdir(path_a) and os.path.isdir(path_b):
+        names = sorted(os.listdir(path_a))
+        return names == sorted(os.listdir(path_b)) and all(
+            same_on_disk(os.path.join(path_a, name), os.path.join(path_b, name))
+            for name in names)
+    return not os.path.exists(path_a) and not os.path.exists(path_b)
+
+
+def path_changed(root, commit_id, relpath):
+    """Return True if a commit changed relpath (a file or a
+       directory) relative to its first parent (or added it, for a
+       root commit).
+
+    Commits with stored trees are tree-diffed. If the commit or its
+    parent has no tree, only relpath is compared between their
+    images directories, so their files are never hashed.
+    """
+    commit_data = get_commit_data(root, commit_id)
+    parent = commit_data['parent'][0]
+    tree = commit_data.get('tree', commit_id)
+    parent_tree = None if parent == 'None' else get_commit_data(
+        root, parent).get('tree', parent)
+    if has_object(root, tree) and (
+            parent_tree is None or has_object(root, parent_tree)):
+        return relpath in diff_tree_paths(root, parent_tree, tree)
+    image = os.path.join(ensure_image(root, commit_id), relpath)
+    if parent == 'None':
+        return os.path.exists(image)
+    return not same_on_disk(os.path.join(ensure_image(root, parent), relpath), image)
+
+
+def bloom_positions(path, size):
+    digest = hashlib.sha1(path.encode()).digest()
+    h1, h2 = struct.unpack('>II', digest[:8])
+    return ((h1 + i * h2) % size for i in range(BLOOM_HASHES))
+
+
+def bloom_filter(paths):
+    """Return the hex encoded changed-path Bloom filter of a commit,
+       or '-' if it changed too many paths to be worth one."""
+    if len(paths) > BLOOM_MAX_PATHS:
+        return '-'
+    size = max(64, -(-len(paths) * BLOOM_BITS_PER_PATH // 64) * 64)
+    bits = 0
+    for path in paths:
+        for position in bloom_positions(path, size):
+            bits |= 1 << position
+    return f'{bits:0{size // 4}x}'
+
+
+def commit_bloom(root, commit_id):
+    """Return the Bloom filter of the paths a commit changed, or '-'
+       if it or its first parent has no stored tree: diffing their
+       images directories would hash (and store) every file."""
+    commit_data = get_commit_data(root, commit_id)
+    parent = commit_data['parent'][0]
+    tree = commit_data.get('tree')
+    parent_tree = None if parent == 'None' else get_commit_data(root, parent).get('tree')
+    if (tree is None or not has_object(root, tree) or parent != 'None'
+            and (parent_tree is None or not has_object(root, parent_tree))):
+        return '-'
+    return bloom_filter(diff_tree_paths(root, parent_tree, tree))
+
+
+def maybe_changed(graph, position, relpath):
+    """Return False if the commit at `position` surely didn't change
+       relpath relative to its first parent. True may be a false
+       positive."""
+    bloom = graph['bloom'][position]
+    if bloom == '-':
+        return True
+    bits = int(bloom, 16)
+    return all(bits >> bit & 1
+               for bit in bloom_positions(relpath, len(bloom) * 4))
+
+
+def write_commit_graph(root):
+    """Write all the commits to commit-graph.txt in topological order.
+
+    Each line holds a commit_id, its generation number (1 for a
+    root commit, otherwise one more than its highest parent), its
+    parents and the Bloom filter of the paths it changed; the line
+    number is the commit's position, used as
+    its bit in the reachability bitmaps. Rewriting the graph
+    invalidates the bitmaps and the commit ID index.
+
+    Args:
+        root (str): Path to the root directory.
+
+    Returns:
+        dict: The loaded commit graph.
+    """
+    wit_path = common_dir(root)
+    all_parents = return_all_parents(root)
+    lines = [f'# commit-graph {COMMIT_GRAPH_VERSION}\n']
+    generations = {}
+    for commit_id in topological_order(all_parents):
+        parents = [p for p in all_parents[commit_id] if p in all_parents]
+        generations[commit_id] = 1 + max(
+            (generations[p] for p in parents), default=0
+        )
+        lines.append(
+            f"{commit_id} {generations[commit_id]} "
+            f"{','.join(parents) or 'None'} "
+            f"{commit_bloom(root, commit_id)}\n"
+        )
+    with open(os.path.join(wit_path, 'commit-graph.txt'), 'w') as f:
+        f.writelines(lines)
+    for name in ('bitmaps.txt', 'commit-ids.idx'):
+        if os.path.exists(os.path.join(wit_path, name)):
+            os.remove(os.path.join(wit_path, name))
+    return load_commit_graph(root)
+
+
+def parse_commit_graph(lines):
+    """Build the in-memory commit graph from commit-graph.txt lines."""
+    graph = {'ids': [], 'pos': {}, 'parents': [], 'generation': [],
+             'bloom': []}
+    for line in lines:
+        commit_id, generation, parents, bloom = line.split()
+        graph['bloom'].append(bloom)
+        parents = () if parents == 'None' else parents.split(',')
+        graph['pos'][commit_id] = len(graph['ids'])
+        graph['ids'].append(commit_id)
+        graph['generation'].append(int(generation))
+        graph['parents'].append(
+            tuple(graph['pos'][p] for p in parents if p in graph['pos'])
+        )
+    return graph
+
+
+@traced('commit-graph.read')
+def load_commit_graph(root):
+    """Return the commit graph of the repository.
+
+    The graph is read once and cached by the file's stat data. It is
+    written from scratch if it doesn't exist yet or was written by
+    another format version.
+
+    Args:
+        root (str): Path to the root directory.
+
+    Returns:
+        dict: 'ids' (position: commit_id), 'pos' (commit_id: position),
+          'parents' (position: tuple of parent positions),
+          'generation' (position: generation number) and 'bloom'
+          (position: changed-path Bloom filter).
+    """
+    graph_path = os.path.join(common_dir(root), 'commit-graph.txt')
+    try:
+        stat = os.stat(graph_path)
+    except FileNotFoundError:
+        return write_commit_graph(root)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _commit_graph_cache.get(graph_path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with open(graph_path, 'r') as f:
+        header = f.readline().split()
+        if header[-1:] != [str(COMMIT_GRAPH_VERSION)]:
+            return write_commit_graph(root)
+        graph = parse_commit_graph(f)
+    _commit_graph_cache[graph_path] = (key, graph)
+    return graph
+
+
+def append_commit_graph(root, commit_id):
+    """Append a new commit to commit-graph.txt, if the graph
+       was already written. Its parents are already in it."""
+    graph_path = os.path.join(common_dir(root), 'commit-graph.txt')
+    if os.path.exists(graph_path):
+        graph_position(root, load_commit_graph(root), commit_id)
+
+
+def graph_position(root, graph, commit_id):
+    """Return the position of a commit_id in the commit graph.
+
+    Commits that are missing from commit-graph.txt (e.g. made
+    before it was written) are read from their commit files,
+    together with their unknown ancestors, and appended to it.
+
+    Raises:
+        FileNotFoundError: If the commit doesn't exist.
+    """
+    if commit_id in graph['pos']:
+        return graph['pos'][commit_id]
+    missing = {}
+    stack = [commit_id]
+    while stack:
+        current = stack.pop()
+        if current in missing or current in graph['pos']:
+            continue
+        parents = [p for p in get_commit_data(root, current)['parent']
+                   if p != 'None']
+        missing[current] = parents
+        stack.extend(parents)
+
+    lines = []
+    for current in topological_order(missing):
+        parents = tuple(graph['pos'][p] for p in missing[current])
+        generation = 1 + max(
+            (graph['generation'][p] for p in parents), default=0
+        )
+        graph['pos'][current] = len(graph['ids'])
+        graph['ids'].append(current)
+        graph['parents'].append(parents)
+        graph['generation'].append(generation)
+        bloom = commit_bloom(root, current)
+        graph['bloom'].append(bloom)
+        lines.append(
+            f"{current} {generation} "
+            f"{','.join(missing[current]) or 'None'} {bloom}\n"
+        )
+    graph_path = os.path.join(common_dir(root), 'commit-graph.txt')
+    with open(graph_path, 'a') as f:
+        f.writelines(lines)
+    _commit_graph_cache.pop(graph_path, None)
+    return graph['pos'][commit_id]
+
+
+def int_array(values=()):
+    """Return a flat array of 64-bit ints: a NumPy array if NumPy
+       is installed, an `array.array` otherwise."""
+    if numpy is not None:
+        return numpy.fromiter(values, dtype=numpy.int64)
+    return array.array('q', values)
+
+
+def csr_graph(all_parents):
+    """Build a compact commit graph with integer commit indexes.
+
+    The parents of commit i are parents[offsets[i]:offsets[i + 1]],
+    so the whole topology is two flat int arrays instead of a list
+    per commit.
+
+    Args:
+        all_parents (dict): 'commit_id: parent-commit_ids' dict,
+          like the one `return_all_parents` returns.
+
+    Returns:
+        dict: 'ids' (index: commit_id), 'index' (commit_id: index),
+          'offsets' and 'parents' arrays.
+    """
+    ids = list(all_parents)
+    index = {commit_id: i for i, commit_id in enumerate(ids)}
+    offsets = array.array('q', [0])
+    parents = array.array('q')
+    for commit_id in ids:
+        parents.extend(index[p] for p in all_parents[commit_id] if p in index)
+        offsets.append(len(parents))
+    return {'ids': ids, 'index': index,
+            'offsets': int_array(offsets), 'parents': int_array(parents)}
+
+
+def load_csr_graph(root):
+    """Read commit-graph.txt straight into a CSR commit graph.
+
+    Commit indexes are the commit graph's positions, so parents
+    always come before their children.
+    """
+    graph_path = os.path.join(common_dir(root), 'commit-graph.txt')
+    if not os.path.exists(graph_path):
+        write_commit_graph(root)
+    ids = []
+    index = {}
+    offsets = array.array('q', [0])
+    parents = array.array('q')
+    with open(graph_path, 'r') as f:
+        f.readline()
+        for line in f:
+            commit_id, _, commit_parents, _ = line.split()
+            if commit_parents != 'None':
+                parents.extend(index[p] for p in commit_parents.split(',')
+                               if p in index)
+            index[commit_id] = len(ids)
+            ids.append(commit_id)
+            offsets.append(len(parents))
+    return {'ids': ids, 'index': index,
+            'offsets': int_array(offsets), 'parents': int_array(parents)}
+
+
+def csr_children(csr):
+    """Return the (offsets, children) CSR arrays of the reversed graph."""
+    count = len(csr['ids'])
+    if numpy is not None:
+        offsets = numpy.asarray(csr['offsets'])
+        parents = numpy.asarray(csr['parents'])
+        child_of = numpy.repeat(numpy.arange(count), numpy.diff(offsets))
+        children = child_of[numpy.argsort(parents, kind='stable')]
+        child_offsets = numpy.zeros(count + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(parents, minlength=count),
+                     out=child_offsets[1:])
+        return child_offsets, children
+
+    offsets, parents = csr['offsets'], csr['parents']
+    child_offsets = array.array('q', [0]) * (count + 1)
+    for p in parents:
+        child_offsets[p + 1] += 1
+    for i in range(count):
+        child_offsets[i + 1] += child_offsets[i]
+    children = array.array('q', [0]) * len(parents)
+    fill = child_offsets[:-1]
+    for child in range(count):
+        for p in parents[offsets[child]:offsets[child + 1]]:
+            children[fill[p]] = child
+            fill[p] += 1
+    return child_offsets, children
+
+
+def csr_gather(offsets, values, rows):
+    """Return the values[offsets[row]:offsets[row + 1]] slices of
+       all the rows, concatenated. With NumPy it is one fancy-index
+       over the whole frontier."""
+    if numpy is not None:
+        offsets, values = numpy.asarray(offsets), numpy.asarray(values)
+        starts = offsets[rows]
+        lengths = offsets[rows + 1] - starts
+        shift = numpy.repeat(starts - numpy.cumsum(lengths) + lengths, lengths)
+        return values[shift + numpy.arange(lengths.sum())]
+    gathered = array.array('q')
+    for row in rows:
+        gathered.extend(values[offsets[row]:offsets[row + 1]])
+    return gathered
+
+
+def csr_levels(csr):
+    """Yield the frontiers of Kahn's algorithm, roots first: the
+       commits whose parents are all in earlier frontiers. A commit
+       is in frontier `generation - 1`.
+
+    Each frontier is processed as a whole, with NumPy as a few array
+    operations, so the number of Python steps is the depth of the
+    history rather than its number of commits.
+    """
+    count = len(csr['ids'])
+    child_offsets, children = csr_children(csr)
+    if numpy is not None:
+        pending = numpy.diff(numpy.asarray(csr['offsets']))
+        frontier = numpy.flatnonzero(pending == 0)
+        while frontier.size:
+            yield frontier
+            found = csr_gather(child_offsets, children, frontier)
+            numpy.subtract.at(pending, found, 1)
+            frontier = numpy.unique(found[pending[found] == 0])
+        return
+
+    offsets = csr['offsets']
+    pending = array.array('q', (offsets[i + 1] - offsets[i] for i in range(count)))
+    frontier = array.array('q', (i for i in range(count) if not pending[i]))
+    while frontier:
+        yield frontier
+        next_frontier = array.array('q')
+        for child in csr_gather(child_offsets, children, frontier):
+            pending[child] -= 1
+            if not pending[child]:
+                next_frontier.append(child)
+        frontier = next_frontier
+
+
+@traced('csr.topo')
+def csr_topological_order(csr):
+    """Return the commit indexes ordered parents first, frontier
+       by frontier (see `csr_levels`)."""
+    if numpy is not None:
+        return numpy.concatenate(
+            [numpy.zeros(0, dtype=numpy.int64), *csr_levels(csr)])
+    order = array.array('q')
+    for frontier in csr_levels(csr):
+        order.extend(frontier)
+    return order
+
+
+@traced('csr.generations')
+def csr_generations(csr):
+    """Return the generation number of every commit index:
+       1 for a root commit, otherwise one more than its highest
+       parent, i.e. one more than its frontier's number."""
+    generations = int_array([0] * len(csr['ids']))
+    for generation, frontier in enumerate(csr_levels(csr), 1):
+        if numpy is not None:
+            generations[frontier] = generation
+        else:
+            for current in frontier:
+                generations[current] = generation
+    return generations
+
+
+@traced('csr.reachable')
+def csr_reachable_count(csr, starts):
+    """Return how many commits are reachable from the commit indexes
+       in `starts`, themselves included.
+
+    The walk expands a whole frontier at a time: its parents are
+    gathered over the offset slices and the ones not seen yet form
+    the next frontier.
+    """
+    offsets, parents = csr['offsets'], csr['parents']
+    if numpy is not None:
+        seen = numpy.zeros(len(csr['ids']), dtype=bool)
+        frontier = numpy.unique(numpy.asarray(list(starts), dtype=numpy.int64))
+        seen[frontier] = True
+        while frontier.size:
+            found = csr_gather(offsets, parents, frontier)
+            frontier = numpy.unique(found[~seen[found]])
+            seen[frontier] = True
+        return int(seen.sum())
+
+    seen = bytearray(len(csr['ids']))
+    frontier = set(starts)
+    for current in frontier:
+        seen[current] = 1
+    count = len(frontier)
+    while frontier:
+        found = {p for p in csr_gather(offsets, parents, frontier) if not seen[p]}
+        for current in found:
+            seen[current] = 1
+        count += len(found)
+        frontier = found
+    return count
+
+
+@traced('topology')
+def topology_stats():
+    """Summarize the whole history, over the CSR commit graph.
+
+    HEAD is looked up in the CSR graph's own index, so the dict
+    commit graph is never loaded.
+
+    Returns:
+        dict: The number of 'commits', of 'roots' (no parent) and
+          'merges' (several parents), the 'max_generation' and the
+          number of commits 'reachable' from HEAD.
+    """
+    root = is_wit_exists(os.getcwd())
+    head = get_ref(root)['HEAD']
+    csr = load_csr_graph(root)
+    if head not in csr['index']:
+        # Written by a command that didn't append to the graph.
+        write_commit_graph(root)
+        csr = load_csr_graph(root)
+    offsets = csr['offsets']
+    generations = csr_generations(csr)
+    if numpy is not None:
+        parent_counts = numpy.diff(numpy.asarray(offsets))
+        roots, merges = int((parent_counts == 0).sum()), int((parent_counts > 1).sum())
+        max_generation = int(generations.max(initial=0))
+    else:
+        parent_counts = [offsets[i + 1] - offsets[i] for i in range(len(csr['ids']))]
+        roots, merges = parent_counts.count(0), sum(count > 1 for count in parent_counts)
+        max_generation = max(generations, default=0)
+    return {
+        'commits': len(csr['ids']),
+        'roots': roots,
+        'merges': merges,
+        'max_generation': max_generation,
+        'reachable': csr_reachable_count(csr, [csr['index'][head]]),
+    }
+
+
+def encode_bitmap(bits):
+    """Run-length encode a bitmap.
+
+    Reachability bitmaps over a topological order are long runs of
+    set and cleared bits, so they are stored as the lengths of
+    alternating runs (cleared bits first), hex encoded.
+
+    Args:
+        bits (int): The bitmap, bit n stands for position n.
+
+    Returns:
+        str: Dot-separated run lengths.
+    """
+    runs = []
+    while bits:
+        zeros = (bits & -bits).bit_length() - 1
+        bits >>= zeros
+        ones = (bits ^ (bits + 1)).bit_length() - 1
+        bits >>= ones
+        runs.extend((zeros, ones))
+    return '.'.join(f'{run:x}' for run in runs) or '0'
+
+
+def decode_bitmap(encoded):
+    """Inverse of `encode_bitmap`."""
+    bits = 0
+    offset = 0
+    runs = [int(run, 16) for run in encoded.split('.')]
+    for i in range(0, len(runs) - 1, 2):
+        offset += runs[i]
+        bits |= ((1 << runs[i + 1]) - 1) << offset
+        offset += runs[i + 1]
+    return bits
+
+
+class EncodedBitmaps(dict):
+    """'position: encoded bitmap' dict whose items read back decoded.
+
+    A bitmap is decoded the first time it is looked up and the int
+    is kept, so a walk only pays for the bitmaps it reaches.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.decoded = {}
+
+    def __getitem__(self, pos):
+        bits = self.decoded.get(pos)
+        if bits is None:
+            bits = self.decoded[pos] = decode_bitmap(super().__getitem__(pos))
+        return bits
+
+
+def load_bitmaps(root):
+    """Return the stored 'position: reachability bitmap' dict.
+
+    The encoded bitmaps are read once and cached by the file's stat
+    data; each one is decoded when it is first used (see
+    `EncodedBitmaps`).
+    """
+    bitmaps_path = os.path.join(common_dir(root), 'bitmaps.txt')
+    try:
+        stat = os.stat(bitmaps_path)
+    except FileNotFoundError:
+        return {}
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _bitmaps_cache.get(bitmaps_path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    graph = load_commit_graph(root)
+    bitmaps = EncodedBitmaps()
+    with open(bitmaps_path, 'r') as f:
+        for line in f:
+            commit_id, encoded = line.split()
+            if commit_id in graph['pos']:
+                bitmaps[graph['pos'][commit_id]] = encoded
+    _bitmaps_cache[bitmaps_path] = (key, bitmaps)
+    return bitmaps
+
+
+def reachable_bitmap(graph, bitmaps, start):
+    """Return a bitmap of all the commits reachable from `start`.
+
+    The walk stops at every commit that has a stored bitmap and ORs
+    it in, so only the commits between `start` and the closest
+    bitmapped commits are visited.
+
+    Args:
+        graph (dict): The commit graph.
+        bitmaps (dict): 'position: bitmap' dict.
+        start (int): Position of the start commit.
+
+    Returns:
+        int: The bitmap, the start commit included.
+    """
+    bits = 0
+    stack = [start]
+    while stack:
+        pos = stack.pop()
+        if bits >> pos & 1:
+            continue
+        if pos in bitmaps:
+            bits |= bitmaps[pos]
+            continue
+        bits |= 1 << pos
+        stack.extend(graph['parents'][pos])
+    return bits
+
+
+def write_bitmaps(root, every=BITMAP_EVERY):
+    """Store reachability bitmaps for selected commits in bitmaps.txt.
+
+    The branch tips and every `every`-th commit of the commit
+    graph get a bitmap. Bitmaps are built in topological order so
+    each one reuses the ones written before it.
+
+    Args:
+        root (str): Path to the root directory.
+        every (int): Distance between bitmapped commits.
+
+    Returns:
+        int: Number of bitmaps written.
+    """
+    graph = write_commit_graph(root)
+    selected = set(range(every - 1, len(graph['ids']), every))
+    for commit_id in get_ref_index(root):
+        if commit_id in graph['pos']:
+            selected.add(graph['pos'][commit_id])
+
+    bitmaps = {}
+    lines = []
+    for pos in sorted(selected):
+        bitmaps[pos] = reachable_bitmap(graph, bitmaps, pos)
+        lines.append(f"{graph['ids'][pos]} {encode_bitmap(bitmaps[pos])}\n")
+    with open(os.path.join(common_dir(root), 'bitmaps.txt'), 'w') as f:
+        f.writelines(lines)
+    return len(lines)
+
+
+COMMIT_ID_INDEX_MAGIC = b'WITCIDX\x01'
+COMMIT_ID_INDEX_HEADER = struct.Struct('>QQ')
+COMMIT_ID_INDEX_MAX_TAIL = 1000
+MIN_ABBREV = 6
+
+
+class AmbiguousCommitError(Exception):
+    pass
+
+
+def write_commit_id_index(root):
+    """Write commit-ids.idx: the commit graph's commit_ids, sorted.
+
+    The header holds the number of ids and the size of
+    commit-graph.txt they cover; commits appended to the graph
+    after that are looked up in its tail until the index is
+    rewritten.
+    """
+    graph = load_commit_graph(root)
+    wit_path = common_dir(root)
+    covered = os.path.getsize(os.path.join(wit_path, 'commit-graph.txt'))
+    ids = sorted(bytes.fromhex(commit_id) for commit_id in graph['ids'])
+    index_path = os.path.join(wit_path, 'commit-ids.idx')
+    tmp_path = f'{index_path}.lock'
+    with open(tmp_path, 'wb') as f:
+        f.write(COMMIT_ID_INDEX_MAGIC)
+        f.write(COMMIT_ID_INDEX_HEADER.pack(len(ids), covered))
+        f.writelines(ids)
+    os.replace(tmp_path, index_path)
+
+
+def read_commit_id_index(index_path, graph_path):
+    """Return the number of ids in commit-ids.idx and the commit_ids
+       appended to commit-graph.txt after it, or None if the index
+       is missing, stale or its tail grew too long."""
+    header_size = len(COMMIT_ID_INDEX_MAGIC) + COMMIT_ID_INDEX_HEADER.size
+    try:
+        with open(index_path, 'rb') as f:
+            header = f.read(header_size)
+    except FileNotFoundError:
+        return None
+    if not header.startswith(COMMIT_ID_INDEX_MAGIC):
+        return None
+    count, covered = COMMIT_ID_INDEX_HEADER.unpack_from(
+        header, len(COMMIT_ID_INDEX_MAGIC))
+    if covered > os.path.getsize(graph_path):
+        return None
+    with open(graph_path, 'r') as f:
+        f.seek(covered)
+        tail = [line.split(' ', 1)[0] for line in f]
+    if len(tail) > COMMIT_ID_INDEX_MAX_TAIL:
+        return None
+    return count, tail
+
+
+@traced('commit-ids.read')
+def load_commit_id_index(root):
+    """Return the path of commit-ids.idx, its number of ids and the
+       commit_ids appended to the commit graph since it was written.
+
+    The index is rewritten if it is missing, was written for
+    another commit graph, or its tail grew too long.
+    """
+    wit_path = common_dir(root)
+    index_path = os.path.join(wit_path, 'commit-ids.idx')
+    graph_path = os.path.join(wit_path, 'commit-graph.txt')
+    if not os.path.exists(graph_path):
+        load_commit_graph(root)
+    loaded = read_commit_id_index(index_path, graph_path)
+    if loaded is None:
+        write_commit_id_index(root)
+        loaded = read_commit_id_index(index_path, graph_path)
+    return (index_path, *loaded)
+
+
+def open_commit_id_index(root):
+    """Return a mapping of commit-ids.idx, its number of ids and the
+       commit_ids appended to the commit graph after it, for
+       `expand_commit_id` and `abbreviate`. A command doing many
+       lookups opens it once."""
+    index_path, count, tail = load_commit_id_index(root)
+    return map_id_index(index_path, count), count, tail
+
+
+def id_index_lower_bound(index, count, digest):
+    """Return the position of the first id in a mapped
+       commit-ids.idx that isn't below `digest`."""
+    header_size = len(COMMIT_ID_INDEX_MAGIC) + COMMIT_ID_INDEX_HEADER.size
+    low, high = 0, count
+    while low < high:
+        middle = (low + high) // 2
+        start = header_size + middle * 20
+        if index[start:start + 20] < digest:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def id_index_at(index, position):
+    start = len(COMMIT_ID_INDEX_MAGIC) + COMMIT_ID_INDEX_HEADER.size + position * 20
+    return index[start:start + 20].hex()
+
+
+def map_id_index(index_path, count):
+    """Return a read-only mapping of commit-ids.idx, or b''
+       if it holds no ids (an empty file can't be mapped)."""
+    if not count:
+        return b''
+    with open(index_path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@traced('commit-ids.lookup')
+def expand_commit_id(root, prefix, id_index=None):
+    """Return the commit_id that starts with a hex prefix.
+
+    The sorted ID index is binary searched, so the lookup is
+    O(log n); every commit is in the commit graph the index is
+    built from, so nothing else is searched.
+
+    Args:
+        id_index (tuple): Default to None (open it). See
+          `open_commit_id_index`.
+
+    Returns:
+        str: The commit_id, or None if no commit matches.
+
+    Raises:
+        AmbiguousCommitError: If several commits match.
+    """
+    index, count, tail = id_index or open_commit_id_index(root)
+    matches = {commit_id for commit_id in tail if commit_id.startswith(prefix)}
+    position = id_index_lower_bound(
+        index, count, bytes.fromhex(prefix.ljust(40, '0')))
+    while position < count and len(matches) < 2:
+        commit_id = id_index_at(index, position)
+        if not commit_id.startswith(prefix):
+            break
+        matches.add(commit_id)
+        position += 1
+    if len(matches) > 1:
+        raise AmbiguousCommitError(f"short commit_id '{prefix}' is ambiguous")
+    return matches.pop() if matches else None
+
+
+def abbreviate(root, commit_id, minimum=MIN_ABBREV, id_index=None):
+    """Return the shortest prefix (at least `minimum` long) that
+       only `commit_id` starts with. Only the commit's neighbours
+       in the sorted ID index (see `open_commit_id_index`) are
+       compared."""
+    index, count, tail = id_index or open_commit_id_index(root)
+    position = id_index_lower_bound(index, count, bytes.fromhex(commit_id))
+    neighbours = tail + [id_index_at(index, p)
+                         for p in (position - 1, position, position + 1)
+                         if 0 <= p < count]
+    length = minimum
+    for other in neighbours:
+        if other != commit_id:
+            common = len(os.path.commonprefix([commit_id, other]))
+            length = max(length, common + 1)
+    return commit_id[:length]
+
+
+class BadRevisionError(Exception):
+    pass
+
+
+REVISION_SUFFIX = re.compile(r'((?:[~^][0-9]*)*)$')
+
+
+def resolve_name(root, identifier):
+    """Return the commit_id of a branch name, commit_id or
+       unique commit_id prefix (at least 4 characters)."""
+    references = get_ref(root)
+    if identifier in references:
+        return references[identifier]
+    if 4 <= len(identifier) < 40 and all(c in '0123456789abcdef' for c in identifier):
+        return expand_commit_id(root, identifier) or identifier
+    return identifier
+
+
+def resolve(root, identifier):
+    """Return the commit_id a revision names.
+
+    A revision is a branch name, commit_id or commit_id prefix,
+    followed by any number of '~<n>' (the n-th first-parent
+    ancestor) and '^<n>' (the n-th parent, '^0' is the commit
+    itself) operators; n defaults to 1. The operators walk the
+    commit graph, so no commit files are read for commits that
+    are already in it.
+
+    Raises:
+        BadRevisionError: If a commit has no such parent.
+    """
+    suffix = REVISION_SUFFIX.search(identifier).group(1)
+    if not suffix or identifier in get_ref(root):
+        return resolve_name(root, identifier)
+    base = identifier[:-len(suffix)]
+    commit_id = resolve_name(root, base or 'HEAD')
+    graph = load_commit_graph(root)
+    pos = graph_position(root, graph, commit_id)
+    for operator, number in re.findall(r'([~^])([0-9]*)', suffix):
+        number = int(number or 1)
+        if operator == '~':
+            for _ in range(number):
+                if not graph['parents'][pos]:
+                    raise BadRevisionError(f"'{identifier}': {graph['ids'][pos]} has no parent")
+                pos = graph['parents'][pos][0]
+        elif number:
+            if len(graph['parents'][pos]) < number:
+                raise BadRevisionError(f"'{identifier}': {graph['ids'][pos]} has no parent {number}")
+            pos = graph['parents'][pos][number - 1]
+    return graph['ids'][pos]
+
+
+def reachable(root, identifier):
+    """Return the reachability bitmap of a branch or commit_id,
+       together with the commit graph its bits refer to."""
+    graph = load_commit_graph(root)
+    pos = graph_position(root, graph, resolve(root, identifier))
+    return reachable_bitmap(graph, load_bitmaps(root), pos), graph
+
+
+def is_ancestor(ancestor, descendant, root=None):
+    """Check if `ancestor` is reachable from `descendant`.
+
+    Args:
+        ancestor (str): Branch name or commit_id.
+        descendant (str): Branch name or commit_id.
+        root (str): Default to the repository of the cwd.
+
+    Returns:
+        bool: True if `ancestor` is `descendant` or one of its
+          parent-commits.
+    """
+    root = root or is_wit_exists(os.getcwd())
+    graph = load_commit_graph(root)
+    ancestor_pos = graph_position(root, graph, resolve(root, ancestor))
+    descendant_pos = graph_position(root, graph, resolve(root, descendant))
+    if ancestor_pos > descendant_pos:  # Parents always come first.
+        return False
+    bits = reachable_bitmap(graph, load_bitmaps(root), descendant_pos)
+    return bool(bits >> ancestor_pos & 1)
+
+
+def range_bitmap(root, spec):
+    """Return the bitmap of the commits a revision range names,
+       together with the commit graph its bits refer to.
+
+    Args:
+        root (str): Path to the root directory.
+        spec (str): A revision (see `resolve`) for the commits
+          reachable from it, 'A..B' for the commits reachable from B
+          and not from A, or 'A...B' for the commits reachable from
+          either but not both. An empty side means HEAD.
+    """
+    if '...' in spec:
+        left, _, right = spec.partition('...')
+        left_bits, graph = reachable(root, left or 'HEAD')
+        right_bits = reachable(root, right or 'HEAD')[0]
+        return left_bits ^ right_bits, graph
+    if '..' in spec:
+        exclude, _, include = spec.partition('..')
+        bits, graph = reachable(root, include or 'HEAD')
+        return bits & ~reachable(root, exclude or 'HEAD')[0], graph
+    return reachable(root, spec)
+
+
+def rev_list(spec):
+    """List the commits of a revision range.
+
+    Args:
+        spec (str): A revision or a range, see `range_bitmap`.
+
+    Returns:
+        list: The commit_ids, newest (highest position) first.
+    """
+    root = is_wit_exists(os.getcwd())
+    bits, graph = range_bitmap(root, spec)
+    return [graph['ids'][pos]
+            for pos in range(bits.bit_length() - 1, -1, -1)
+            if bits >> pos & 1]
+
+
+def count_commits(spec):
+    """Return the number of commits `rev_list` lists for `spec`,
+       without materializing them."""
+    root = is_wit_exists(os.getcwd())
+    return bin(range_bitmap(root, spec)[0]).count('1')
+
+
+def rev_parse(root, revision):
+    """Return the commit_id of a revision, checking that it exists.
+
+    Raises:
+        BadRevisionError: If the revision names no commit.
+    """
+    try:
+        commit_id = resolve(root, revision)
+    except (FileNotFoundError, KeyError) as err:
+        raise BadRevisionError(f"'{revision}': unknown revision") from err
+    if not has_commit(root, commit_id):
+        raise BadRevisionError(f"'{revision}': unknown revision")
+    return commit_id
+
+
+HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def lookup_object(root, name):
+    """Return the type, id and data of what a 'cat-file' name names.
+
+    A name is a revision (the commit, as its raw record), a
+    '<revision>:<path>' (the blob or tree at the path, the commit's
+    tree for an empty path) or a full object sha.
+
+    Raises:
+        BadRevisionError: If the revision or path doesn't exist.
+        FileNotFoundError: If an object doesn't exist.
+    """
+    revision, colon, relpath = name.partition(':')
+    if not colon:
+        if len(name) == 40 and set(name) <= HEX_DIGITS and has_object(root, name):
+            obj_type, data = read_object(root, name)
+            return obj_type, name, data
+        commit_id = rev_parse(root, name)
+        return 'commit', commit_id, read_commit_record(root, commit_id)
+    commit_id = rev_parse(root, revision)
+    obj_type, sha = 'tree', get_commit_data(root, commit_id).get('tree')
+    if sha is None:
+        obj_type, sha = 'blob', commit_entries(root, commit_id).get(relpath)
+    else:
+        for part in filter(None, relpath.strip('/').split('/')):
+            if obj_type != 'tree':
+                sha = None
+                break
+            obj_type, sha = tree_listing(root, sha).get(part, (None, None))
+            if obj_type is None:
+                break
+    if sha is None:
+        raise BadRevisionError(f"'{relpath}' doesn't exist in {commit_id}")
+    return obj_type, sha, read_object(root, sha)[1]
+
+
+def cat_file_batch(names, output, contents=True, flush=True):
+    """Answer 'cat-file' queries, one name (see `lookup_object`) per line.
+
+    Every answer is a '<id> <type> <size>' line followed, with
+    `contents`, by the data and a newline; a name that can't be
+    found is answered with '<name> missing'. The repository is
+    discovered once and its store, journal and caches stay open
+    across the queries, so a single process can answer any number.
+
+    Args:
+        names (iterable): Lines to answer, e.g. sys.stdin.
+        output (file): A binary stream, e.g. sys.stdout.buffer.
+        contents (bool): Default to True. False writes headers only.
+        flush (bool): Default to True. Flush after every answer, so
+          a caller can wait for one before sending the next.
+    """
+    root = is_wit_exists(os.getcwd())
+    for line in names:
+        name = line.strip()
+        if not name:
+            continue
+        try:
+            obj_type, obj_id, data = lookup_object(root, name)
+        except AmbiguousCommitError:
+            output.write(f'{name} ambiguous\n'.encode())
+        except (BadRevisionError, FileNotFoundError, ValueError):
+            output.write(f'{name} missing\n'.encode())
+        else:
+            output.write(f'{obj_id} {obj_type} {len(data)}\n'.encode())
+            if contents:
+                output.write(data + b'\n')
+        if flush:
+            output.flush()
+
+
+def rev_parse_batch(revisions, output, flush=True):
+    """Write the commit_id of every revision line, or
+       '<revision> missing', like `cat_file_batch` does."""
+    root = is_wit_exists(os.getcwd())
+    for line in revisions:
+        revision = line.strip()
+        if not revision:
+            continue
+        try:
+            output.write(f'{rev_parse(root, revision)}\n')
+        except AmbiguousCommitError:
+            output.write(f'{revision} ambiguous\n')
+        except (BadRevisionError, ValueError):
+            output.write(f'{revision} missing\n')
+        if flush:
+            output.flush()
+
+
+PARENT1, PARENT2, STALE, RESULT = 1, 2, 4, 8
+
+
+def paint_down_to_common(graph, one, twos):
+    """Find the common ancestors of `one` and all of `twos`.
+
+    Walks from all the commits at once, highest generation first,
+    painting every commit with the sides it is reachable from. A
+    commit painted from both sides is a result, and everything below
+    it is marked stale. The walk ends when only stale commits are
+    left, so commits far below the merge base are never visited.
+
+    Args:
+        graph (dict): The commit graph.
+        one (int): Position of the first commit.
+        twos (list): Positions of the other commits.
+
+    Returns:
+        list: Positions of the common ancestors found, some of them
+          may be ancestors of others.
+    """
+    flags = {one: PARENT1}
+    queue = [(-graph['generation'][one], -one)]
+    for two in twos:
+        flags[two] = flags.get(two, 0) | PARENT2
+        heapq.heappush(queue, (-graph['generation'][two], -two))
+
+    results = []
+    while any(not flags[-pos] & STALE for _, pos in queue):
+        pos = -heapq.heappop(queue)[1]
+        pos_flags = flags[pos] & (PARENT1 | PARENT2 | STALE)
+        if pos_flags == PARENT1 | PARENT2:
+            if not flags[pos] & RESULT:
+                flags[pos] |= RESULT
+                results.append(pos)
+            pos_flags |= STALE
+        for p in graph['parents'][pos]:
+            if flags.get(p, 0) & pos_flags == pos_flags:
+                continue
+            flags[p] = flags.get(p, 0) | pos_flags
+            heapq.heappush(queue, (-graph['generation'][p], -p))
+    return [pos for pos in results if not flags[pos] & STALE]
+
+
+def remove_redundant(graph, candidates):
+    """Drop the candidates that are ancestors of other candidates.
+
+    The walks don't go below the lowest candidate generation, since
+    no candidate can be found there.
+    """
+    min_generation = min(graph['generation'][pos] for pos in candidates)
+    redundant = set()
+    for pos in candidates:
+        if pos in redundant:
+            continue
+        stack = list(graph['parents'][pos])
+        seen = set()
+        while stack:
+            current = stack.pop()
+            if current in seen or graph['generation'][current] < min_generation:
+                continue
+            seen.add(current)
+            if current in candidates:
+                redundant.add(current)
+            stack.extend(graph['parents'][current])
+    return [pos for pos in candidates if pos not in redundant]
+
+
+def merge_base(*identifiers, all_bases=False):
+    """Find the best common ancestors of the given commits.
+
+    With more than two commits, the result is the merge base of the
+    first one and a hypothetical merge of all the others.
+
+    Args:
+        identifiers (str): Two or more branch names or commit_ids.
+        all_bases (bool): Default to False. If True, return all the
+          best common ancestors (there are several after criss-cross
+          merges), not only the first one.
+
+    Returns:
+        list: The commit_ids of the merge bases. Empty if the commits
+          have no common ancestor.
+    """
+    root = is_wit_exists(os.getcwd())
+    graph = load_commit_graph(root)
+    one, *twos = [graph_position(root, graph, resolve(root, identifier))
+                  for identifier in identifiers]
+    if one in twos:
+        return [graph['ids'][one]]
+    bases = paint_down_to_common(graph, one, twos)
+    if len(bases) > 1:
+        bases = remove_redundant(graph, bases)
+    bases.sort(key=lambda pos: -graph['generation'][pos])
+    if not all_bases:
+        bases = bases[:1]
+    return [graph['ids'][pos] for pos in bases]
+
+
+@traced('graph')
+def graph():
+    """Create a flow chart of the commit directories tree.
+
+    Args:
+        None
+
+    Returns:
+        Digraph: A styled graph object of the dirs tree.
+    """
+    root = is_wit_exists(os.getcwd())
+
+    commit_graph = Digraph(
+        'commit_graph', filename='commit_id_tree', format='png'
+    )
+    commit_graph.attr(rankdir='RL')
+    commit_graph.attr(
+        'node', style='filled', fillcolor="cornflowerblue", shape='circle'
+    )
+    commit_graph.attr('edge', style='filled', fillcolor="cornflowerblue")
+
+    head = get_ref(root)['HEAD']
+    refs_index = get_ref_index(root)
+    abbrev = functools.partial(
+        abbreviate, root, id_index=open_commit_id_index(root))
+    commit_graph.edge('HEAD', abbrev(head))
+
+    parents = return_parents(root, head)
+    commit_ids = set(parents) | {p for ps in parents.values() for p in ps}
+    commit_ids.add(head)
+    for comm_id in commit_ids:
+        for name in refs_index.get(comm_id, ()):
+            commit_graph.edge(name, abbrev(comm_id))
+
+    for comm_id, comm_parents in parents.items():
+        for p in comm_parents:
+            commit_graph.edge(abbrev(comm_id), abbrev(p))
+    return commit_graph
+
+
+@traced('log')
+def log(path=None):
+    """Return the history of HEAD, newest commit first.
+
+    Every commit is decorated with the branches that point at it.
+    With a path, only the commits that changed it relative to their
+    first parent are returned: the commit graph's Bloom filters rule
+    out most commits, and only the rest are tree-diffed.
+
+    Args:
+        path (str): Default to None. A file or directory path.
+
+    Returns:
+        list: Dictionaries with the 'commit', 'refs', 'parent',
+          'date' and 'message' of each commit.
+    """
+    root = is_wit_exists(os.getcwd())
+    head = get_ref(root)['HEAD']
+    refs_index = get_ref_index(root)
+    if path is not None:
+        relpath = to_relpath(os.path.abspath(path), root)
+        graph = load_commit_graph(root)
+    history = []
+    seen = {head}
+    queue = [head]
+    while queue:
+        commit_id = queue.pop(0)
+        commit_data = get_commit_data(root, commit_id)
+        for p in commit_data['parent']:
+            if p != 'None' and p not in seen:
+                seen.add(p)
+                queue.append(p)
+        if path is not None and not (
+                maybe_changed(graph, graph_position(root, graph, commit_id), relpath)
+                and path_changed(root, commit_id, relpath)):
+            continue
+        refs = list(refs_index.get(commit_id, ()))
+        if commit_id == head:
+            refs.insert(0, 'HEAD')
+        history.append({'commit': commit_id, 'refs': refs, **commit_data})
+    return history
+
+
+@functools.lru_cache(maxsize=COMMIT_CACHE_SIZE)
+def tree_listing(root, sha):
+    """Return the 'name: (type, sha)' dict of one stored tree.
+
+    Trees never change, so unchanged subtrees shared by many
+    commits are read only once.
+    """
+    listing = {}
+    for line in read_object(root, sha)[1].decode().splitlines():
+        obj_type, obj_sha, name = line.split(' ', 2)
+        listing[name] = (obj_type, obj_sha)
+    return listing
+
+
+def path_sha(root, commit_id, relpath):
+    """Return the blob sha of `relpath` in a commit, or None.
+
+    Only the trees along the path are read.
+    """
+    tree = get_commit_data(root, commit_id).get('tree', commit_id)
+    if not has_object(root, tree):
+        return commit_entries(root, commit_id).get(relpath)
+    sha = tree
+    for name in relpath.split('/'):
+        obj_type, sha = tree_listing(root, sha).get(name, (None, None))
+        if obj_type is None:
+            return None
+    return sha if obj_type == 'blob' else None
+
+
+def blob_lines(root, sha):
+    return read_object(root, sha)[1].decode(errors='replace').splitlines()
+
+
+@functools.lru_cache(maxsize=COMMIT_CACHE_SIZE)
+def matching_lines(root, old_sha, new_sha):
+    """Return a 'new line index: old line index' dict of the lines
+       two blobs have in common."""
+    matcher = difflib.SequenceMatcher(
+        None, blob_lines(root, old_sha), blob_lines(root, new_sha),
+        autojunk=False)
+    return {
+        new + i: old + i
+        for old, new, size in matcher.get_matching_blocks()
+        for i in range(size)
+    }
+
+
+@functools.lru_cache(maxsize=COMMIT_CACHE_SIZE)
+@traced('blame.walk')
+def blame_blob(root, relpath, commit_id, sha):
+    """Return the commit_id that introduced each line of a blob.
+
+    History is walked backwards from commit_id. Commits where the
+    path's blob didn't change are stepped over without a diff (most
+    of them by a test of their changed-path Bloom filter), and
+    the walk stops once every line is attributed. At a merge, the
+    parent with the same blob is followed if there is one.
+
+    Args:
+        root (str): Path to the root directory.
+        relpath (str): The file's path relative to the root.
+        commit_id (str): The commit to start from.
+        sha (str): The file's blob sha in that commit.
+
+    Returns:
+        tuple: One commit_id per line of the blob.
+    """
+    origins = [None] * len(blob_lines(root, sha))
+    pending = {i: i for i in range(len(origins))}
+    graph = load_commit_graph(root)
+    diffs = skipped = 0
+    while pending:
+        parents = [p for p in get_commit_data(root, commit_id)['parent']
+                   if p != 'None']
+        if parents and not maybe_changed(
+                graph, graph_position(root, graph, commit_id), relpath):
+            skipped += 1
+            commit_id = parents[0]
+            continue
+        parent, parent_sha = None, None
+        for p in parents:
+            p_sha = path_sha(root, p, relpath)
+            if p_sha == sha:
+                parent, parent_sha = p, p_sha
+                break
+            if parent is None and p_sha is not None:
+                parent, parent_sha = p, p_sha
+        if parent is None:
+            for line_no in pending.values():
+                origins[line_no] = commit_id
+            break
+        if parent_sha != sha:
+            matches = matching_lines(root, parent_sha, sha)
+            diffs += 1
+            for i, line_no in list(pending.items()):
+                if i not in matches:
+                    origins[line_no] = commit_id
+            pending = {matches[i]: line_no
+                       for i, line_no in pending.items() if i in matches}
+        commit_id, sha = parent, parent_sha
+    trace_add(diffs=diffs, skipped=skipped)
+    return tuple(origins)
+
+
+@traced('blame')
+def blame(path):
+    """Return the commit that last changed each line of a file at HEAD.
+
+    Args:
+        path (str): Path to a file committed in HEAD.
+
+    Returns:
+        list: (commit_id, author, date, line) tuples.
+
+    Raises:
+        FileNotFoundError: If the file isn't in HEAD.
+    """
+    root = is_wit_exists(os.getcwd())
+    relpath = to_relpath(os.path.abspath(path), root)
+    head = get_ref(root)['HEAD']
+    sha = path_sha(root, head, relpath)
+    if sha is None:
+        raise FileNotFoundError(f"no such path '{relpath}' in HEAD")
+    result = []
+    for commit_id, line in zip(blame_blob(root, relpath, head, sha),
+                               blob_lines(root, sha)):
+        commit_data = get_commit_data(root, commit_id)
+        result.append((commit_id, commit_data.get('author', ''),
+                       commit_data['date'], line))
+    return result
+
+
+def branch(name):
+    """Add the given branch name to references.txt"""
+    root = is_wit_exists(os.getcwd())
+    references = get_ref(root)
+    references[name] = references['HEAD']
+    write_refs(root, references)
+
+
+GC_GRACE_PERIOD = 14 * 24 * 60 * 60
+
+
+def ref_tips(root):
+    """Return the commit_ids every branch, every worktree's
+       HEAD and every stash entry point at."""
+    tips = {commit_id for worktree in list_worktrees(root)
+            for commit_id in get_ref(worktree).values()}
+    tips.update(commit_id for commit_id, _ in read_stash(root))
+    return tips
+
+
+def mark_commits(root):
+    """Return the commit graph and a bitmap of the commits
+       reachable from any reference."""
+    graph = load_commit_graph(root)
+    bitmaps = load_bitmaps(root)
+    bits = 0
+    for commit_id in ref_tips(root):
+        bits |= reachable_bitmap(
+            graph, bitmaps, graph_position(root, graph, commit_id))
+    return graph, bits
+
+
+class ObjectMarks:
+    """The objects `gc` keeps, as a bitmap per pack over its index
+       entries, so marking a packed object costs one bit.
+
+    The pack indexes are mapped while the marks are in use (see
+    `close`). Only objects outside the packs (loose ones, which gc
+    packs, those of alternates and of stores other than the
+    filesystem) are kept in a set of 20-byte digests.
+    """
+
+    def __init__(self, root):
+        self.packs = {}
+        self.unpacked = set()
+        if isinstance(open_store(common_dir(root)), FileStore):
+            for index_path, _ in list_packs(os.path.join(common_dir(root), 'objects')):
+                with open(index_path, 'rb') as f:
+                    index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                count = struct.unpack_from('>Q', index, len(PACK_INDEX_MAGIC))[0]
+                self.packs[index_path] = (index, bytearray(-(-count // 8)))
+
+    def add(self, digest):
+        found = False
+        for index, bits in self.packs.values():
+            position = pack_index_position(index, digest)
+            if position is not None:
+                bits[position >> 3] |= 1 << (position & 7)
+                found = True
+        if not found:
+            self.unpacked.add(digest)
+
+    def __contains__(self, digest):
+        return digest in self.unpacked or any(
+            self.has_entry(index_path, self.position(index_path, digest))
+            for index_path in self.packs)
+
+    def has_entry(self, index_path, position):
+        """Return True if entry `position` of a pack index is marked."""
+        if position is None:
+            return False
+        return bool(self.packs[index_path][1][position >> 3] >> (position & 7) & 1)
+
+    def position(self, index_path, digest):
+        """Return the entry number of an object in a pack, or None."""
+        return pack_index_position(self.packs[index_path][0], digest)
+
+    def close(self):
+        for index, _ in self.packs.values():
+            index.close()
+        self.packs.clear()
+
+
+def mark_objects(root, commit_ids):
+    """Return the ObjectMarks of every object reachable from the
+       given commits and the worktrees' indexes.
+
+    Every tree is read at most once, however many commits share it.
+    """
+    marked = ObjectMarks(root)
+    for worktree in list_worktrees(root):
+        for sha, _, _ in read_index(worktree).values():
+            marked.add(bytes.fromhex(sha))
+    stack = []
+    for commit_id in commit_ids:
+        tree = get_commit_data(root, commit_id).get('tree', commit_id)
+        if tree != commit_id:
+            stack.append(tree)
+    while stack:
+        tree = stack.pop()
+        digest = bytes.fromhex(tree)
+        if digest in marked or not has_object(root, tree):
+            continue
+        marked.add(digest)
+        for line in read_object(root, tree)[1].decode().splitlines():
+            obj_type, sha, _ = line.split(' ', 2)
+            if obj_type == 'tree':
+                stack.append(sha)
+            else:
+                marked.add(bytes.fromhex(sha))
+    return marked
+
+
+def remove_path(path):
+    """Delete a file or a directory tree and return the bytes freed."""
+    if os.path.isdir(path):
+        freed = sum(os.path.getsize(f) for f in dir_files(path))
+        shutil.rmtree(path)
+        return freed
+    freed = os.path.getsize(path)
+    os.remove(path)
+    return freed
+
+
+def repack_objects(root, marked, cutoff, report):
+    """Delete the unmarked loose and packed objects older than
+       `cutoff` and pack the rest, for `gc`."""
+    objects_path = os.path.join(common_dir(root), 'objects')
+    pack_dir = os.path.join(objects_path, 'pack')
+    loose = []
+    for fanout in sorted(os.listdir(objects_path)):
+        fanout_path = os.path.join(objects_path, fanout)
+        if fanout == 'pack' or not os.path.isdir(fanout_path):
+            if fanout.startswith('tmp_') and os.path.getmtime(fanout_path) < cutoff:
+                report['bytes'] += remove_path(fanout_path)
+            continue
+        with os.scandir(fanout_path) as entries:
+            for entry in entries:
+                sha = fanout + entry.name
+                if len(sha) == 40 and bytes.fromhex(sha) in marked:
+                    loose.append(sha)
+                elif entry.stat().st_mtime < cutoff:
+                    report['bytes'] += remove_path(entry.path)
+                    report['objects'] += not entry.name.startswith('tmp_')
+
+    packs = list_packs(objects_path)
+    if os.path.isdir(pack_dir):
+        with os.scandir(pack_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith('tmp_') and entry.stat().st_mtime < cutoff:
+                    report['bytes'] += remove_path(entry.path)
+
+    has_garbage = any(
+        not marked.has_entry(index_path, position)
+        for index_path, pack_path in packs
+        if os.path.getmtime(pack_path) < cutoff
+        for position, _ in enumerate(iter_pack_index(index_path))
+    )
+    if loose or len(packs) > 1 or has_garbage:
+        keep_all = [os.path.getmtime(pack_path) > cutoff for _, pack_path in packs]
+
+        def kept(number, digest):
+            """Whether pack `number` has the object and keeps it."""
+            position = marked.position(packs[number][0], digest)
+            return position is not None and (
+                keep_all[number] or marked.has_entry(packs[number][0], position))
+
+        def records():
+            for sha in loose:
+                packed[0] += 1
+                yield sha, read_raw_object(root, sha)
+            loose_shas = set(loose)
+            for number, (index_path, pack_path) in enumerate(packs):
+                with open(pack_path, 'rb') as pack:
+                    for position, (sha, offset, length) in enumerate(
+                            iter_pack_index(index_path)):
+                        if sha in loose_shas or any(
+                                kept(earlier, bytes.fromhex(sha)) for earlier in range(number)):
+                            continue
+                        if keep_all[number] or marked.has_entry(index_path, position):
+                            packed[0] += 1
+                            pack.seek(offset)
+                            yield sha, pack.read(length)
+                        else:
+                            report['objects'] += 1
+
+        packed = [0]
+        old_size = sum(os.path.getsize(object_path(root, sha)) for sha in loose)
+        old_size += sum(os.path.getsize(index_path) + os.path.getsize(pack_path)
+                        for index_path, pack_path in packs)
+        new_pack, new_size = write_pack(root, records())
+        marked.close()
+        for index_path, pack_path in packs:
+            if pack_path != new_pack:
+                os.remove(index_path)
+                os.remove(pack_path)
+        for sha in loose:
+            os.remove(object_path(root, sha))
+        if new_pack:
+            new_size += os.path.getsize(new_pack[:-5] + '.idx')
+        report['packed'] = packed[0]
+        # Packing loose objects can take a few more bytes.
+        report['bytes'] += max(0, old_size - new_size)
+        _packs_cache.clear()
+
+    for fanout in os.listdir(objects_path):
+        fanout_path = os.path.join(objects_path, fanout)
+        if fanout != 'pack' and os.path.isdir(fanout_path) and not os.listdir(fanout_path):
+            os.rmdir(fanout_path)
+
+
+@traced('gc')
+def gc(grace_period=GC_GRACE_PERIOD):
+    """Delete unreachable commits and objects and pack the rest.
+
+    Commits reachable from any reference are marked with a bitmap
+    over the commit graph, and their objects by walking their trees,
+    with a bit per pack index entry (see `ObjectMarks`).
+    Unreachable images, journal records and loose objects, and
+    leftover temporary files, are deleted once they are older than
+    the grace period; the journal is rewritten without them. The
+    remaining loose objects and packs are then written to a single
+    pack. Directories are scanned with `os.scandir`, so they are
+    never listed into memory at once. A store other than the
+    filesystem keeps no modification times, so its unreachable
+    objects are deleted right away.
+
+    Args:
+        grace_period (int): Seconds an unreachable file is kept,
+          default two weeks.
+
+    Returns:
+        dict: The number of 'commits' and 'objects' removed, the
+          number of objects 'packed' and the 'bytes' reclaimed.
+    """
+    root = is_wit_exists(os.getcwd())
+    wit_path = common_dir(root)
+    cutoff = time.time() - grace_period
+    graph, commits = mark_commits(root)
+    report = {'commits': 0, 'objects': 0, 'packed': 0, 'bytes': 0}
+
+    def is_marked_commit(commit_id):
+        pos = graph['pos'].get(commit_id)
+        return pos is not None and commits >> pos & 1
+
+    def keep_commit(commit_id, record):
+        timestamp = parse_commit(record).get('timestamp', '0 +0000')
+        return is_marked_commit(commit_id) or int(timestamp.split()[0]) > cutoff
+
+    # The objects of unreachable commits still in the grace period
+    # are kept with them.
+    marked = mark_objects(root, [
+        commit_id for commit_id, record in iter_commit_records(root)
+        if keep_commit(commit_id, record)])
+
+    images_path = os.path.join(wit_path, 'images')
+    with os.scandir(images_path) as entries:
+        for entry in entries:
+            commit_id = entry.name[:-4] if entry.name.endswith('.txt') else entry.name
+            if is_marked_commit(commit_id) or entry.stat().st_mtime > cutoff:
+                continue
+            report['bytes'] += remove_path(entry.path)
+            report['commits'] += entry.name.endswith('.txt')
+
+    store = open_store(wit_path)
+    report['commits'] += store.remove_commits(keep_commit)
+
+    index_lock = os.path.join(root, '.wit', 'index.txt.lock')
+    if os.path.exists(index_lock) and os.path.getmtime(index_lock) < cutoff:
+        report['bytes'] += remove_path(index_lock)
+
+    if isinstance(store, FileStore):
+        repack_objects(root, marked, cutoff, report)
+    else:
+        garbage = [(sha, size) for sha, size in store.iter_object_sizes()
+                   if bytes.fromhex(sha) not in marked]
+        for sha, size in garbage:
+            store.delete_object(sha)
+            report['objects'] += 1
+            report['bytes'] += size
+    marked.close()
+
+    if report['commits']:
+        had_bitmaps = os.path.exists(os.path.join(wit_path, 'bitmaps.txt'))
+        write_commit_graph(root)
+        if had_bitmaps:
+            write_bitmaps(root)
+    return report
+
+
+FSCK_BATCH_SIZE = 256
+
+
+def verify_object(path, sha, offset=0, length=None):
+    """Check that a stored object hashes to its name.
+
+    The compressed record is read and inflated in CHUNK_SIZE
+    pieces, so large objects are never held in memory.
+
+    Args:
+        path (str): Loose object file or pack.
+        sha (str): The expected SHA-1.
+        offset (int): Offset of the record in a pack.
+        length (int): Length of the record in a pack, None for
+          a loose object.
+
+    Returns:
+        tuple: An error message (None if the object is fine) and
+          the SHA-1s a tree object refers to.
+    """
+    def chunks():
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            remaining = length
+            while remaining is None or remaining > 0:
+                to_read = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+                chunk = f.read(to_read)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    return verify_chunks(chunks(), sha)
+
+
+def verify_chunks(chunks, sha):
+    """The checks of `verify_object`, over the chunks of a compressed
+       record (a single one for a record a store holds in memory)."""
+    hasher = hashlib.sha1()
+    decompressor = zlib.decompressobj()
+    header = b''
+    size = 0
+    tree_data = []
+    try:
+        for chunk in chunks:
+            data = decompressor.decompress(chunk)
+            hasher.update(data)
+            if b'\0' not in header:
+                header += data
+                data = header.partition(b'\0')[2]
+            size += len(data)
+            if header.startswith(b'tree '):
+                tree_data.append(data)
+        data = decompressor.flush()
+        hasher.update(data)
+        size += len(data)
+        tree_data.append(data)
+    except (OSError, zlib.error) as err:
+        return f'{sha}: unreadable ({err})', []
+
+    obj_type, _, declared = header.partition(b'\0')[0].partition(b' ')
+    if hasher.hexdigest() != sha:
+        return f'{sha}: hash mismatch, content hashes to {hasher.hexdigest()}', []
+    if not declared.isdigit() or int(declared) != size:
+        return f'{sha}: size mismatch, header says {declared.decode()}', []
+    refs = []
+    if obj_type == b'tree':
+        for line in b''.join(tree_data).decode().splitlines():
+            refs.append(line.split(' ', 2)[1])
+    return None, refs
+
+
+def verify_objects(batch):
+    """Run `verify_object` over a batch of argument tuples."""
+    return [verify_object(*args) for args in batch]
+
+
+def stored_objects(root):
+    """Yield `verify_object` arguments for every loose and packed object."""
+    objects_path = os.path.join(common_dir(root), 'objects')
+    for fanout in sorted(os.listdir(objects_path)):
+        fanout_path = os.path.join(objects_path, fanout)
+        if len(fanout) != 2 or not os.path.isdir(fanout_path):
+            continue
+        with os.scandir(fanout_path) as entries:
+            for entry in entries:
+                if not entry.name.startswith('tmp_'):
+                    yield (entry.path, fanout + entry.name)
+    for index_path, pack_path in list_packs(objects_path):
+        for sha, offset, length in iter_pack_index(index_path):
+            yield (pack_path, sha, offset, length)
+
+
+def batched(iterable, size):
+    """Yield lists of up to `size` items of the iterable."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@traced('fsck')
+def fsck(workers=None):
+    """Verify the integrity of the repository.
+
+    Every object, loose or packed, is re-hashed and compared to its
+    name, in parallel over a process pool so hashing a big store is
+    bound by the disk rather than one core (in this process for a
+    store other than the filesystem). Then every commit's
+    parents and tree, every tree's entries and every reference
+    are checked to point at existing commits and objects.
 
     Args:
-        root (str): Path to the root directory.
-        start (str): Existing commit_id.
+        workers (int): Default to None (one per CPU). Number of
+          processes hashing objects; 1 hashes in this process.
 
     Returns:
-        dict: All of the parents from the start commit_id
-          to the first commit_id (parent=None).
+        list: A message for every problem found.
     """
-    all_parents = return_all_parents(root)
-    parents_a = find_partial_parents(all_parents, start)
+    root = is_wit_exists(os.getcwd())
+    problems = []
+    referenced = {}
 
-    parents_b = add_missing_parents(parents_a, all_parents, root)
-    while parents_b:
-        for parents_dict in parents_b:
-            parents_a.update(parents_dict)
-        parents_b = add_missing_parents(parents_a, all_parents, root)
-    return parents_a
+    def collect(results):
+        for (error, refs), args in results:
+            if error:
+                problems.append(f'object {error}')
+            for sha in refs:
+                referenced.setdefault(sha, args[1])
 
+    store = open_store(common_dir(root))
+    batches = batched(stored_objects(root), FSCK_BATCH_SIZE)
+    if not isinstance(store, FileStore):
+        collect(((verify_chunks([record], sha), (None, sha))
+                 for sha, record in store.iter_objects()))
+    elif workers == 1:
+        for batch in batches:
+            collect(zip(verify_objects(batch), batch))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            pending = {}
+            for batch in batches:
+                pending[pool.submit(verify_objects, batch)] = batch
+                if len(pending) >= 4 * (workers or os.cpu_count() or 1):
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        collect(zip(future.result(), pending.pop(future)))
+            for future, batch in pending.items():
+                collect(zip(future.result(), batch))
 
-def graph():
-    """Create a flow chart of the commit directories tree.
+    for sha, tree in referenced.items():
+        if not has_object(root, sha):
+            problems.append(f'tree {tree}: missing object {sha}')
+
+    commits = list_commit_ids(root)
+    for commit_id in sorted(commits):
+        try:
+            commit_data = get_commit_data(root, commit_id)
+        except (ValueError, KeyError, UnicodeDecodeError) as err:
+            problems.append(f'commit {commit_id}: unparsable ({err})')
+            continue
+        for parent in commit_data['parent']:
+            if parent != 'None' and parent not in commits:
+                problems.append(f'commit {commit_id}: missing parent {parent}')
+        tree = commit_data.get('tree', commit_id)
+        if tree == commit_id:
+            if not os.path.isdir(image_path(root, commit_id)):
+                problems.append(f'commit {commit_id}: missing image directory')
+        elif not has_object(root, tree):
+            problems.append(f'commit {commit_id}: missing tree {tree}')
+
+    for name, commit_id in get_ref(root).items():
+        if commit_id not in commits:
+            problems.append(f'ref {name}: missing commit {commit_id}')
+    return problems
+
+
+def link_or_copy(source, destination):
+    """Hard-link a file, or copy it if it can't be linked (e.g. across
+       file systems). Returns True if it was linked."""
+    try:
+        os.link(source, destination)
+        return True
+    except OSError:
+        shutil.copy2(source, destination)
+        return False
+
+
+@traced('clone')
+def clone(source, destination=None, shared=False, reference=None):
+    """Create a new repository from a local one.
+
+    Commits, images and objects never change once written, so they
+    are hard-linked rather than copied when both repositories are on
+    the same file system. With `shared`, nothing is linked: the new
+    repository lists the source's '.wit' in its 'alternates.txt' and
+    reads its history from there, so cloning costs O(refs). With a
+    `reference` repository (e.g. a shared cache), whatever it has is
+    borrowed the same way and only the rest is linked. The clone's
+    HEAD is checked out into the new working directory.
 
     Args:
-        None
+        source (str): Root directory of the repository to clone.
+        destination (str): Default to the source's directory name
+          in the cwd. Must not exist or be empty.
+        shared (bool): Default to False. Borrow all of the source's
+          history instead of linking it.
+        reference (str): Default to None. Root directory of a
+          repository to borrow commits and objects from.
 
     Returns:
-        Digraph: A styled graph object of the dirs tree.
+        dict: The number of files 'linked' and 'copied'.
+    """
+    source_wit = os.path.join(os.path.abspath(source), '.wit')
+    if not os.path.isdir(source_wit):
+        raise WitDirNotFoundError(f"'{source}' is not a wit repository.")
+    destination = os.path.abspath(
+        destination or os.path.basename(os.path.abspath(source)))
+    wit_path = os.path.join(destination, '.wit')
+    os.makedirs(destination, exist_ok=True)
+    create_paths((wit_path, os.path.join(wit_path, 'images'),
+                  os.path.join(wit_path, 'objects'),
+                  os.path.join(wit_path, 'staging_area')))
+
+    alternates = []
+    if shared:
+        alternates.append(source_wit)
+    if reference:
+        alternates.append(os.path.join(os.path.abspath(reference), '.wit'))
+    if alternates:
+        with open(os.path.join(wit_path, 'alternates.txt'), 'w') as f:
+            f.writelines(f'{alternate}\n' for alternate in alternates)
+    borrowed = wit_dirs(destination)[1:]
+
+    def is_borrowed(*path):
+        return any(os.path.exists(os.path.join(alternate, *path))
+                   for alternate in borrowed)
+
+    report = {'linked': 0, 'copied': 0}
+    for top in ('images', 'objects'):
+        if shared:
+            break
+        for dirpath, _, filenames in os.walk(os.path.join(source_wit, top)):
+            relpath = os.path.relpath(dirpath, start=source_wit)
+            for filename in filenames:
+                parts = os.path.join(relpath, filename).split(os.sep)
+                # An image directory is borrowed as a whole.
+                unit = parts[:2] if top == 'images' else parts
+                if filename.startswith('tmp_') or is_borrowed(*unit):
+                    continue
+                os.makedirs(os.path.join(wit_path, relpath), exist_ok=True)
+                linked = link_or_copy(os.path.join(dirpath, filename),
+                                      os.path.join(wit_path, *parts))
+                report['linked' if linked else 'copied'] += 1
+
+    # The journal is appended to, so it is copied rather than linked.
+    if not shared and os.path.isdir(os.path.join(source_wit, 'journal')):
+        shutil.copytree(os.path.join(source_wit, 'journal'),
+                        os.path.join(wit_path, 'journal'))
+        report['copied'] += len(os.listdir(os.path.join(wit_path, 'journal')))
+
+    for filename in ('references.txt', 'activated.txt',
+                     'commit-graph.txt', 'bitmaps.txt'):
+        if os.path.exists(os.path.join(source_wit, filename)):
+            shutil.copy2(os.path.join(source_wit, filename),
+                         os.path.join(wit_path, filename))
+            report['copied'] += 1
+
+    # Nothing to link out of another store: its history is sent over.
+    source_store = open_store(source_wit)
+    if not shared and not isinstance(source_store, FileStore):
+        references = source_store.get_refs()
+        transfer(os.path.dirname(source_wit), destination, set(references.values()))
+        write_refs(destination, references)
+        report['copied'] += 1
+
+    head = get_ref(destination)['HEAD']
+    commit_path = ensure_image(destination, head)
+    update_root_dir(destination, commit_path)
+    update_staging_area(wit_path, commit_path)
+    reset_index(destination, head)
+    return report
+
+
+PACK_STREAM_MAGIC = b'WITPACK1\n'
+
+
+class PushRejectedError(Exception):
+    pass
+
+
+def has_commit(root, commit_id):
+    """Check if a repository (or one of its alternates) has a commit."""
+    try:
+        read_commit_record(root, commit_id)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def negotiate(sender_root, receiver_root, wants):
+    """Find the commits the receiver is missing.
+
+    Walks back from the wanted tips on the sender's side and stops
+    at every commit the receiver already has, so only the new part
+    of the history is visited.
+
+    Args:
+        sender_root (str): Root of the repository sending commits.
+        receiver_root (str): Root of the repository receiving them.
+        wants (iterable): The tips the receiver asks for.
+
+    Returns:
+        list: The missing commit_ids, parents before children.
+    """
+    missing = {}
+    stack = [want for want in wants if not has_commit(receiver_root, want)]
+    while stack:
+        commit_id = stack.pop()
+        if commit_id in missing:
+            continue
+        parents = [p for p in get_commit_data(sender_root, commit_id)['parent']
+                   if p != 'None']
+        missing[commit_id] = parents
+        stack.extend(p for p in parents
+                     if p not in missing and not has_commit(receiver_root, p))
+    return topological_order(missing)
+
+
+def missing_objects(sender_root, receiver_root, commits):
+    """Yield the SHA-1s of the objects of `commits` the receiver lacks.
+
+    A tree the receiver has is skipped with everything under it.
+    """
+    seen = set()
+    stack = []
+    for commit_id in commits:
+        tree = get_commit_data(sender_root, commit_id).get('tree', commit_id)
+        if tree != commit_id:
+            stack.append(tree)
+    while stack:
+        tree = stack.pop()
+        if tree in seen or has_object(receiver_root, tree):
+            continue
+        seen.add(tree)
+        yield tree
+        for line in read_object(sender_root, tree)[1].decode().splitlines():
+            obj_type, sha, _ = line.split(' ', 2)
+            if obj_type == 'tree':
+                stack.append(sha)
+            elif sha not in seen and not has_object(receiver_root, sha):
+                seen.add(sha)
+                yield sha
+
+
+def send_pack(sender_root, commits, objects, stream):
+    """Write commits and objects to a stream as a single pack.
+
+    The stream is a header followed by '<kind> <name> <length>'
+    lines, each followed by `length` bytes: 'object' entries carry
+    an object's compressed record, 'commit' entries a commit file
+    and 'file' entries the files of images older than the object
+    store. It ends with an 'end' line.
+
+    Returns:
+        int: Bytes written.
+    """
+    written = stream.write(PACK_STREAM_MAGIC)
+
+    def entry(kind, name, data):
+        return stream.write(f'{kind} {name} {len(data)}\n'.encode() + data)
+
+    for sha in objects:
+        written += entry('object', sha, read_raw_object(sender_root, sha))
+    for commit_id in commits:
+        written += entry('commit', commit_id,
+                         read_commit_record(sender_root, commit_id))
+        tree = get_commit_data(sender_root, commit_id).get('tree', commit_id)
+        if tree == commit_id:
+            image = image_path(sender_root, commit_id)
+            for path in dir_files(image):
+                with open(path, 'rb') as f:
+                    written += entry(
+                        'file', f'{commit_id}/{to_relpath(path, image)}',
+                        f.read())
+    written += stream.write(b'end\n')
+    return written
+
+
+def write_image(root, commit_id):
+    """Write a commit's images directory from its tree objects."""
+    destination = os.path.join(common_dir(root), 'images', commit_id)
+    for relpath, sha in commit_entries(root, commit_id).items():
+        path = os.path.join(destination, *relpath.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(read_object(root, sha)[1])
+    os.makedirs(destination, exist_ok=True)
+
+
+def ensure_image(root, commit_id):
+    """Return the path of a commit's images directory, writing it
+       from the commit's tree first if it doesn't exist yet."""
+    path = image_path(root, commit_id)
+    if not os.path.isdir(path):
+        tree = get_commit_data(root, commit_id).get('tree', commit_id)
+        if tree != commit_id and has_object(root, tree):
+            write_image(root, commit_id)
+    return path
+
+
+def receive_pack(root, stream):
+    """Store the commits and objects of a `send_pack` stream.
+
+    The objects are written to a new pack. Images directories are
+    only received for commits without a tree; the others' are built
+    when needed, by `ensure_image`.
+
+    Returns:
+        list: The received commit_ids.
+    """
+    if stream.readline() != PACK_STREAM_MAGIC:
+        raise ValueError('Not a wit pack stream.')
+    images_path = os.path.join(common_dir(root), 'images')
+    records = []
+
+    def objects():
+        for line in iter(stream.readline, b'end\n'):
+            kind, name, length = line.decode().split()
+            data = stream.read(int(length))
+            if kind == 'object':
+                yield name, data
+            elif kind == 'commit':
+                records.append((name, data))
+            else:
+                path = os.path.join(images_path, *name.split('/'))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+
+    store = open_store(common_dir(root))
+    store.put_objects(objects())
+    commits = [commit_id for commit_id, _ in records]
+    if records:
+        store.put_commits(records)
+    if commits and os.path.exists(os.path.join(common_dir(root), 'commit-graph.txt')):
+        graph = load_commit_graph(root)
+        for commit_id in commits:
+            graph_position(root, graph, commit_id)
+    return commits
+
+
+def transfer(sender_root, receiver_root, wants):
+    """Send the commits and objects behind `wants` the receiver lacks,
+       through a single pack stream.
+
+    Returns:
+        dict: The number of 'commits' and 'objects' sent and the
+          'bytes' of the pack.
+    """
+    commits = negotiate(sender_root, receiver_root, wants)
+    objects = list(missing_objects(sender_root, receiver_root, commits))
+    with tempfile.TemporaryFile() as stream:
+        size = send_pack(sender_root, commits, objects, stream)
+        stream.seek(0)
+        receive_pack(receiver_root, stream)
+    return {'commits': len(commits), 'objects': len(objects), 'bytes': size}
+
+
+def remote_root(remote):
+    """Return the root directory of a remote repository path."""
+    root = os.path.abspath(remote)
+    if not os.path.isdir(os.path.join(root, '.wit')):
+        raise WitDirNotFoundError(f"'{remote}' is not a wit repository.")
+    return root
+
+
+@traced('fetch')
+def fetch(remote, name='origin'):
+    """Download the branches of another local repository.
+
+    Only the commits and objects missing here are transferred. Every
+    local branch of the remote is recorded as '<name>/<branch>' in
+    references.txt, ready to be merged; its own remote-tracking
+    refs (names with a '/') are skipped.
+
+    Args:
+        remote (str): Path of the other repository.
+        name (str): Default to 'origin'. Prefix of the branches.
+
+    Returns:
+        dict: See `transfer`.
     """
     root = is_wit_exists(os.getcwd())
+    source = remote_root(remote)
+    branches = {branch: commit_id
+                for branch, commit_id in get_ref(source).items()
+                if branch != 'HEAD' and '/' not in branch}
+    report = transfer(source, root, set(branches.values()))
+    references = get_ref(root)
+    references.update({f'{name}/{branch}': commit_id
+                       for branch, commit_id in branches.items()})
+    write_refs(root, references)
+    return report
 
-    commit_graph = Digraph(
-        'commit_graph', filename='commit_id_tree', format='png'
-    )
-    commit_graph.attr(rankdir='RL')
-    commit_graph.attr(
-        'node', style='filled', fillcolor="cornflowerblue", shape='circle'
-    )
-    commit_graph.attr('edge', style='filled', fillcolor="cornflowerblue")
 
-    commit_graph.edge('HEAD', get_ref(root)['HEAD'][:6])
+@traced('push')
+def push(remote, branch=None):
+    """Upload a branch to another local repository.
 
-    if get_ref(root)['master'] == get_ref(root)['HEAD']:
-        commit_graph.edge('master', get_ref(root)['master'][:6])
+    Only the commits and objects the remote is missing are
+    transferred. The remote branch is only moved forward, and a
+    branch checked out in the remote is never updated.
 
-    head = get_ref(root)['HEAD']
-    for comm_id, parents in return_parents(root, head).items():
-        for p in parents:
-            commit_graph.edge(comm_id[:6], p[:6])
-    return commit_graph
+    Args:
+        remote (str): Path of the other repository.
+        branch (str): Default to the active branch.
 
+    Returns:
+        dict: See `transfer`.
 
-def branch(name):
-    """Add the given branch name to references.txt"""
+    Raises:
+        PushRejectedError: If the push would lose remote commits or
+          change the remote's checked out branch.
+    """
+    root = is_wit_exists(os.getcwd())
+    destination = remote_root(remote)
+    branch = branch or get_active_branch(root)
+    commit_id = get_ref(root)[branch]
+    references = get_ref(destination)
+    current = references.get(branch)
+    if current == commit_id:
+        return {'commits': 0, 'objects': 0, 'bytes': 0}
+    if current and (not has_commit(root, current)
+                    or not is_ancestor(current, commit_id, root=root)):
+        raise PushRejectedError(
+            f"Remote '{branch}' has commits that aren't here. Fetch and merge first.")
+    if (current and get_active_branch(destination) == branch
+            and references['HEAD'] == current):
+        raise PushRejectedError(f"'{branch}' is checked out in the remote.")
+
+    report = transfer(root, destination, [commit_id])
+    references[branch] = commit_id
+    write_refs(destination, references)
+    return report
+
+
+class BranchCheckedOutError(Exception):
+    pass
+
+
+def list_worktrees(root):
+    """Return the root directories of all the worktrees sharing
+       the repository's history, the main one first."""
+    common = common_dir(root)
+    worktrees = [os.path.dirname(common)]
+    try:
+        with open(os.path.join(common, 'worktrees.txt'), 'r') as f:
+            worktrees.extend(line.strip() for line in f if line.strip())
+    except FileNotFoundError:
+        pass
+    return [worktree for worktree in worktrees
+            if os.path.isdir(os.path.join(worktree, '.wit'))]
+
+
+def check_not_checked_out(root, branch, ignore_current=True):
+    """Raise BranchCheckedOutError if another worktree (or any,
+       when not `ignore_current`) has the branch active."""
+    for worktree in list_worktrees(root):
+        if ignore_current and os.path.samefile(worktree, root):
+            continue
+        if get_active_branch(worktree) == branch:
+            raise BranchCheckedOutError(
+                f"'{branch}' is already checked out at '{worktree}'.")
+
+
+@traced('worktree')
+def worktree_add(path, branch):
+    """Create an additional working directory for a branch.
+
+    The new worktree gets its own HEAD, activated branch, index and
+    staging area, and shares the images, objects, references and
+    commit graph of the current repository, so it costs only its
+    working-tree files.
+
+    Args:
+        path (str): A new or empty directory.
+        branch (str): An existing branch, not checked out elsewhere.
+
+    Raises:
+        BranchCheckedOutError: If the branch is active in another
+          worktree.
+    """
+    root = is_wit_exists(os.getcwd())
+    common = common_dir(root)
+    commit_id = get_ref(root)[branch]
+    check_not_checked_out(root, branch, ignore_current=False)
+    path = os.path.abspath(path)
+    wit_path = os.path.join(path, '.wit')
+    os.makedirs(os.path.join(wit_path, 'staging_area'))
+    with open(os.path.join(wit_path, 'commondir.txt'), 'w') as f:
+        f.write(common)
+    with open(os.path.join(wit_path, 'HEAD.txt'), 'w') as f:
+        f.write(commit_id)
+    update_activated_file(path, branch_name=branch)
+    with open(os.path.join(common, 'worktrees.txt'), 'a') as f:
+        f.write(f'{path}\n')
+
+    commit_path = ensure_image(root, commit_id)
+    update_root_dir(path, commit_path)
+    update_staging_area(wit_path, commit_path)
+    reset_index(path, commit_id)
+    return path
+
+
+def worktree_entries(root, index):
+    """Return the 'relpath: blob sha' dict of the tracked files in
+       the working tree.
+
+    Only files whose size or mtime differ from their index entry
+    are read, and stored as new blobs. Deleted files are left out.
+    """
+    index_mtime_ns = os.stat(os.path.join(root, '.wit', 'index.txt')).st_mtime_ns
+    entries = {}
+    for relpath, (sha, size, mtime_ns) in index.items():
+        try:
+            stat = os.stat(os.path.join(root, relpath))
+        except FileNotFoundError:
+            continue
+        if (size, mtime_ns) == (stat.st_size, stat.st_mtime_ns) \
+                and stat.st_mtime_ns < index_mtime_ns:
+            entries[relpath] = sha
+        else:
+            entries[relpath] = hash_file(root, os.path.join(root, relpath))
+    return entries
+
+
+def changed_paths(entries_a, entries_b):
+    """Return the relpaths whose blob differs between two
+       'relpath: blob sha' dicts."""
+    return {relpath for relpath in entries_a.keys() | entries_b.keys()
+            if entries_a.get(relpath) != entries_b.get(relpath)}
+
+
+def write_blob(root, sha, path):
+    """Write a blob's content to `path`, or delete `path` if
+       `sha` is None."""
+    if sha is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(read_object(root, sha)[1])
+
+
+def tree_of(root, entries):
+    """Store the trees of a 'relpath: blob sha' dict."""
+    return write_tree(root, {relpath: (sha, -1, 0)
+                             for relpath, sha in entries.items()})
+
+
+def read_stash(root):
+    """Return the stash entries, newest first, as
+       (commit_id, message) pairs."""
+    try:
+        with open(os.path.join(common_dir(root), 'stash.txt'), 'r') as f:
+            return [tuple(line.rstrip('\n').split(' ', 1)) for line in f]
+    except FileNotFoundError:
+        return []
+
+
+def write_stash(root, stash):
+    with open(os.path.join(common_dir(root), 'stash.txt'), 'w') as f:
+        f.writelines(f'{commit_id} {message}\n' for commit_id, message in stash)
+
+
+@traced('stash')
+def stash_push(message=None):
+    """Save the staged and unstaged changes and revert them.
+
+    The index and the working tree are recorded as two commits
+    without images directories: one of the index's tree, and one of
+    the working tree's, whose parents are HEAD and the index commit.
+    Unchanged files keep their existing blobs, so only the changed
+    files are stored. Afterwards only the changed files are reset to
+    HEAD.
+
+    Args:
+        message (str): Default to 'WIP on <branch>: <HEAD>'.
+
+    Returns:
+        str: The stash commit_id, or None if there was nothing to save.
+    """
     root = is_wit_exists(os.getcwd())
-    ref_path = os.path.join(root, '.wit', 'references.txt')
     head = get_ref(root)['HEAD']
-    with open(ref_path, 'a') as f:
-        f.write(f'{name}={head}')
+    index = read_index(root)
+    head_entries = commit_entries(root, head)
+    index_entries = {relpath: entry[0] for relpath, entry in index.items()}
+    work_entries = worktree_entries(root, index)
+    staged = changed_paths(head_entries, index_entries)
+    unstaged = changed_paths(head_entries, work_entries)
+    if not staged and not unstaged:
+        return None
+
+    images_path = os.path.join(common_dir(root), 'images')
+    branch = get_active_branch(root) or head[:6]
+    index_commit = id_generator()
+    write_commit_record(images_path, index_commit, tree_of(root, index_entries),
+                        [head], f'index on {branch}: {head[:6]}')
+    append_commit_graph(root, index_commit)
+    stash_commit = id_generator()
+    write_commit_record(images_path, stash_commit, tree_of(root, work_entries),
+                        [head, index_commit],
+                        message or f'WIP on {branch}: {head[:6]}')
+    append_commit_graph(root, stash_commit)
+    write_stash(root, [(stash_commit, message or f'WIP on {branch}: {head[:6]}')]
+                + read_stash(root))
+
+    staging_area = os.path.join(root, '.wit', 'staging_area')
+    for relpath in unstaged:
+        write_blob(root, head_entries.get(relpath), os.path.join(root, relpath))
+    for relpath in staged:
+        write_blob(root, head_entries.get(relpath),
+                   os.path.join(staging_area, relpath))
+        index.pop(relpath, None)
+    for relpath in unstaged | staged:
+        if relpath in head_entries:
+            stat = os.stat(os.path.join(root, relpath))
+            index[relpath] = (head_entries[relpath], stat.st_size, stat.st_mtime_ns)
+    write_index(root, index)
+    return stash_commit
+
+
+@traced('stash')
+def stash_pop(number=0):
+    """Re-apply a stash entry and drop it.
+
+    Only the files the stash changed are written, to the working
+    tree, staging area and index.
+
+    Args:
+        number (int): Default to 0 (the newest). The entry to pop.
+
+    Raises:
+        NotSavedChangesError: If a file the stash changes has
+          changes that aren't committed.
+        MergeConflictError: If HEAD changed a file the stash changes
+          since the stash was saved; nothing is changed then.
+    """
+    root = is_wit_exists(os.getcwd())
+    stash = read_stash(root)
+    stash_commit, _ = stash[number]
+    base, index_commit = get_commit_data(root, stash_commit)['parent']
+    base_entries = commit_entries(root, base)
+    stash_index = commit_entries(root, index_commit)
+    stash_work = commit_entries(root, stash_commit)
+    staged = changed_paths(base_entries, stash_index)
+    unstaged = changed_paths(base_entries, stash_work)
+
+    index = read_index(root)
+    head_entries = commit_entries(root, get_ref(root)['HEAD'])
+    index_entries = {relpath: entry[0] for relpath, entry in index.items()}
+    local = (changed_paths(head_entries, index_entries)
+             | changed_paths(index_entries, worktree_entries(root, index)))
+    if local & (staged | unstaged):
+        raise NotSavedChangesError(
+            "Files changed by the stash have changes not yet commited.")
+    moved = sorted(relpath for relpath in staged | unstaged
+                   if head_entries.get(relpath) != base_entries.get(relpath))
+    if moved:
+        raise MergeConflictError(
+            f"HEAD changed files the stash changes: {', '.join(moved)}")
+
+    staging_area = os.path.join(root, '.wit', 'staging_area')
+    for relpath in unstaged:
+        write_blob(root, stash_work.get(relpath), os.path.join(root, relpath))
+    for relpath in staged:
+        write_blob(root, stash_index.get(relpath),
+                   os.path.join(staging_area, relpath))
+    for relpath in staged | unstaged:
+        if relpath not in stash_index:
+            index.pop(relpath, None)
+        elif stash_index[relpath] == stash_work.get(relpath):
+            stat = os.stat(os.path.join(root, relpath))
+            index[relpath] = (stash_index[relpath], stat.st_size, stat.st_mtime_ns)
+        else:
+            index[relpath] = (stash_index[relpath], -1, 0)
+    write_index(root, index)
+    write_stash(root, stash[:number] + stash[number + 1:])
+    return stash_commit
+
+
+class MergeConflictError(Exception):
+    pass
+
+
+def line_changes(base, other):
+    """Return the (start, end, lines) hunks that turn the `base`
+       lines into the `other` lines, in order."""
+    matcher = difflib.SequenceMatcher(None, base, other, autojunk=False)
+    return [(i1, i2, other[j1:j2])
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def apply_changes(base, start, end, changes):
+    """Return `base[start:end]` with the hunks applied."""
+    lines = []
+    for change_start, change_end, replacement in changes:
+        lines.extend(base[start:change_start])
+        lines.extend(replacement)
+        start = change_end
+    lines.extend(base[start:end])
+    return lines
 
 
+def merge_lines(base, ours, theirs):
+    """Three-way merge lists of lines.
+
+    Hunks of the two sides that overlap or touch form a region; a
+    region changed by one side takes that side's lines, and one
+    changed by both is a conflict unless they made the same change.
+
+    Returns:
+        list: The merged lines, or None on a conflict.
+    """
+    hunks = sorted([(*change, 0) for change in line_changes(base, ours)]
+                   + [(*change, 1) for change in line_changes(base, theirs)])
+    merged = []
+    position = i = 0
+    while i < len(hunks):
+        start, end = hunks[i][0], hunks[i][1]
+        region = [hunks[i]]
+        i += 1
+        while i < len(hunks) and hunks[i][0] <= end:
+            end = max(end, hunks[i][1])
+            region.append(hunks[i])
+            i += 1
+        sides = [apply_changes(base, start, end, [hunk[:3] for hunk in region
+                                                  if hunk[3] == side])
+                 for side in (0, 1)]
+        changed_by = {hunk[3] for hunk in region}
+        if changed_by == {0, 1} and sides[0] != sides[1]:
+            return None
+        merged.extend(base[position:start])
+        merged.extend(sides[1] if changed_by == {1} else sides[0])
+        position = end
+    merged.extend(base[position:])
+    return merged
+
+
+def merge_blobs(root, base, ours, theirs):
+    """Three-way merge the lines of three blobs (`base` may be None)
+       and store the result.
+
+    Returns:
+        str: The merged blob's sha, or None on a conflict, a
+          deleted side or binary content.
+    """
+    if ours is None or theirs is None:
+        return None
+    contents = [read_object(root, sha)[1] if sha else b'' for sha in (base, ours, theirs)]
+    if any(b'\0' in content for content in contents):
+        return None
+    merged = merge_lines(*(content.splitlines(keepends=True) for content in contents))
+    if merged is None:
+        return None
+    return write_object(root, 'blob', b''.join(merged))
+
+
+def merge_trees(root, base, ours, theirs):
+    """Three-way merge 'relpath: blob sha' dicts in memory.
+
+    A path takes the side that changed it from `base`. A path both
+    sides changed is merged line by line (see `merge_lines`); it is
+    a conflict when the same lines changed differently, or when one
+    side deleted it.
+
+    Returns:
+        tuple: The merged dict and the list of conflicting relpaths.
+    """
+    merged = dict(ours)
+    conflicts = []
+    for relpath in changed_paths(base, theirs):
+        if ours.get(relpath) == theirs.get(relpath):
+            continue
+        if ours.get(relpath) != base.get(relpath):
+            sha = merge_blobs(root, base.get(relpath), ours.get(relpath),
+                              theirs.get(relpath))
+            if sha is None:
+                conflicts.append(relpath)
+            else:
+                merged[relpath] = sha
+        elif relpath in theirs:
+            merged[relpath] = theirs[relpath]
+        else:
+            del merged[relpath]
+    return merged, sorted(conflicts)
+
+
+def replay(root, head, commits):
+    """Re-apply commits on top of `head`, in memory only.
+
+    Each commit's change from its first parent is three-way merged
+    into the current tree (see `merge_trees`). The new commits are
+    written without an images directory, and only once every commit
+    applied, so a conflict leaves no commits behind.
+
+    Args:
+        root (str): Path to the root directory.
+        head (str): The commit_id to start from.
+        commits (list): The commit_ids to replay, in order.
+
+    Returns:
+        tuple: The new tip commit_id and its 'relpath: blob sha' dict.
+
+    Raises:
+        MergeConflictError: If a commit doesn't apply cleanly.
+    """
+    images_path = os.path.join(common_dir(root), 'images')
+    entries = commit_entries(root, head)
+    replayed = []
+    for commit_id in commits:
+        commit_data = get_commit_data(root, commit_id)
+        parent = commit_data['parent'][0]
+        base = {} if parent == 'None' else commit_entries(root, parent)
+        entries, conflicts = merge_trees(
+            root, base, entries, commit_entries(root, commit_id))
+        if conflicts:
+            raise MergeConflictError(
+                f"{commit_id[:6]} conflicts in: {', '.join(conflicts)}")
+        replayed.append((tree_of(root, entries), commit_data['message']))
+    for tree, message in replayed:
+        new_id = id_generator()
+        write_commit_record(images_path, new_id, tree, [head], message)
+        append_commit_graph(root, new_id)
+        head = new_id
+    return head, entries
+
+
+def move_head(root, commit_id, entries):
+    """Point HEAD (and the active branch) at a replayed commit and
+       update only the changed files of the working tree, staging
+       area and index."""
+    head_entries = commit_entries(root, get_ref(root)['HEAD'])
+    staging_area = os.path.join(root, '.wit', 'staging_area')
+    index = read_index(root)
+    for relpath in changed_paths(head_entries, entries):
+        sha = entries.get(relpath)
+        write_blob(root, sha, os.path.join(root, relpath))
+        write_blob(root, sha, os.path.join(staging_area, relpath))
+        if sha is None:
+            index.pop(relpath, None)
+        else:
+            stat = os.stat(os.path.join(root, relpath))
+            index[relpath] = (sha, stat.st_size, stat.st_mtime_ns)
+    write_index(root, index)
+    update_references(commit_id, root)
+
+
+@traced('cherry-pick')
+def cherry_pick(*identifiers):
+    """Apply the changes of existing commits on top of HEAD.
+
+    All the commits are replayed in memory, and the working tree is
+    updated once at the end.
+
+    Args:
+        identifiers (str): Branch names or commit_ids, in order.
+
+    Returns:
+        str: The new HEAD commit_id.
+
+    Raises:
+        MergeConflictError: If a commit doesn't apply cleanly;
+          nothing is changed then.
+    """
+    is_safe_checkout()
+    root = is_wit_exists(os.getcwd())
+    commits = [resolve(root, identifier) for identifier in identifiers]
+    head, entries = replay(root, get_ref(root)['HEAD'], commits)
+    move_head(root, head, entries)
+    return head
+
+
+@traced('rebase')
+def rebase(upstream):
+    """Replay the commits of HEAD that aren't in `upstream` on top of it.
+
+    Merge commits are dropped. The commits are replayed in memory,
+    and the working tree is updated once at the end rather than
+    once per commit.
+
+    Args:
+        upstream (str): Branch name or commit_id.
+
+    Returns:
+        str: The new HEAD commit_id.
+
+    Raises:
+        MergeConflictError: If a commit doesn't apply cleanly;
+          nothing is changed then.
+    """
+    is_safe_checkout()
+    root = is_wit_exists(os.getcwd())
+    upstream_id = resolve(root, upstream)
+    commits = [commit_id for commit_id in reversed(rev_list(f'{upstream_id}..HEAD'))
+               if len(get_commit_data(root, commit_id)['parent']) == 1]
+    head, entries = replay(root, upstream_id, commits)
+    move_head(root, head, entries)
+    return head
+
+
+@traced('merge')
 def merge(name):
     """Merge 2 commit_id directories: HEAD and
        the one that the given branch point at.
 
     Args:
         name (str): Existing branch name.
+
+    Returns:
+        str: The merge commit_id.
     """
     root = is_wit_exists(os.getcwd())
     staging_area = os.path.join(root, '.wit', 'staging_area')
-    head_commit = os.path.join(root, '.wit', 'images', get_ref(root)['HEAD'])
-    are_dirs_different = (compare_dirs(staging_area, head_commit)
-                          or compare_dirs(head_commit, staging_area))
-    if are_dirs_different:
+    if staged_paths(root, get_ref(root)['HEAD']):
         raise NotSavedChangesError("Can't merege. Staging area and HEAD are different.")
-    commit_path = os.path.join(root, '.wit', 'images', get_ref(root)[name])
+    commit_path = ensure_image(root, get_ref(root)[name])
     copy_files(commit_path, staging_area)
-    commit(f"Merge barnch {name}", branch=name)
+    index = read_index(root)
+    for relpath, sha in commit_entries(root, get_ref(root)[name]).items():
+        index[relpath] = (sha, -1, 0)
+    write_index(root, index)
+    return commit(f"Merge barnch {name}", branch=name)
 
 
 if __name__ == '__main__':
@@ -570,14 +4867,25 @@ if __name__ == '__main__':
     except IndexError:
         function = None
         print("Function name is missing.")
+    start_tracing(function)
     if function == 'init':
-        init()
+        stores = [arg.split('=', 1)[1] for arg in sys.argv[2:]
+                  if arg.startswith('--store=')]
+        # A MemoryStore doesn't outlive the process, so only the
+        # Python API (wit.Repository.init) can use one.
+        persistent = [name for name in STORES if name != 'memory']
+        if stores and stores[0] not in persistent:
+            print(f"usage: init [--store={'|'.join(persistent)}]")
+        else:
+            init(*stores[:1])
     if function == 'add':
-        try:
-            path = sys.argv[2]
-            add(path)
-        except IndexError:
+        dry_run = '--dry-run' in sys.argv[2:]
+        paths = [arg for arg in sys.argv[2:] if arg != '--dry-run']
+        if not paths:
             print("Path argument is missing.")
+        else:
+            for relpath in add(*paths, dry_run=dry_run):
+                print(f"add '{relpath}'")
     if function == 'commit':
         try:
             message = ' '.join(sys.argv[2:])
@@ -601,6 +4909,131 @@ if __name__ == '__main__':
             branch(name)
         except IndexError:
             print("name argument is missing.")
+    if function == 'log':
+        paths = [arg for arg in sys.argv[2:] if arg != '--']
+        for entry in log(*paths[:1]):
+            refs = f" ({', '.join(entry['refs'])})" if entry['refs'] else ''
+            print(f"commit {entry['commit']}{refs}")
+            print(f"Date: {entry['date']}\n\n    {entry['message']}\n")
+    if function == 'blame':
+        if len(sys.argv) != 3:
+            print("usage: blame <file>")
+        else:
+            lines = blame(sys.argv[2])
+            width = len(str(len(lines)))
+            for line_no, (commit_id, author, date, line) in enumerate(lines, 1):
+                print(f"{commit_id[:8]} ({author} {date} {line_no:>{width}}) {line}")
+    if function == 'commit-graph':
+        if sys.argv[2:] == ['--stats']:
+            for key, val in topology_stats().items():
+                print(f"{key}: {val}")
+        else:
+            print(f"{write_bitmaps(root=is_wit_exists(os.getcwd()))} bitmaps written.")
+    if function == 'merge-base':
+        if sys.argv[2:3] == ['--is-ancestor'] and len(sys.argv) == 5:
+            sys.exit(0 if is_ancestor(sys.argv[3], sys.argv[4]) else 1)
+        all_bases = '--all' in sys.argv[2:]
+        commits = [arg for arg in sys.argv[2:] if arg != '--all']
+        if len(commits) < 2:
+            print("usage: merge-base [--all] <commit> <commit>...\n"
+                  "       merge-base --is-ancestor <commit> <commit>")
+        else:
+            bases = merge_base(*commits, all_bases=all_bases)
+            print('\n'.join(bases))
+            if not bases:
+                sys.exit(1)
+    if function == 'cat-file':
+        options = sys.argv[2:]
+        if options and options[0] in ('--batch', '--batch-check') and (
+                set(options[1:]) <= {'--buffer'}):
+            cat_file_batch(sys.stdin, sys.stdout.buffer,
+                           contents=options[0] == '--batch',
+                           flush='--buffer' not in options)
+        else:
+            print("usage: cat-file (--batch | --batch-check) [--buffer] < <names>")
+    if function == 'rev-parse':
+        if sys.argv[2:3] == ['--stdin'] and set(sys.argv[3:]) <= {'--buffer'}:
+            rev_parse_batch(sys.stdin, sys.stdout, flush='--buffer' not in sys.argv)
+        elif len(sys.argv) > 2:
+            for revision in sys.argv[2:]:
+                print(rev_parse(is_wit_exists(os.getcwd()), revision))
+        else:
+            print("usage: rev-parse [--stdin [--buffer] | <rev>...]")
+    if function == 'rev-list':
+        if sys.argv[2:3] == ['--count'] and len(sys.argv) == 4:
+            print(count_commits(sys.argv[3]))
+        elif len(sys.argv) == 3:
+            print('\n'.join(rev_list(sys.argv[2])))
+        else:
+            print("usage: rev-list [--count] <rev>|<rev>..<rev>|<rev>...<rev>")
+    if function == 'gc':
+        prune = [arg.split('=', 1)[1] for arg in sys.argv[2:]
+                 if arg.startswith('--prune=')]
+        if not prune:
+            report = gc()
+        elif prune[0] == 'now':
+            report = gc(grace_period=0)
+        else:
+            report = gc(grace_period=float(prune[0]) * 24 * 60 * 60)
+        print(f"Removed {report['commits']} commits and "
+              f"{report['objects']} objects, packed {report['packed']} "
+              f"objects, reclaimed {report['bytes']} bytes.")
+    if function == 'fsck':
+        problems = fsck()
+        print('\n'.join(problems) or 'No problems found.')
+        if problems:
+            sys.exit(1)
+    if function == 'clone':
+        options = [arg for arg in sys.argv[2:] if arg.startswith('--')]
+        args = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+        reference = [option.split('=', 1)[1] for option in options
+                     if option.startswith('--reference=')]
+        if not args:
+            print("usage: clone [--shared] [--reference=<repo>] <path> [<dir>]")
+        else:
+            report = clone(*args[:2], shared='--shared' in options,
+                           reference=reference[0] if reference else None)
+            print(f"Linked {report['linked']} files, copied {report['copied']}.")
+    if function in ('fetch', 'push'):
+        if len(sys.argv) < 3:
+            print(f"usage: {function} <path> [<name>|<branch>]")
+        else:
+            report = (fetch if function == 'fetch' else push)(*sys.argv[2:4])
+            print(f"{report['commits']} commits, {report['objects']} objects, "
+                  f"{report['bytes']} bytes transferred.")
+    if function == 'worktree':
+        if sys.argv[2:3] == ['add'] and len(sys.argv) == 5:
+            worktree_add(sys.argv[3], sys.argv[4])
+        elif sys.argv[2:3] == ['list']:
+            for worktree in list_worktrees(is_wit_exists(os.getcwd())):
+                print(f"{worktree}  [{get_active_branch(worktree)}]")
+        else:
+            print("usage: worktree add <path> <branch>\n       worktree list")
+    if function == 'stash':
+        action = sys.argv[2] if len(sys.argv) > 2 else 'push'
+        if action == 'push':
+            stash_commit = stash_push(' '.join(sys.argv[3:]) or None)
+            print(f"Saved {stash_commit}" if stash_commit
+                  else "No local changes to save.")
+        elif action == 'pop':
+            stash_pop(int(sys.argv[3]) if len(sys.argv) > 3 else 0)
+        elif action == 'list':
+            for number, (_, message) in enumerate(read_stash(is_wit_exists(os.getcwd()))):
+                print(f"stash@{{{number}}}: {message}")
+        else:
+            print("usage: stash [push [<message>] | pop [<n>] | list]")
+    if function == 'cherry-pick':
+        if len(sys.argv) < 3:
+            print("usage: cherry-pick <commit>...\n"
+                  "Files both sides changed are merged line by line.")
+        else:
+            print(cherry_pick(*sys.argv[2:]))
+    if function == 'rebase':
+        if len(sys.argv) != 3:
+            print("usage: rebase <upstream>\n"
+                  "Files both sides changed are merged line by line.")
+        else:
+            print(rebase(sys.argv[2]))
     if function == 'merge':
         try:
             name = sys.argv[2]
@@ -0,0 +1,30 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import merge  # noqa: E402
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """An empty repository in a temporary directory, made the cwd."""
+    monkeypatch.chdir(tmp_path)
+    merge.init()
+    return str(tmp_path)
+
+
+@pytest.fixture
+def make_commit(repo):
+    """Return a function writing files ('relpath: content') and
+       committing them, which returns the new commit_id."""
+    def make_commit(files, message='message'):
+        for relpath, content in files.items():
+            path = os.path.join(repo, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(content)
+        merge.add(*files)
+        return merge.commit(message)
+    return make_commit
@@ -0,0 +1,49 @@
+import io
+import os
+
+import merge
+
+
+def cat_file(names, contents=True):
+    output = io.BytesIO()
+    merge.cat_file_batch(names, output, contents=contents)
+    return output.getvalue()
+
+
+def test_cat_file_batch(repo, make_commit):
+    head = make_commit({'f.txt': 'one\n', 'd/g.txt': 'g\n'})
+    blob = merge.path_sha(repo, head, 'f.txt')
+
+    lines = cat_file(['HEAD:f.txt\n', f'{blob}\n', '\n', 'HEAD\n'],
+                     contents=False).decode().splitlines()
+
+    record = merge.read_commit_record(repo, head)
+    assert lines == [f'{blob} blob 4', f'{blob} blob 4',
+                     f'{head} commit {len(record)}']
+    assert cat_file(['HEAD:f.txt']) == f'{blob} blob 4\none\n\n'.encode()
+    tree_line = cat_file(['HEAD:d'], contents=False).decode()
+    assert tree_line.split()[1:] == ['tree', str(len(merge.read_object(
+        repo, tree_line.split()[0])[1]))]
+
+
+def test_cat_file_batch_answers_bad_names_and_goes_on(repo, make_commit):
+    make_commit({'f.txt': 'one\n'})
+    merge.gc()  # Packed objects make non-hex names reach the pack index.
+    assert merge.list_packs(os.path.join(repo, '.wit', 'objects'))
+    bad = ['HEAD:f.txt/x', 'z' * 40, 'HEAD:nothing', 'nothing', 'HEAD~5']
+
+    lines = cat_file([*bad, 'HEAD:f.txt'], contents=False).decode().splitlines()
+
+    assert lines[:-1] == [f'{name} missing' for name in bad]
+    assert lines[-1].endswith(' blob 4')
+
+
+def test_rev_parse_batch(repo, make_commit):
+    first = make_commit({'f.txt': 'one\n'})
+    second = make_commit({'f.txt': 'two\n'})
+    output = io.StringIO()
+
+    merge.rev_parse_batch(['HEAD\n', 'HEAD~1\n', first[:8], 'z' * 40, 'nope'], output)
+
+    assert output.getvalue().splitlines() == [
+        second, first, first, f"{'z' * 40} missing", 'nope missing']
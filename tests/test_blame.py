@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+import merge
+
+
+def blamed(path):
+    return [(commit_id, line) for commit_id, _, _, line in merge.blame(path)]
+
+
+def test_blame_attributes_each_line(repo, make_commit, monkeypatch):
+    monkeypatch.setenv('WIT_AUTHOR', 'ann')
+    first = make_commit({'f.txt': 'a\nb\nc\n', 'g.txt': 'g\n'})
+    second = make_commit({'f.txt': 'a\nB\nc\nd\n'})
+    make_commit({'g.txt': 'g2\n'})
+
+    assert blamed('f.txt') == [(first, 'a'), (second, 'B'), (first, 'c'), (second, 'd')]
+    assert {author for _, author, _, _ in merge.blame('f.txt')} == {'ann'}
+
+
+def test_blame_follows_the_parent_a_merge_took_the_file_from(repo, make_commit):
+    first = make_commit({'f.txt': 'a\nb\n'})
+    merge.branch('topic')
+    merge.checkout('topic')
+    topic = make_commit({'f.txt': 'a\ntopic\n'})
+    merge.checkout('master')
+    make_commit({'g.txt': 'g\n'})
+    merge.merge('topic')
+
+    assert blamed('f.txt') == [(first, 'a'), (topic, 'topic')]
+
+
+def test_blame_in_a_subdirectory(repo, make_commit, monkeypatch):
+    first = make_commit({'d/f.txt': 'a\n'})
+    monkeypatch.chdir(os.path.join(repo, 'd'))
+
+    assert blamed('f.txt') == [(first, 'a')]
+
+
+def test_blame_of_a_path_not_in_head(repo, make_commit):
+    make_commit({'f.txt': 'a\n'})
+    with open(os.path.join(repo, 'new.txt'), 'w') as f:
+        f.write('new\n')
+
+    with pytest.raises(FileNotFoundError):
+        merge.blame('new.txt')
+    with pytest.raises(FileNotFoundError):
+        merge.blame('missing.txt')
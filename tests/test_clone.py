@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+import merge
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_clone_links_history(repo, make_commit, tmp_path_factory):
+    head = make_commit({'d/f.txt': 'one\n'})
+    destination = str(tmp_path_factory.mktemp('clone'))
+
+    report = merge.clone(repo, destination)
+
+    assert report['linked'] + report['copied'] > 0
+    assert merge.get_ref(destination)['HEAD'] == head
+    assert read(os.path.join(destination, 'd', 'f.txt')) == 'one\n'
+    assert merge.wit_dirs(destination) == [os.path.join(destination, '.wit')]
+
+
+def test_shared_clone_borrows_everything(repo, make_commit, tmp_path_factory, monkeypatch):
+    head = make_commit({'f.txt': 'one\n'})
+    destination = str(tmp_path_factory.mktemp('shared'))
+
+    report = merge.clone(repo, destination, shared=True)
+
+    assert report['linked'] == 0
+    assert merge.wit_dirs(destination)[1:] == [os.path.join(repo, '.wit')]
+    assert os.listdir(os.path.join(destination, '.wit', 'objects')) == []
+    assert merge.has_commit(destination, head)
+    assert read(os.path.join(destination, 'f.txt')) == 'one\n'
+    monkeypatch.chdir(destination)
+    with open(os.path.join(destination, 'f.txt'), 'w') as f:
+        f.write('two\n')
+    merge.add('f.txt')
+    child = merge.commit('two')
+    assert [entry['commit'] for entry in merge.log()] == [child, head]
+    assert not merge.has_commit(repo, child)
+
+
+def test_reference_clone_links_only_what_the_reference_lacks(
+        repo, make_commit, tmp_path_factory):
+    make_commit({'f.txt': 'one\n'})
+    cache = str(tmp_path_factory.mktemp('cache'))
+    merge.clone(repo, cache)
+    head = make_commit({'f.txt': 'two\n'})
+    destination = str(tmp_path_factory.mktemp('reference'))
+
+    merge.clone(repo, destination, reference=cache)
+
+    cached = {sha for _, sha, *_ in merge.stored_objects(cache)}
+    linked = {sha for _, sha, *_ in merge.stored_objects(destination)}
+    assert linked and not linked & cached
+    assert merge.get_ref(destination)['HEAD'] == head
+    assert read(os.path.join(destination, 'f.txt')) == 'two\n'
+
+
+def test_clone_of_a_directory_without_a_repository(tmp_path_factory):
+    with pytest.raises(merge.WitDirNotFoundError):
+        merge.clone(str(tmp_path_factory.mktemp('empty')),
+                    str(tmp_path_factory.mktemp('clone')))
@@ -0,0 +1,40 @@
+import os
+
+import merge
+
+
+def test_commit_writes_no_image(repo, make_commit):
+    first = make_commit({'f.txt': 'one\n', 'd/g.txt': 'g\n'})
+    second = make_commit({'f.txt': 'two\n'})
+
+    assert not os.path.exists(os.path.join(repo, '.wit', 'images', second))
+    assert merge.commit_entries(repo, second)['f.txt'] != (
+        merge.commit_entries(repo, first)['f.txt'])
+    assert merge.status()['Changes to be committed'] == []
+
+
+def test_status_lists_staged_files(repo, make_commit):
+    make_commit({'f.txt': 'one\n', 'g.txt': 'g\n'})
+    for relpath, content in (('f.txt', 'two\n'), ('h.txt', 'new\n')):
+        with open(os.path.join(repo, relpath), 'w') as f:
+            f.write(content)
+    merge.add('f.txt', 'h.txt')
+
+    staging_area = os.path.join(repo, '.wit', 'staging_area')
+    assert merge.status()['Changes to be committed'] == [
+        os.path.join(staging_area, 'f.txt'), os.path.join(staging_area, 'h.txt')]
+
+
+def test_checkout_and_merge_without_images(repo, make_commit):
+    first = make_commit({'f.txt': 'one\n'})
+    merge.branch('topic')
+    merge.checkout('topic')
+    make_commit({'g.txt': 'topic\n'})
+    merge.checkout('master')
+    with open(os.path.join(repo, 'f.txt')) as f:
+        assert f.read() == 'one\n'
+
+    merged = merge.merge('topic')
+
+    assert merge.commit_entries(repo, merged).keys() == {'f.txt', 'g.txt'}
+    assert merge.get_commit_data(repo, merged)['parent'][0] == first
@@ -0,0 +1,68 @@
+import os
+
+import merge
+
+
+def legacy_commit(repo, commit_id, parent, files):
+    """Write a commit with only an images directory, no tree."""
+    image = os.path.join(repo, '.wit', 'images', commit_id)
+    for relpath, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(image, relpath)), exist_ok=True)
+        with open(os.path.join(image, relpath), 'w') as f:
+            f.write(content)
+    fields = [('parent', parent), ('author', 'author'),
+              ('timestamp', '0 +0000'), ('message', commit_id[:6])]
+    merge.open_store(os.path.join(repo, '.wit')).put_commits(
+        [(commit_id, merge.format_commit_record(fields))])
+
+
+def test_graph_of_legacy_commits_stores_no_objects(repo):
+    first, second = 'a' * 40, 'b' * 40
+    legacy_commit(repo, first, 'None', {'f.txt': 'one\n'})
+    legacy_commit(repo, second, first, {'f.txt': 'two\n', 'g.txt': 'g\n'})
+    merge.write_refs(repo, {'HEAD': second, 'master': second})
+
+    merge.write_commit_graph(repo)
+    graph = merge.load_commit_graph(repo)
+
+    assert graph['bloom'] == ['-', '-']
+    assert merge.count_commits('HEAD') == 2
+    assert list(merge.stored_objects(repo)) == []
+
+
+def test_bloom_filters_rule_out_unchanged_paths(repo, make_commit):
+    make_commit({'f.txt': 'one\n', 'd/g.txt': 'g\n'})
+    second = make_commit({'f.txt': 'two\n'})
+    merge.write_commit_graph(repo)
+    graph = merge.load_commit_graph(repo)
+    position = graph['pos'][second]
+
+    assert merge.maybe_changed(graph, position, 'f.txt')
+    assert not merge.maybe_changed(graph, position, 'd/g.txt')
+
+
+def test_bitmaps_are_decoded_when_reached(repo, make_commit):
+    for i in range(6):
+        make_commit({'f.txt': f'{i}\n'})
+    assert merge.write_bitmaps(repo, every=2) == 3
+    bitmaps = merge.load_bitmaps(repo)
+    assert bitmaps.decoded == {}
+
+    assert merge.count_commits('HEAD') == 6
+    assert merge.count_commits('HEAD~2') == 4
+    assert set(bitmaps.decoded) <= set(bitmaps)
+    assert bitmaps[1] == 0b11
+
+
+def test_log_of_a_path_over_legacy_commits_hashes_nothing(repo):
+    first, second, third = 'a' * 40, 'b' * 40, 'c' * 40
+    legacy_commit(repo, first, 'None', {'f.txt': 'one\n', 'd/g.txt': 'g\n'})
+    legacy_commit(repo, second, first, {'f.txt': 'two\n', 'd/g.txt': 'g\n'})
+    legacy_commit(repo, third, second, {'f.txt': 'two\n', 'd/g.txt': 'g2\n'})
+    merge.write_refs(repo, {'HEAD': third, 'master': third})
+    merge.write_commit_graph(repo)
+
+    assert [entry['commit'] for entry in merge.log('f.txt')] == [second, first]
+    assert [entry['commit'] for entry in merge.log('d')] == [third, first]
+    assert merge.log('missing.txt') == []
+    assert list(merge.stored_objects(repo)) == []
@@ -0,0 +1,53 @@
+import pytest
+
+import merge
+
+
+@pytest.fixture(params=['array', 'numpy'])
+def backend(request, monkeypatch):
+    """Run a test with the `array` module, then with NumPy
+       (skipped if it isn't installed)."""
+    if request.param == 'numpy':
+        monkeypatch.setattr(merge, 'numpy', pytest.importorskip('numpy'))
+    else:
+        monkeypatch.setattr(merge, 'numpy', None)
+    return request.param
+
+
+DIAMOND = {'d': ['b', 'c'], 'b': ['a'], 'c': ['a'], 'a': [], 'e': ['d']}
+
+
+def test_csr_routines(backend):
+    csr = merge.csr_graph(DIAMOND)
+    index = csr['index']
+
+    order = [csr['ids'][i] for i in merge.csr_topological_order(csr).tolist()]
+    assert sorted(order) == sorted(DIAMOND)
+    for commit_id, parents in DIAMOND.items():
+        assert all(order.index(p) < order.index(commit_id) for p in parents)
+
+    generations = merge.csr_generations(csr).tolist()
+    assert {commit_id: generations[i] for commit_id, i in index.items()} == (
+        {'a': 1, 'b': 2, 'c': 2, 'd': 3, 'e': 4})
+    assert merge.csr_reachable_count(csr, [index['e']]) == 5
+    assert merge.csr_reachable_count(csr, [index['b'], index['c']]) == 3
+
+    child_offsets, children = (a.tolist() for a in merge.csr_children(csr))
+    a = index['a']
+    assert sorted(children[child_offsets[a]:child_offsets[a + 1]]) == (
+        sorted([index['b'], index['c']]))
+
+
+def test_topology_stats(backend, repo, make_commit):
+    make_commit({'f.txt': 'one\n'})
+    merge.branch('topic')
+    merge.checkout('topic')
+    make_commit({'g.txt': 'topic\n'})
+    merge.checkout('master')
+    make_commit({'f.txt': 'two\n'})
+    merge.merge('topic')
+
+    assert merge.topology_stats() == {
+        'commits': 4, 'roots': 1, 'merges': 1,
+        'max_generation': 3, 'reachable': 4}
+    assert merge.load_csr_graph(repo)['ids'] == merge.load_commit_graph(repo)['ids']
@@ -0,0 +1,61 @@
+import os
+import zlib
+
+import pytest
+
+import merge
+
+
+@pytest.fixture
+def history(repo, make_commit):
+    """Return the commit_id and blob sha of a committed 'd/f.txt'."""
+    head = make_commit({'d/f.txt': 'one\n'})
+    return head, merge.commit_entries(repo, head)['d/f.txt']
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_fsck_of_a_sound_repository(history, workers):
+    assert merge.fsck(workers=workers) == []
+
+
+def test_fsck_finds_a_corrupt_loose_object(repo, history):
+    _, sha = history
+    path = merge.object_path(repo, sha)
+    os.chmod(path, 0o644)
+    with open(path, 'wb') as f:
+        f.write(zlib.compress(b'blob 4\0two\n'))
+
+    assert any(sha in problem for problem in merge.fsck(workers=1))
+
+
+def test_fsck_finds_a_truncated_packed_object(repo, history):
+    _, sha = history
+    merge.gc()
+    (index_path, pack_path), = merge.list_packs(os.path.join(repo, '.wit', 'objects'))
+    offset, length = merge.find_in_pack_index(index_path, sha)
+    with open(pack_path, 'r+b') as f:
+        f.seek(offset)
+        f.write(b'\0' * length)
+
+    assert any(sha in problem for problem in merge.fsck(workers=1))
+
+
+def test_fsck_finds_missing_objects_and_commits(repo, history):
+    head, sha = history
+    os.remove(merge.object_path(repo, sha))
+    references = merge.get_ref(repo)
+    references['lost'] = 'f' * 40
+    merge.write_refs(repo, references)
+
+    problems = merge.fsck(workers=1)
+
+    assert any(problem.endswith(f'missing object {sha}') for problem in problems)
+    assert f"ref lost: missing commit {'f' * 40}" in problems
+
+
+def test_fsck_finds_a_missing_tree(repo, history):
+    head, _ = history
+    tree = merge.get_commit_data(repo, head)['tree']
+    os.remove(merge.object_path(repo, tree))
+
+    assert f'commit {head}: missing tree {tree}' in merge.fsck(workers=1)
@@ -0,0 +1,93 @@
+import os
+import time
+
+import merge
+
+
+def age_objects(repo, seconds):
+    then = time.time() - seconds
+    for dirpath, _, filenames in os.walk(os.path.join(repo, '.wit', 'objects')):
+        for filename in filenames:
+            os.utime(os.path.join(dirpath, filename), (then, then))
+
+
+def test_gc_packs_loose_objects(repo, make_commit):
+    make_commit({'f.txt': 'one\n', 'd/g.txt': 'g\n'})
+
+    report = merge.gc()
+
+    assert report['packed'] > 0
+    assert report['bytes'] >= 0
+    assert merge.fsck(workers=1) == []
+
+
+def test_gc_keeps_objects_of_commits_in_grace_period(repo, make_commit):
+    make_commit({'f.txt': 'one\n'})
+    merge.branch('topic')
+    merge.checkout('topic')
+    dangling = make_commit({'f.txt': 'topic\n'})
+    merge.checkout('master')
+    references = merge.get_ref(repo)
+    del references['topic']
+    merge.write_refs(repo, references)
+    age_objects(repo, 3600)
+
+    report = merge.gc(grace_period=60)
+
+    assert report['commits'] == 0
+    assert dangling in merge.list_commit_ids(repo)
+    blob = merge.commit_entries(repo, dangling)['f.txt']
+    assert merge.read_object(repo, blob)[1] == b'topic\n'
+    assert merge.fsck(workers=1) == []
+
+
+def test_gc_drops_unreachable_commits(repo, make_commit):
+    make_commit({'f.txt': 'one\n'})
+    merge.branch('topic')
+    merge.checkout('topic')
+    dangling = make_commit({'f.txt': 'topic\n'})
+    merge.checkout('master')
+    references = merge.get_ref(repo)
+    del references['topic']
+    merge.write_refs(repo, references)
+
+    report = merge.gc(grace_period=-60)
+
+    assert report['commits'] == 1
+    assert dangling not in merge.list_commit_ids(repo)
+    assert merge.fsck(workers=1) == []
+
+
+def test_marks_are_bits_of_the_packs(repo, make_commit):
+    make_commit({'f.txt': 'one\n'})
+    merge.gc()
+    loose = merge.write_object(repo, 'blob', b'loose\n')
+    blob = merge.commit_entries(repo, merge.get_ref(repo)['HEAD'])['f.txt']
+    marked = merge.ObjectMarks(repo)
+
+    marked.add(bytes.fromhex(blob))
+    marked.add(bytes.fromhex(loose))
+
+    assert bytes.fromhex(blob) in marked
+    assert bytes.fromhex(loose) in marked
+    assert marked.unpacked == {bytes.fromhex(loose)}
+    assert bytes.fromhex('ff' * 20) not in marked
+    marked.close()
+
+
+def test_gc_drops_garbage_from_several_packs(repo, make_commit):
+    make_commit({'f.txt': 'one\n'})
+    merge.gc()
+    garbage = merge.write_object(repo, 'blob', b'garbage\n')
+    head = make_commit({'f.txt': 'two\n'})
+    merge.write_pack(repo, [(garbage, merge.read_raw_object(repo, garbage))])
+    os.remove(merge.object_path(repo, garbage))
+    age_objects(repo, 3600)
+
+    report = merge.gc(grace_period=60)
+
+    assert report['objects'] == 1
+    assert not merge.has_object(repo, garbage)
+    assert len(merge.list_packs(os.path.join(repo, '.wit', 'objects'))) == 1
+    assert merge.read_object(repo, merge.commit_entries(repo, head)['f.txt'])[1] == b'two\n'
+    assert merge.fsck(workers=1) == []
@@ -0,0 +1,85 @@
+import glob
+import os
+
+import merge
+
+
+def test_torn_first_frame_in_new_segment(repo, make_commit):
+    first = make_commit({'f.txt': 'one\n'})
+    wit_path = os.path.join(repo, '.wit')
+    torn = os.path.join(wit_path, 'journal', 'segment-000002.log')
+    with open(torn, 'wb') as f:
+        f.write(merge.JOURNAL_FRAME.pack(b'\x01' * 20, 100)[:10])
+
+    offsets = merge.load_journal(wit_path)
+
+    assert set(offsets) == {first}
+    assert os.path.getsize(torn) == 0
+    assert os.path.exists(torn[:-4] + '.idx')
+    second = make_commit({'f.txt': 'two\n'})
+    assert set(merge.load_journal(wit_path)) == {first, second}
+
+
+def test_empty_segment_without_idx(repo, make_commit):
+    first = make_commit({'f.txt': 'one\n'})
+    wit_path = os.path.join(repo, '.wit')
+    open(os.path.join(wit_path, 'journal', 'segment-000002.log'), 'wb').close()
+    merge._journal_cache.clear()
+
+    assert set(merge.load_journal(wit_path)) == {first}
+    assert merge.log()[0]['commit'] == first
+
+
+def to_commit_files(wit_path):
+    """Turn a repository's journal back into one file per commit."""
+    records = dict(merge.open_store(wit_path).iter_commits())
+    for commit_id, record in records.items():
+        with open(os.path.join(wit_path, 'images', f'{commit_id}.txt'), 'wb') as f:
+            f.write(record)
+    for path in glob.glob(os.path.join(wit_path, 'journal', '*')):
+        os.remove(path)
+    os.rmdir(os.path.join(wit_path, 'journal'))
+    merge._journal_cache.clear()
+    return records
+
+
+def test_migrate_commit_files(repo, make_commit):
+    make_commit({'f.txt': 'one\n'})
+    make_commit({'f.txt': 'two\n'})
+    wit_path = os.path.join(repo, '.wit')
+    records = to_commit_files(wit_path)
+
+    assert set(merge.load_journal(wit_path)) == set(records)
+    assert dict(merge.open_store(wit_path).iter_commits()) == records
+    assert not glob.glob(os.path.join(wit_path, 'images', '*.txt'))
+    assert not glob.glob(os.path.join(wit_path, 'tmp_*'))
+
+
+def test_failed_migration_keeps_commit_files(repo, make_commit, monkeypatch):
+    make_commit({'f.txt': 'one\n'})
+    wit_path = os.path.join(repo, '.wit')
+    records = to_commit_files(wit_path)
+
+    def crash(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(merge, 'append_commit_records', crash)
+
+    assert merge.load_journal(wit_path) is None
+    assert not os.path.exists(os.path.join(wit_path, 'journal'))
+    assert dict(merge.open_store(wit_path).iter_commits()) == records
+
+
+def test_compact_journal(repo, make_commit):
+    first = make_commit({'f.txt': 'one\n'})
+    second = make_commit({'f.txt': 'two\n'})
+    wit_path = os.path.join(repo, '.wit')
+    record = merge.read_commit_record(repo, first)
+
+    dropped = merge.compact_journal(wit_path, lambda commit_id, _: commit_id == first)
+
+    assert dropped == 1
+    assert set(merge.load_journal(wit_path)) == {first}
+    assert merge.read_commit_record(repo, first) == record
+    assert len(merge.journal_segments(wit_path)) == 1
+    assert merge.compact_journal(wit_path, lambda *_: True) == 0
+    assert second not in merge.list_commit_ids(repo)
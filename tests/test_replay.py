@@ -0,0 +1,113 @@
+import os
+
+import pytest
+
+import merge
+
+
+def read(repo, relpath):
+    with open(os.path.join(repo, relpath)) as f:
+        return f.read()
+
+
+BASE = ''.join(f'line {i}\n' for i in range(10))
+
+
+def edit(text, number, content):
+    lines = text.splitlines(keepends=True)
+    lines[number] = content
+    return ''.join(lines)
+
+
+def topic_and_master(make_commit, topic_files, master_files):
+    """Commit the base, `topic_files` on 'topic' and `master_files`
+       on master; return the topic commit_id."""
+    make_commit({'f.txt': BASE})
+    merge.branch('topic')
+    merge.checkout('topic')
+    topic = make_commit(topic_files, 'topic')
+    merge.checkout('master')
+    make_commit(master_files, 'master')
+    return topic
+
+
+def test_merge_lines():
+    base = ['a\n', 'b\n', 'c\n', 'd\n', 'e\n']
+    ours = ['A\n', 'b\n', 'c\n', 'd\n', 'e\n']
+    theirs = ['a\n', 'b\n', 'c\n', 'd\n', 'E\n']
+    assert merge.merge_lines(base, ours, theirs) == ['A\n', 'b\n', 'c\n', 'd\n', 'E\n']
+    assert merge.merge_lines(base, ours, ours) == ours
+    assert merge.merge_lines(base, ours, ['B\n', 'b\n', 'c\n', 'd\n', 'e\n']) is None
+    # Touching hunks are one region.
+    assert merge.merge_lines(base, ours, ['a\n', 'B\n', 'c\n', 'd\n', 'e\n']) is None
+
+
+def test_cherry_pick_merges_unrelated_lines_of_a_file(repo, make_commit):
+    topic = topic_and_master(make_commit, {'f.txt': edit(BASE, 8, 'topic\n')},
+                             {'f.txt': edit(BASE, 1, 'master\n')})
+
+    head = merge.cherry_pick(topic)
+
+    assert read(repo, 'f.txt') == edit(edit(BASE, 1, 'master\n'), 8, 'topic\n')
+    assert merge.get_commit_data(repo, head)['message'] == 'topic'
+    assert merge.status()['Changes to be committed'] == []
+
+
+def test_same_change_on_both_sides_does_not_conflict(repo, make_commit):
+    changed = edit(BASE, 3, 'same\n')
+    topic = topic_and_master(make_commit, {'f.txt': changed, 'g.txt': 'g\n'},
+                             {'f.txt': changed})
+
+    merge.cherry_pick(topic)
+
+    assert read(repo, 'f.txt') == changed
+    assert read(repo, 'g.txt') == 'g\n'
+
+
+def test_rebase_replays_commits_on_upstream(repo, make_commit):
+    make_commit({'f.txt': BASE})
+    merge.branch('topic')
+    merge.checkout('topic')
+    make_commit({'g.txt': 'one\n'}, 'one')
+    make_commit({'g.txt': 'two\n'}, 'two')
+    merge.checkout('master')
+    upstream = make_commit({'f.txt': edit(BASE, 0, 'master\n')}, 'master')
+    merge.checkout('topic')
+
+    head = merge.rebase('master')
+
+    assert merge.get_ref(repo)['topic'] == head
+    assert [entry['message'] for entry in merge.log()] == ['two', 'one', 'master', 'message']
+    assert merge.get_commit_data(repo, merge.get_commit_data(repo, head)['parent'][0])[
+        'parent'] == [upstream]
+    assert read(repo, 'f.txt') == edit(BASE, 0, 'master\n')
+    assert read(repo, 'g.txt') == 'two\n'
+
+
+def test_conflict_writes_no_commits(repo, make_commit):
+    topic = topic_and_master(make_commit, {'f.txt': edit(BASE, 5, 'topic\n')},
+                             {'f.txt': edit(BASE, 5, 'master\n')})
+    merge.checkout('topic')
+    clean = make_commit({'g.txt': 'g\n'}, 'clean')
+    merge.checkout('master')
+    head = merge.get_ref(repo)['HEAD']
+    store = merge.open_store(os.path.join(repo, '.wit'))
+    commits = store.commit_ids()
+
+    with pytest.raises(merge.MergeConflictError, match='f.txt'):
+        merge.cherry_pick(clean, topic)
+
+    assert store.commit_ids() == commits
+    assert merge.get_ref(repo)['HEAD'] == head
+    assert read(repo, 'f.txt') == edit(BASE, 5, 'master\n')
+
+
+def test_deleted_and_changed_file_conflicts(repo):
+    base, changed = (merge.write_object(repo, 'blob', content.encode())
+                     for content in (BASE, edit(BASE, 2, 'topic\n')))
+
+    merged, conflicts = merge.merge_trees(
+        repo, {'f.txt': base}, {}, {'f.txt': changed})
+
+    assert conflicts == ['f.txt']
+    assert merged == {}
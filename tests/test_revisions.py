@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import merge
+
+
+@pytest.fixture
+def no_listing(monkeypatch):
+    def list_commit_ids(root):
+        raise AssertionError('listed every commit')
+    monkeypatch.setattr(merge, 'list_commit_ids', list_commit_ids)
+
+
+def test_expand_commit_id(repo, make_commit, no_listing):
+    first = make_commit({'f.txt': 'one\n'})
+    second = make_commit({'f.txt': 'two\n'})
+
+    assert merge.expand_commit_id(repo, first[:8]) == first
+    assert merge.resolve(repo, second[:6]) == second
+    unknown = next(c for c in '0123456789abcdef' if c not in (first[0], second[0]))
+    assert merge.expand_commit_id(repo, unknown * 8) is None
+
+
+def test_stash_commits_are_in_the_id_index(repo, make_commit, no_listing):
+    make_commit({'f.txt': 'one\n'})
+    merge.load_commit_graph(repo)
+    with open(os.path.join(repo, 'f.txt'), 'w') as f:
+        f.write('stashed\n')
+    stash_commit = merge.stash_push()
+
+    assert merge.expand_commit_id(repo, stash_commit[:10]) == stash_commit
+
+
+def test_graph_opens_the_id_index_once(repo, make_commit, monkeypatch):
+    for number in range(5):
+        make_commit({'f.txt': f'{number}\n'})
+    opened = []
+    load = merge.load_commit_id_index
+    monkeypatch.setattr(merge, 'load_commit_id_index',
+                        lambda root: opened.append(root) or load(root))
+
+    merge.graph()
+    assert len(opened) == 1
+
+
+def test_revision_operators(repo, make_commit):
+    first = make_commit({'f.txt': 'one\n'})
+    second = make_commit({'f.txt': 'two\n'})
+    third = make_commit({'f.txt': 'three\n'})
+
+    assert merge.resolve(repo, 'HEAD~2') == first
+    assert merge.resolve(repo, 'master^') == second
+    assert merge.rev_list(f'{first}..HEAD') == [third, second]
+    with pytest.raises(merge.BadRevisionError):
+        merge.resolve(repo, 'HEAD~3')
@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+import merge
+
+
+def read(repo, relpath):
+    with open(os.path.join(repo, relpath)) as f:
+        return f.read()
+
+
+def test_stash_round_trip(repo, make_commit):
+    make_commit({'f.txt': 'one\n', 'g.txt': 'g\n'})
+    with open(os.path.join(repo, 'f.txt'), 'w') as f:
+        f.write('stashed\n')
+
+    assert merge.stash_push()
+    assert read(repo, 'f.txt') == 'one\n'
+    merge.stash_pop()
+    assert read(repo, 'f.txt') == 'stashed\n'
+    assert merge.read_stash(repo) == []
+
+
+def test_stash_pop_refuses_files_head_changed(repo, make_commit):
+    make_commit({'f.txt': 'one\n'})
+    with open(os.path.join(repo, 'f.txt'), 'w') as f:
+        f.write('stashed\n')
+    merge.stash_push()
+    head = make_commit({'f.txt': 'head\n'})
+    index = merge.read_index(repo)
+
+    with pytest.raises(merge.MergeConflictError):
+        merge.stash_pop()
+
+    assert read(repo, 'f.txt') == 'head\n'
+    assert merge.read_index(repo) == index
+    assert len(merge.read_stash(repo)) == 1
+    assert merge.get_ref(repo)['HEAD'] == head
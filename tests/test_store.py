@@ -0,0 +1,82 @@
+import os
+import sqlite3
+
+import pytest
+
+import merge
+import wit
+
+
+@pytest.mark.parametrize('store', ['filesystem', 'sqlite', 'memory'])
+def test_repository_on_every_store(store, tmp_path):
+    repo = wit.Repository.init(str(tmp_path), store=store)
+    with open(tmp_path / 'f.txt', 'w') as f:
+        f.write('one\n')
+    repo.add('f.txt')
+    first = repo.commit('first')
+    repo.branch('topic')
+
+    assert type(merge.open_store(str(tmp_path / '.wit'))).__name__ == (
+        merge.STORES[store].__name__)
+    assert repo.branches == {'master': first.id, 'topic': first.id}
+    assert [commit.id for commit in repo.log()] == [first.id]
+    assert merge.get_ref_index(repo.root) == {first.id: ['master', 'topic']}
+
+
+@pytest.mark.parametrize('store', ['filesystem', 'sqlite'])
+def test_refs_cache_sees_other_writers(store, tmp_path):
+    repo = wit.Repository.init(str(tmp_path), store=store)
+    with open(tmp_path / 'f.txt', 'w') as f:
+        f.write('one\n')
+    repo.add('f.txt')
+    head = repo.commit('first').id
+    assert 'other' not in repo.branches
+
+    wit_path = str(tmp_path / '.wit')
+    if store == 'sqlite':
+        connection = sqlite3.connect(os.path.join(wit_path, 'store.sqlite'))
+        with connection:
+            connection.execute("INSERT INTO refs VALUES (9, 'other', ?)", (head,))
+        connection.close()
+    else:
+        with open(os.path.join(wit_path, 'references.txt'), 'a') as f:
+            f.write(f'other={head}\n')
+
+    assert repo.branches['other'] == head
+    assert 'other' in merge.get_ref_index(repo.root)[head]
+
+
+def test_refs_are_indexed_once(repo, make_commit, monkeypatch):
+    make_commit({'f.txt': 'one\n'})
+    store = merge.open_store(os.path.join(repo, '.wit'))
+    merge.get_ref(repo)
+    calls = []
+    monkeypatch.setattr(store, 'get_refs', lambda: calls.append(1))
+
+    for _ in range(3):
+        merge.get_ref(repo)
+        merge.get_ref_index(repo)
+    assert calls == []
+
+
+def test_sqlite_store_streams_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(merge, 'SQLITE_BATCH_SIZE', 2)
+    repo = wit.Repository.init(str(tmp_path), store='sqlite')
+    commits = []
+    for i in range(5):
+        with open(tmp_path / 'f.txt', 'w') as f:
+            f.write(f'{i}\n')
+        repo.add('f.txt')
+        commits.append(repo.commit(str(i)).id)
+    store = merge.open_store(str(tmp_path / '.wit'))
+    assert [commit_id for commit_id, _ in store.iter_commits()] == commits
+
+    store.put_object('ff' * 20, b'garbage')
+    monkeypatch.setattr(store, 'iter_objects', lambda: pytest.fail('records read'))
+    monkeypatch.chdir(tmp_path)
+    report = merge.gc()
+
+    assert report['objects'] == 1
+    assert report['bytes'] == len(b'garbage')
+    assert not store.has_object('ff' * 20)
+    assert store.has_commit(commits[-1])
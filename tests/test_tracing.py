@@ -0,0 +1,69 @@
+import json
+import os
+import pstats
+import subprocess
+import sys
+
+import pytest
+
+import merge
+
+MERGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'merge.py')
+
+
+def wit(repo, *args, **env):
+    """Run a command of the CLI in `repo` with extra environment."""
+    environ = {key: value for key, value in os.environ.items()
+               if not key.startswith('WIT_')}
+    return subprocess.run([sys.executable, MERGE, *args], cwd=repo, env={**environ, **env},
+                          capture_output=True, text=True, check=True)
+
+
+@pytest.fixture
+def cli_repo(tmp_path):
+    wit(tmp_path, 'init')
+    (tmp_path / 'f.txt').write_text('one\n')
+    wit(tmp_path, 'add', 'f.txt')
+    wit(tmp_path, 'commit', 'first')
+    return tmp_path
+
+
+def test_no_tracing_without_the_environment(cli_repo):
+    result = wit(cli_repo, 'status')
+
+    assert result.stderr == ''
+    assert not os.path.exists(cli_repo / 'wit-trace.json')
+
+
+@pytest.mark.skipif(bool(merge.WIT_TRACE), reason='tests run traced')
+def test_traced_functions_are_undecorated():
+    assert not hasattr(merge.status, '__wrapped__')
+    merge.trace_add(files=1)
+
+
+def test_trace_summary(cli_repo):
+    result = wit(cli_repo, 'status', WIT_TRACE='1')
+
+    header, *rows = result.stderr.splitlines()
+    assert header.split() == ['span', 'calls', 'ms', 'counters']
+    names = [row.split()[0] for row in rows]
+    assert 'status' in names and 'untracked' in names
+    assert any('dirs=' in row for row in rows)
+
+
+def test_chrome_trace(cli_repo):
+    trace_file = cli_repo / 'trace.json'
+    wit(cli_repo, 'status', WIT_TRACE='chrome', WIT_TRACE_FILE=str(trace_file))
+
+    events = json.loads(trace_file.read_text())['traceEvents']
+    assert events[0]['name'] == 'wit status'
+    assert {'status', 'untracked'} <= {event['name'] for event in events}
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+
+
+def test_profile(cli_repo, tmp_path_factory):
+    profiles = tmp_path_factory.mktemp('profiles') / 'new'
+    wit(cli_repo, 'status', WIT_PROFILE=str(profiles))
+
+    stats = pstats.Stats(str(profiles / 'wit-status.prof'))
+    assert any(name == 'status' for _, _, name in stats.stats)
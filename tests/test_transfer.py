@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import merge
+
+
+def test_fetch_builds_images_on_demand(repo, make_commit, tmp_path_factory, monkeypatch):
+    make_commit({'d/f.txt': 'one\n'})
+    other = str(tmp_path_factory.mktemp('other'))
+    merge.clone(repo, other)
+    commit_id = make_commit({'d/f.txt': 'two\n'})
+    monkeypatch.chdir(other)
+
+    assert merge.fetch(repo)['commits'] == 1
+
+    assert not os.path.exists(os.path.join(other, '.wit', 'images', commit_id))
+    image = merge.ensure_image(other, commit_id)
+    with open(os.path.join(image, 'd', 'f.txt')) as f:
+        assert f.read() == 'two\n'
+
+
+def test_push_rejects_diverged_remote(repo, make_commit, tmp_path_factory, monkeypatch):
+    make_commit({'f.txt': 'one\n'})
+    remote = str(tmp_path_factory.mktemp('remote'))
+    merge.clone(repo, remote)
+    monkeypatch.chdir(remote)
+    merge.branch('topic')
+    merge.checkout('topic')
+    with open(os.path.join(remote, 'f.txt'), 'w') as f:
+        f.write('remote\n')
+    merge.add('f.txt')
+    merge.commit('remote change')
+    monkeypatch.chdir(repo)
+    merge.branch('topic')
+    merge.checkout('topic')
+    make_commit({'f.txt': 'local\n'})
+
+    with pytest.raises(merge.PushRejectedError):
+        merge.push(remote, 'topic')
+
+
+def test_fetch_skips_the_remotes_remote_tracking_refs(
+        repo, make_commit, tmp_path_factory, monkeypatch):
+    head = make_commit({'f.txt': 'one\n'})
+    middle = str(tmp_path_factory.mktemp('middle'))
+    merge.clone(repo, middle)
+    monkeypatch.chdir(middle)
+    merge.fetch(repo)
+    assert merge.get_ref(middle)['origin/master'] == head
+    other = str(tmp_path_factory.mktemp('other'))
+    merge.clone(middle, other)
+    monkeypatch.chdir(other)
+
+    merge.fetch(middle)
+
+    references = merge.get_ref(other)
+    assert references['origin/master'] == head
+    assert not any(name.startswith('origin/origin/') for name in references)
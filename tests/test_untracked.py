@@ -0,0 +1,64 @@
+import os
+
+import merge
+
+
+def untracked(repo):
+    return sorted(os.path.relpath(path, repo)
+                  for path in merge.untracked_files(repo, merge.read_index(repo)))
+
+
+def age_dirs(repo, seconds=60):
+    for dirpath, dirnames, _ in os.walk(repo):
+        dirnames[:] = [name for name in dirnames if name != '.wit']
+        stat = os.stat(dirpath)
+        os.utime(dirpath, ns=(stat.st_atime_ns, stat.st_mtime_ns - seconds * 10**9))
+
+
+def write(repo, relpath, content='x\n'):
+    path = os.path.join(repo, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def test_untracked_cache_lists_only_changed_dirs(repo, make_commit, monkeypatch):
+    make_commit({'f.txt': 'f\n', 'd/g.txt': 'g\n', 'e/h.txt': 'h\n'})
+    write(repo, 'd/new.txt')
+    age_dirs(repo)
+    assert untracked(repo) == ['d/new.txt']
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: listed.append(path) or scandir(path))
+
+    assert untracked(repo) == ['d/new.txt']
+    assert listed == []
+
+    write(repo, 'e/other.txt')
+    assert untracked(repo) == ['d/new.txt', 'e/other.txt']
+    assert listed == [os.path.join(repo, 'e')]
+
+
+def test_untracked_cache_follows_the_index(repo, make_commit):
+    make_commit({'f.txt': 'f\n'})
+    write(repo, 'd/new.txt')
+    write(repo, 'd/sub/deep.txt')
+    assert untracked(repo) == ['d/new.txt', 'd/sub/deep.txt']
+
+    merge.add('d/new.txt')
+    assert untracked(repo) == ['d/sub/deep.txt']
+
+    merge.remove_path(os.path.join(repo, 'd', 'sub'))
+    assert untracked(repo) == []
+
+
+def test_unreadable_cache_is_rebuilt(repo, make_commit):
+    make_commit({'f.txt': 'f\n'})
+    write(repo, 'new.txt')
+    untracked(repo)
+    with open(os.path.join(repo, '.wit', 'untracked.txt'), 'w') as f:
+        f.write('# untracked 0\nD 0 0 \nU stale.txt\n')
+
+    assert untracked(repo) == ['new.txt']
+    with open(os.path.join(repo, '.wit', 'untracked.txt')) as f:
+        assert f.readline() == f'# untracked {merge.UNTRACKED_VERSION}\n'
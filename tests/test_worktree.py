@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+import merge
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+@pytest.fixture
+def worktree(repo, make_commit, tmp_path_factory):
+    """A 'topic' branch checked out in a second worktree."""
+    make_commit({'f.txt': 'one\n'})
+    merge.branch('topic')
+    path = str(tmp_path_factory.mktemp('worktrees') / 'topic')
+    merge.worktree_add(path, 'topic')
+    return path
+
+
+def test_worktree_add_checks_out_the_branch(repo, worktree):
+    assert read(os.path.join(worktree, 'f.txt')) == 'one\n'
+    assert merge.get_active_branch(worktree) == 'topic'
+    assert merge.list_worktrees(repo) == [repo, worktree]
+    assert merge.common_dir(worktree) == os.path.join(repo, '.wit')
+
+
+def test_worktrees_share_history(repo, worktree, monkeypatch):
+    monkeypatch.chdir(worktree)
+    with open(os.path.join(worktree, 'f.txt'), 'w') as f:
+        f.write('topic\n')
+    merge.add('f.txt')
+    topic = merge.commit('topic')
+    monkeypatch.chdir(repo)
+
+    assert merge.get_ref(repo)['topic'] == topic
+    assert merge.get_ref(repo)['HEAD'] != topic
+    assert read(os.path.join(repo, 'f.txt')) == 'one\n'
+    assert merge.status()['Changes to be committed'] == []
+
+
+def test_branch_checked_out_elsewhere_is_refused(repo, worktree, tmp_path_factory):
+    with pytest.raises(merge.BranchCheckedOutError):
+        merge.checkout('topic')
+    with pytest.raises(merge.BranchCheckedOutError):
+        merge.worktree_add(str(tmp_path_factory.mktemp('again') / 'topic'), 'topic')
+    with pytest.raises(merge.BranchCheckedOutError):
+        merge.worktree_add(str(tmp_path_factory.mktemp('main') / 'master'), 'master')
+    assert merge.get_active_branch(repo) == 'master'
+
+
+def test_removed_worktree_is_not_listed(repo, worktree):
+    merge.remove_path(worktree)
+
+    assert merge.list_worktrees(repo) == [repo]
+    merge.checkout('topic')
+    assert merge.get_active_branch(repo) == 'topic'
+
+
+def test_gc_keeps_what_a_worktree_staged(repo, worktree, monkeypatch):
+    monkeypatch.chdir(worktree)
+    with open(os.path.join(worktree, 'g.txt'), 'w') as f:
+        f.write('staged\n')
+    merge.add('g.txt')
+    sha = merge.read_index(worktree)['g.txt'][0]
+    monkeypatch.chdir(repo)
+
+    merge.gc(grace_period=-60)
+
+    assert merge.read_object(repo, sha)[1] == b'staged\n'
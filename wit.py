@@ -0,0 +1,150 @@
+"""Use wit from Python, without a process per command.
+
+A Repository runs merge.py's commands in-process, so the refs,
+index, commit graph and object caches they keep stay warm from
+one call to the next, and returns their results as namedtuples
+rather than printed dicts:
+
+    repo = wit.Repository('path/to/repo')
+    repo.add('file.txt')
+    head = repo.commit('message')
+    print(head.id, head.parents, repo.status().staged)
+
+The commands work on the current directory, so every call
+switches into the repository's root under a process-wide lock;
+calls from several threads are run one at a time.
+"""
+import collections
+import contextlib
+import os
+import threading
+
+import merge
+
+
+Commit = collections.namedtuple(
+    'Commit', ['id', 'parents', 'tree', 'author', 'date', 'message', 'refs'])
+Status = collections.namedtuple(
+    'Status', ['head', 'staged', 'unstaged', 'untracked'])
+
+_cwd_lock = threading.RLock()
+
+
+@contextlib.contextmanager
+def working_directory(path):
+    """Run the enclosed block with `path` as the cwd."""
+    with _cwd_lock:
+        cwd = os.getcwd()
+        os.chdir(path)
+        try:
+            yield
+        finally:
+            os.chdir(cwd)
+
+
+class Repository:
+    """A wit repository, found from `path` like the commands find it
+       from the cwd.
+
+    Raises:
+        WitDirNotFoundError: If no parent directory of `path`
+          has a '.wit' directory.
+    """
+
+    def __init__(self, path='.'):
+        self.root = merge.is_wit_exists(os.path.abspath(path))
+
+    def __repr__(self):
+        return f'Repository({self.root!r})'
+
+    @classmethod
+    def init(cls, path, store='filesystem'):
+        """Create a repository in `path` (see `merge.init`). A
+           'memory' store lives only as long as this process."""
+        os.makedirs(path, exist_ok=True)
+        with working_directory(path):
+            merge.init(store)
+        return cls(path)
+
+    def _run(self, command, *args, **kwargs):
+        with working_directory(self.root):
+            return command(*args, **kwargs)
+
+    def _path(self, path):
+        return os.path.join(self.root, path)
+
+    def get_commit(self, revision='HEAD'):
+        """Return the Commit a revision (see `merge.resolve`) names."""
+        commit_id = merge.resolve(self.root, revision)
+        refs = list(merge.get_ref_index(self.root).get(commit_id, ()))
+        if commit_id == self.head:
+            refs.insert(0, 'HEAD')
+        return self._commit(commit_id, refs)
+
+    def _commit(self, commit_id, refs, commit_data=None):
+        commit_data = commit_data or merge.get_commit_data(self.root, commit_id)
+        return Commit(
+            id=commit_id,
+            parents=tuple(p for p in commit_data['parent'] if p != 'None'),
+            tree=commit_data.get('tree'),
+            author=commit_data.get('author'),
+            date=commit_data['date'],
+            message=commit_data['message'],
+            refs=tuple(refs),
+        )
+
+    @property
+    def head(self):
+        return merge.get_ref(self.root)['HEAD']
+
+    @property
+    def active_branch(self):
+        """The checked out branch, '' for a detached HEAD."""
+        return merge.get_active_branch(self.root)
+
+    @property
+    def branches(self):
+        """The 'name: commit_id' dict of the branches."""
+        return {name: commit_id for name, commit_id in merge.get_ref(self.root).items()
+                if name != 'HEAD'}
+
+    def add(self, *paths, dry_run=False):
+        """Stage files; relative paths are taken from the root.
+
+        Returns:
+            list: The relpaths of the staged (changed) files.
+        """
+        return self._run(merge.add, *map(self._path, paths), dry_run=dry_run)
+
+    def commit(self, message):
+        """Commit the staging area and return the new Commit."""
+        return self.get_commit(self._run(merge.commit, message))
+
+    def status(self):
+        status = self._run(merge.status)
+        return Status(
+            head=status['HEAD'],
+            staged=status['Changes to be committed'],
+            unstaged=status['Changes not staged for commit'],
+            untracked=status['Untracked files'],
+        )
+
+    def checkout(self, identifier):
+        """Check out a branch or commit and return its Commit."""
+        return self.get_commit(self._run(merge.checkout, identifier))
+
+    def branch(self, name):
+        """Create a branch at HEAD and return HEAD's Commit."""
+        self._run(merge.branch, name)
+        return self.get_commit()
+
+    def merge(self, name):
+        """Merge a branch into HEAD and return the merge Commit."""
+        return self.get_commit(self._run(merge.merge, name))
+
+    def log(self, path=None):
+        """Return HEAD's history as Commits, newest first."""
+        if path is not None:
+            path = self._path(path)
+        return [self._commit(entry['commit'], entry['refs'], entry)
+                for entry in self._run(merge.log, path)]